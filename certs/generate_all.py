@@ -370,7 +370,7 @@ def restart_tls_services():
     Restart services using TLS certs.
     Перезапускает сервисы, использующие TLS-сертификаты.
     """
-    services = ["kube-apiserver", "etcd"]
+    services = ["kube-apiserver", "etcd", "intake_ipam"]
     for service in services:
         result = subprocess.run(["systemctl", "is-active", service], stdout=subprocess.DEVNULL)
         if result.returncode == 0:
@@ -399,7 +399,9 @@ def main():
         "etcd-healthcheck": f"{ETCD_DIR}/healthcheck-client",
         "front-proxy-client": f"{PKI_DIR}/front-proxy-client",
         "front-proxy-ca": f"{PKI_DIR}/front-proxy-ca",
-        "admin": f"{PKI_DIR}/admin"
+        "admin": f"{PKI_DIR}/admin",
+        # серверный сертификат mTLS-слушателя cps_service (SAN: hostname и IP ноды)
+        "intake": f"{PKI_DIR}/intake"
     }
 
     for name, base in certs.items():
@@ -38,6 +38,8 @@ def collect_input() -> dict:
         "DISCOVERY_HASH": ask("DISCOVERY_HASH"),
         "CILIUM_TOKEN": ask("CILIUM_TOKEN"),
         "IPAM_PASSWORD": ask("1IPAM_PASSWORD"),
+        # необязательно: порт прямого mTLS API intake, пусто — только SSH
+        "INTAKE_TLS_PORT": input("INTAKE_TLS_PORT (пусто — только SSH): ").strip(),
     }
 
 
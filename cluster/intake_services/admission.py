@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Admission control for intake requests: rate limits, bounded queue, Retry-After.
+
+Контроль допуска запросов intake: ограничение частоты, ограниченная очередь, Retry-After.
+
+When an autoscaler starts many workers at once, each of them calls /register
+immediately and every call fans out to kubectl and the API server. The service
+admits mutating requests through AdmissionControl:
+  - a token bucket per client (worker IP, or the SSH peer forwarded by
+    node_intake_client.py) and a global one; an empty bucket answers 429;
+  - at most `max_active` admitted requests run at once, up to `max_queue`
+    more wait in FIFO order for `queue_timeout` seconds; a full queue or a
+    timeout answers 503;
+  - every rejection carries Retry-After. The global bucket also counts the
+    clients it has already sent away and spreads their Retry-After over the
+    time it takes to serve them, so a rejected storm does not come back in
+    the same second.
+Limits are per service process; cps_service divides all of them, the
+per-client ones included, between INTAKE_WORKERS processes (a bucket keeps a
+burst of at least one request).
+
+Clients (worker_bootstrap.py, worker_delete.py) retry throttled calls with
+retry_throttled(): Retry-After plus exponential backoff with full jitter,
+until a deadline; 409 (same idempotency key still in progress) is retried
+the same way. node_intake_client.py exits with THROTTLED_EXIT and prints a
+throttled_line(), so the SSH path reports throttling the same way.
+
+Когда автоскейлер поднимает много воркеров разом, каждый сразу вызывает
+/register, и каждый вызов расходится в kubectl и API-сервер. Сервис
+допускает изменяющие запросы через AdmissionControl:
+  - token bucket на клиента (IP воркера или SSH-клиент, переданный
+    node_intake_client.py) и общий; пустое ведро — ответ 429;
+  - одновременно выполняется не больше `max_active` допущенных запросов, ещё
+    до `max_queue` ждут в порядке очереди не дольше `queue_timeout` секунд;
+    полная очередь или таймаут — ответ 503;
+  - каждый отказ содержит Retry-After. Общее ведро учитывает уже отказанных
+    клиентов и растягивает их Retry-After на время, нужное, чтобы их
+    обслужить, — отклонённый шторм не возвращается в ту же секунду.
+Лимиты действуют на процесс сервиса; cps_service делит их все, включая
+лимиты на клиента, между процессами INTAKE_WORKERS (запас ведра — не меньше
+одного запроса).
+
+Клиенты (worker_bootstrap.py, worker_delete.py) повторяют отклонённые вызовы
+через retry_throttled(): Retry-After плюс экспоненциальная задержка с полным
+джиттером, до крайнего срока; так же повторяется 409 (запрос с тем же ключом
+идемпотентности ещё выполняется). node_intake_client.py завершается с кодом
+THROTTLED_EXIT и печатает строку throttled_line(), поэтому SSH-путь сообщает
+об ограничении так же.
+"""
+
+import re
+import math
+import time
+import random
+import asyncio
+
+# Ответы «повторите позже»: лимит частоты, перегрузка, запрос с тем же ключом идемпотентности ещё идёт
+RETRY_LATER_CODES = (409, 429, 503)
+
+# Код выхода node_intake_client.py на такой ответ (EX_TEMPFAIL) и строка для SSH-пути
+THROTTLED_EXIT = 75
+THROTTLED_RE = re.compile(r"Throttled: (\d{3}) Retry-After: (\d+(?:\.\d+)?|-)")
+
+# Границы Retry-After, которые сообщает сервис (секунды)
+MIN_RETRY_AFTER_SEC = 1
+MAX_RETRY_AFTER_SEC = 120
+
+# Задержка клиента: экспонента от BACKOFF_BASE_SEC, не больше BACKOFF_MAX_SEC, плюс Retry-After
+BACKOFF_BASE_SEC = 1
+BACKOFF_MAX_SEC = 60
+
+# Сколько ведер клиентов держать, прежде чем выбросить заполненные (неактивные)
+MAX_CLIENT_BUCKETS = 10000
+
+# Вес нового замера в скользящем среднем времени обслуживания
+SERVICE_TIME_ALPHA = 0.2
+
+
+class Throttled(Exception):
+    """
+    The service is saturated: retry after `retry_after` seconds (None if unknown).
+
+    Сервис перегружен: повторить через `retry_after` секунд (None, если неизвестно).
+    """
+
+    def __init__(self, status: int, retry_after: float | None, reason: str = ""):
+        super().__init__(f"{status} {reason}".strip())
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def clamp_retry_after(seconds: float) -> int:
+    return int(min(MAX_RETRY_AFTER_SEC, max(MIN_RETRY_AFTER_SEC, math.ceil(seconds))))
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, up to `burst` stored. `backlog` counts requests sent away
+    and drains at `rate`, so the next rejected one is told to come back later.
+
+    `rate` токенов в секунду, не больше `burst` в запасе. `backlog` — отказанные запросы,
+    убывает со скоростью `rate`, поэтому следующему отказанному называют более позднее время.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.backlog = 0.0
+        self.updated = time.monotonic()
+
+    def _fill(self, now: float) -> None:
+        if now <= self.updated:
+            # `now` взят до создания ведра
+            return
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.backlog = max(0.0, self.backlog - elapsed * self.rate)
+
+    def take(self, now: float) -> float:
+        """
+        Take a token: 0 on success, otherwise seconds until the caller should retry.
+
+        Взять токен: 0 при успехе, иначе через сколько секунд повторить.
+        """
+        self._fill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        self.backlog += 1
+        return (self.backlog - self.tokens) / self.rate
+
+    def give_back(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def idle(self, now: float) -> bool:
+        self._fill(now)
+        return self.tokens >= self.burst and not self.backlog
+
+
+class AdmissionControl:
+    """
+    Per-client and global rate limits plus a bounded FIFO queue in front of
+    `max_active` concurrent requests. A rate of 0 disables that limit.
+
+    Лимиты частоты на клиента и общий плюс ограниченная очередь FIFO перед
+    `max_active` одновременными запросами. Частота 0 выключает лимит.
+    """
+
+    def __init__(self, max_active: int, max_queue: int, queue_timeout: float,
+                 rate: float = 0, burst: float = 0, client_rate: float = 0, client_burst: float = 0):
+        self.max_active = max(max_active, 1)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.clients = {}
+        self.active = 0
+        self.waiting = 0
+        self.service_time = 1.0
+        self._slots = None
+
+    def _client_bucket(self, client: str, now: float) -> TokenBucket:
+        bucket = self.clients.get(client)
+        if bucket is None:
+            if len(self.clients) >= MAX_CLIENT_BUCKETS:
+                self.clients = {c: b for c, b in self.clients.items() if not b.idle(now)}
+            bucket = self.clients[client] = TokenBucket(self.client_rate, self.client_burst)
+        return bucket
+
+    def check_rate(self, client: str) -> None:
+        """
+        Take a token from the client's and the global bucket; raises Throttled (429).
+
+        Взять токен из ведра клиента и общего ведра; иначе Throttled (429).
+        """
+        now = time.monotonic()
+        client_bucket = self._client_bucket(client, now) if self.client_rate > 0 else None
+        if client_bucket is not None:
+            wait = client_bucket.take(now)
+            if wait:
+                raise Throttled(429, clamp_retry_after(wait), "rate_client")
+        if self.bucket is not None:
+            wait = self.bucket.take(now)
+            if wait:
+                if client_bucket is not None:
+                    client_bucket.give_back()
+                raise Throttled(429, clamp_retry_after(wait), "rate_global")
+
+    def queue_retry_after(self) -> int:
+        # очередь и выполняемые разойдутся примерно за (очередь / параллельность) времён обслуживания
+        return clamp_retry_after(self.service_time * (self.waiting + self.active) / self.max_active)
+
+    async def acquire(self, client: str) -> None:
+        """
+        Admit one request: rate limits, then a free slot within queue_timeout; raises Throttled.
+
+        Допустить запрос: лимиты частоты, затем свободный слот за queue_timeout; иначе Throttled.
+        """
+        self.check_rate(client)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_active)
+        if not self._slots.locked():
+            # свободный слот и никто не ждёт — занимаем сразу, без задачи wait_for
+            await self._slots.acquire()
+        elif self.waiting >= self.max_queue:
+            raise Throttled(503, self.queue_retry_after(), "queue_full")
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise Throttled(503, self.queue_retry_after(), "queue_timeout")
+            finally:
+                self.waiting -= 1
+        self.active += 1
+
+    def release(self, seconds: float) -> None:
+        """
+        Free the slot of a request that ran for `seconds`.
+
+        Освободить слот запроса, выполнявшегося `seconds` секунд.
+        """
+        self.active -= 1
+        self.service_time += SERVICE_TIME_ALPHA * (seconds - self.service_time)
+        self._slots.release()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Retry-After header value in seconds; None if absent or an HTTP date.
+
+    Значение заголовка Retry-After в секундах; None, если его нет или это HTTP-дата.
+    """
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def throttled_line(status: int, retry_after: float | None) -> str:
+    """
+    Line node_intake_client.py prints for a retry-later answer (read back by parse_throttled).
+
+    Строка, которую node_intake_client.py печатает на ответ «повторите позже» (читает parse_throttled).
+    """
+    return f"Throttled: {status} Retry-After: {'-' if retry_after is None else f'{retry_after:g}'}"
+
+
+def parse_throttled(text: str | None) -> Throttled | None:
+    """
+    Throttled from a throttled_line() in `text` (SSH output); None if there is none.
+
+    Throttled из строки throttled_line() в `text` (вывод SSH); None, если её нет.
+    """
+    match = THROTTLED_RE.search(text or "")
+    if match is None:
+        return None
+    status, retry_after = match.groups()
+    return Throttled(int(status), None if retry_after == "-" else float(retry_after))
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """
+    Delay before retry number `attempt` (from 0): full-jitter exponential backoff,
+    never earlier than Retry-After.
+
+    Задержка перед повтором номер `attempt` (с 0): экспоненциальная с полным
+    джиттером, не раньше Retry-After.
+    """
+    jitter = random.uniform(0, min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** attempt))
+    return (retry_after or 0) + jitter
+
+
+def retry_throttled(call, deadline_sec: float, log, what: str):
+    """
+    Run `call()` again while it raises Throttled, sleeping backoff_delay(); after
+    `deadline_sec` the last Throttled is re-raised.
+
+    Повторять `call()`, пока он бросает Throttled, выжидая backoff_delay(); после
+    `deadline_sec` последний Throttled пробрасывается дальше.
+    """
+    deadline = time.monotonic() + deadline_sec
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Throttled as e:
+            delay = backoff_delay(attempt, e.retry_after)
+            if time.monotonic() + delay > deadline:
+                raise
+            log(f"{what}: сервис перегружен ({e}), повтор через {delay:.1f} с", "warn")
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Offline load test of the intake service: concurrent joins and churn.
+
+Офлайн-нагрузочный тест intake-сервиса: параллельные join и churn.
+
+The real cps_service app runs in a child process with every path redirected
+into a temporary directory: a fresh IPAM store, idempotency and token
+databases, a generated collected_info.py (pod CIDR, join token) and a
+stand-in kubectl (shell script: every call succeeds after --kubectl-ms). The
+controller, bootstrap-token Secrets and background loops are off, so neither
+a cluster nor real maps, certificates or network are touched.
+
+Traffic, --concurrency client threads with keep-alive connections:
+  - join  — --nodes registrations at once (an autoscaler join storm);
+    --replay of them are sent again with the same idempotency key and must
+    get the same CIDR;
+  - churn — --churn × --nodes pairs: delete of a joined node + register of a
+    new one, shuffled, so released CIDRs are reused while others register.
+
+Admission control (admission.py) is off by default, so the run measures
+raw capacity; with --admit the service keeps its INTAKE_ADMIT_* limits and
+the clients wait Retry-After with jitter like worker_bootstrap.py, every
+429/503 is counted in the error rate. Each simulated node is its own client
+(X-Intake-Client).
+
+Reported per phase and endpoint: requests, throughput, latency
+(p50/p99/max), error rate by response code. Allocation correctness is
+checked twice: online — a register must never return a CIDR still held by a
+live node that is not being deleted; offline — the final store must hold
+exactly the live nodes, without overlapping CIDRs. Any violation gives exit
+code 1.
+
+Реальное приложение cps_service запускается в дочернем процессе, все пути
+которого перенаправлены во временный каталог: новое хранилище IPAM, базы
+идемпотентности и токенов, сгенерированный collected_info.py (pod CIDR,
+join-токен) и заглушка kubectl (shell-скрипт: любой вызов успешен через
+--kubectl-ms). Контроллер, Secret с bootstrap-токенами и фоновые циклы
+выключены — ни кластер, ни реальные карты, сертификаты и сеть не нужны.
+
+Нагрузка, --concurrency потоков-клиентов с keep-alive соединениями:
+  - join  — --nodes регистраций разом (шторм join от автоскейлера); доля
+    --replay из них повторяется с тем же ключом идемпотентности и должна
+    получить тот же CIDR;
+  - churn — --churn × --nodes пар: удаление вошедшей ноды + регистрация
+    новой вперемешку, освобождённые CIDR переиспользуются под нагрузкой.
+
+Контроль допуска (admission.py) по умолчанию выключен — прогон измеряет
+предельную производительность; с --admit сервис сохраняет лимиты
+INTAKE_ADMIT_*, а клиенты, как worker_bootstrap.py, ждут Retry-After с
+джиттером, каждый 429/503 учитывается в доле ошибок. Каждая имитируемая
+нода — отдельный клиент (X-Intake-Client).
+
+В отчёте по фазе и эндпоинту: число запросов, пропускная способность,
+задержка (p50/p99/max), доля ошибок по кодам ответа. Корректность выдачи
+проверяется дважды: на лету — register не должен вернуть CIDR, который
+держит живая нода, не находящаяся в процессе удаления; в конце — в
+хранилище ровно живые ноды и нет пересекающихся CIDR. Любое нарушение —
+код выхода 1.
+
+Usage / Использование:
+    python3 cluster/intake_services/bench_intake.py --nodes 1000 --concurrency 64 --kubectl-ms 50
+"""
+
+import argparse
+import http.client
+import ipaddress
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+from cluster.ipam_cilium.bench_ipam import print_table
+from cluster.ipam_cilium.store import IpamStore
+from cluster.intake_services.admission import RETRY_LATER_CODES, Throttled, parse_retry_after, retry_throttled
+
+BENCH_TOKEN = "bench0.0123456789abcdef"
+READY_TIMEOUT_SEC = 30
+REQUEST_TIMEOUT_SEC = 120
+# без --admit: столько одновременных запросов сервис не ограничивает
+UNLIMITED_ACTIVE = 1_000_000
+# с --admit: сколько клиент ждёт перегруженный сервис, как worker_bootstrap.py
+THROTTLE_DEADLINE_SEC = 900
+# Столбцы таблицы результатов
+TABLE_COLUMNS = ("phase", "endpoint", "requests", "req_per_s", "mean_ms", "p50_ms", "p99_ms", "max_ms",
+                 "error_rate", "codes")
+
+FAKE_KUBECTL = """#!/bin/sh
+# заглушка kubectl нагрузочного теста: любой вызов успешен через BENCH_KUBECTL_SLEEP секунд
+[ "${BENCH_KUBECTL_SLEEP:-0}" = "0" ] || sleep "$BENCH_KUBECTL_SLEEP"
+exit 0
+"""
+
+
+def prepare_workdir(workdir: Path, pod_cidr: str) -> None:
+    """
+    collected_info.py and the kubectl stand-in for the service under test.
+
+    collected_info.py и заглушка kubectl для тестируемого сервиса.
+    """
+    (workdir / "collected_info.py").write_text(
+        f'HOSTNAME = "bench-cp"\nIP = "127.0.0.1"\nROLE = "control-plane"\n'
+        f'CLUSTER_POD_CIDR = "{pod_cidr}"\nJOIN_TOKEN = "{BENCH_TOKEN}"\n')
+    kubectl = workdir / "bin" / "kubectl"
+    kubectl.parent.mkdir()
+    kubectl.write_text(FAKE_KUBECTL)
+    kubectl.chmod(0o755)
+
+
+def serve(workdir: str, port: int, kubectl_ms: float, lease_ttl: int, admit: bool) -> None:
+    """
+    Child process: the cps_service app with the store, maps and databases in `workdir`.
+
+    Дочерний процесс: приложение cps_service с хранилищем, картами и базами в `workdir`.
+    """
+    workdir = Path(workdir)
+    # настройки читаются при импорте cps_service — задаём до него
+    os.environ.update({
+        "PATH": f"{workdir / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+        "BENCH_KUBECTL_SLEEP": str(kubectl_ms / 1000),
+        "IPAM_CONTROLLER": "0", "INTAKE_TOKEN_SECRETS": "0", "INTAKE_WORKERS": "1",
+        "IPAM_LEASE_TTL": str(lease_ttl),
+    })
+    if not admit:
+        os.environ.update({"INTAKE_ADMIT_RATE": "0", "INTAKE_ADMIT_CLIENT_RATE": "0",
+                           "INTAKE_ADMIT_ACTIVE": str(UNLIMITED_ACTIVE)})
+    # журнал сервиса — в файл, чтобы не смешивать с отчётом
+    sys.stdout = open(workdir / "service.log", "w", buffering=1)
+
+    import uvicorn
+    from cluster.ipam_cilium import mapper
+    mapper.COLLECTED_INFO = workdir / "collected_info.py"
+    mapper.CONTROL_MAP = workdir / "control_plane_map.json"
+    mapper.WORKER_MAP = workdir / "worker_map.json"
+    mapper.MAP_FILES = {"control-plane": mapper.CONTROL_MAP, "worker": mapper.WORKER_MAP}
+    mapper._STORE = IpamStore(workdir / "ipam.db")
+
+    from cluster.intake_services import cps_service
+    cps_service.COLLECTED_INFO_PATH = workdir / "collected_info.py"
+    cps_service.IDEMPOTENCY_DB = workdir / "intake_requests.db"
+    cps_service.TOKENS_DB = workdir / "intake_tokens.db"
+    cps_service.get_ipam()
+    uvicorn.run(cps_service.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port: int, proc: multiprocessing.Process) -> None:
+    deadline = time.monotonic() + READY_TIMEOUT_SEC
+    while time.monotonic() < deadline and proc.is_alive():
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/metrics")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("intake service did not start")
+
+
+class Recorder:
+    """
+    Latencies and codes per (phase, endpoint), live allocations and correctness violations.
+
+    Задержки и коды по (фаза, эндпоинт), живые выдачи и нарушения корректности.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.codes = {}
+        self.live = {}          # имя → CIDR
+        self.owners = {}        # CIDR → имя
+        self.deleting = set()
+        self.violations = []
+
+    def record(self, phase: str, endpoint: str, code: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault((phase, endpoint), []).append(seconds)
+            self.codes.setdefault((phase, endpoint), Counter())[code] += 1
+
+    def allocated(self, name: str, cidr: str) -> None:
+        with self.lock:
+            holder = self.owners.get(cidr)
+            # CIDR удаляемой ноды может уйти другой ещё до того, как ответ /delete дошёл до клиента
+            if holder is not None and holder != name and holder not in self.deleting:
+                self.violations.append(f"{cidr} issued to {name} while held by {holder}")
+            previous = self.live.get(name)
+            if previous is not None and previous != cidr:
+                self.violations.append(f"{name} moved from {previous} to {cidr}")
+            self.live[name] = cidr
+            self.owners[cidr] = name
+
+    def releasing(self, name: str) -> None:
+        with self.lock:
+            self.deleting.add(name)
+
+    def released(self, name: str, ok: bool) -> None:
+        with self.lock:
+            self.deleting.discard(name)
+            if ok:
+                cidr = self.live.pop(name, None)
+                if cidr is not None and self.owners.get(cidr) == name:
+                    del self.owners[cidr]
+
+
+class Client:
+    """
+    One keep-alive connection per client thread.
+
+    Одно keep-alive соединение на поток клиента.
+    """
+
+    def __init__(self, port: int, recorder: Recorder, retry: bool = False):
+        self.port = port
+        self.recorder = recorder
+        self.retry = retry
+        self._local = threading.local()
+
+    def post(self, phase: str, path: str, body: dict, key: str | None = None) -> tuple[int, dict | None]:
+        if not self.retry:
+            return self.send(phase, path, body, key)
+
+        def attempt():
+            status, data = self.send(phase, path, body, key)
+            if status in RETRY_LATER_CODES:
+                raise Throttled(status, self._local.retry_after)
+            return status, data
+
+        try:
+            return retry_throttled(attempt, THROTTLE_DEADLINE_SEC, lambda *_: None, path)
+        except Throttled as e:
+            return e.status, None
+
+    def send(self, phase: str, path: str, body: dict, key: str | None = None) -> tuple[int, dict | None]:
+        headers = {"Content-Type": "application/json", "X-Intake-Client": body["node"]["hostname"]}
+        if key:
+            headers["Idempotency-Key"] = key
+        started = time.perf_counter()
+        while True:
+            conn = getattr(self._local, "conn", None)
+            reused = conn is not None
+            try:
+                if conn is None:
+                    conn = self._local.conn = http.client.HTTPConnection("127.0.0.1", self.port,
+                                                                         timeout=REQUEST_TIMEOUT_SEC)
+                conn.request("POST", path, json.dumps(body), headers)
+                response = conn.getresponse()
+                status, payload = response.status, response.read()
+                self._local.retry_after = parse_retry_after(response.getheader("Retry-After"))
+                break
+            except (OSError, http.client.HTTPException):
+                self._local.conn = None
+                if reused:
+                    # сервер закрыл keep-alive, пока поток ждал Retry-After, — новое соединение
+                    continue
+                self.recorder.record(phase, path, "conn", time.perf_counter() - started)
+                return 0, None
+        self.recorder.record(phase, path, str(status), time.perf_counter() - started)
+        return status, json.loads(payload) if status == 200 else None
+
+    def register(self, phase: str, name: str, replay: bool = False) -> None:
+        body = {"node": {"hostname": name, "ip": "192.0.2.1", "role": "worker"}, "token": BENCH_TOKEN}
+        status, data = self.post(phase, "/register", body, key=name)
+        if status != 200:
+            return
+        self.recorder.allocated(name, data["cidr"])
+        if replay:
+            status, again = self.post(phase, "/register", body, key=name)
+            if status == 200 and again["cidr"] != data["cidr"]:
+                with self.recorder.lock:
+                    self.recorder.violations.append(f"replay of {name}: {data['cidr']} != {again['cidr']}")
+
+    def delete(self, phase: str, name: str) -> None:
+        self.recorder.releasing(name)
+        status, _ = self.post(phase, "/delete", {"node": {"hostname": name, "role": "worker"},
+                                                 "token": BENCH_TOKEN}, key=f"{name}-delete")
+        self.recorder.released(name, status == 200)
+
+
+def run_phase(client: Client, phase: str, ops: list, concurrency: int) -> float:
+    """
+    Run `ops` ((method, name, replay) tuples) on `concurrency` threads; returns the wall time.
+
+    Выполнить `ops` (кортежи (метод, имя, replay)) в `concurrency` потоков; возвращает время фазы.
+    """
+    def one(op):
+        method, name, replay = op
+        if method == "register":
+            client.register(phase, name, replay)
+        else:
+            client.delete(phase, name)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, ops))
+    return time.perf_counter() - started
+
+
+def check_store(db_path: Path, live: dict) -> list:
+    """
+    Final store holds exactly the live nodes with their CIDRs and no overlapping subnets.
+
+    В итоговом хранилище ровно живые ноды со своими CIDR и нет пересекающихся подсетей.
+    """
+    entries = IpamStore(db_path).entries("worker")
+    problems = []
+    stored = {name: entry["cidr"] for name, entry in entries.items()}
+    for name in sorted(set(stored) ^ set(live)):
+        problems.append(f"{name}: store {stored.get(name)}, client {live.get(name)}")
+    for name in sorted(set(stored) & set(live)):
+        if stored[name] != live[name]:
+            problems.append(f"{name}: store {stored[name]} != client {live[name]}")
+    networks = sorted((ipaddress.ip_network(cidr), name) for name, cidr in stored.items())
+    for (a, name_a), (b, name_b) in zip(networks, networks[1:]):
+        if a.overlaps(b):
+            problems.append(f"{a} ({name_a}) overlaps {b} ({name_b})")
+    return problems
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(recorder: Recorder, walls: dict) -> list:
+    rows = []
+    for (phase, endpoint), latencies in recorder.latencies.items():
+        latencies = sorted(latencies)
+        codes = recorder.codes[(phase, endpoint)]
+        errors = sum(n for code, n in codes.items() if code != "200")
+        rows.append({
+            "phase": phase,
+            "endpoint": endpoint,
+            "requests": len(latencies),
+            "req_per_s": round(len(latencies) / walls[phase], 1) if walls[phase] else 0,
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "max_ms": round(latencies[-1] * 1000, 1),
+            "error_rate": round(errors / len(latencies), 4),
+            "codes": ",".join(f"{code}:{n}" for code, n in sorted(codes.items())),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the intake service")
+    parser.add_argument("--nodes", type=int, default=500, help="Nodes registered in the join storm")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client requests")
+    parser.add_argument("--churn", type=float, default=0.5, help="Delete+register pairs per node after the join")
+    parser.add_argument("--replay", type=float, default=0.1,
+                        help="Share of joins repeated with the same idempotency key")
+    parser.add_argument("--kubectl-ms", type=float, default=20, help="Latency of every kubectl call, ms")
+    parser.add_argument("--lease-ttl", type=int, default=900, help="IPAM_LEASE_TTL of the service")
+    parser.add_argument("--pod-cidr", default="10.0.0.0/8", help="CLUSTER_POD_CIDR of the test pool")
+    parser.add_argument("--admit", action="store_true",
+                        help="Keep the INTAKE_ADMIT_* limits; clients wait Retry-After with jitter")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    joined = [f"bench-{i:06d}" for i in range(args.nodes)]
+    join_ops = [("register", name, rng.random() < args.replay) for name in joined]
+    pairs = min(int(args.nodes * args.churn), args.nodes)
+    churn_ops = [("delete", name, False) for name in rng.sample(joined, pairs)]
+    churn_ops += [("register", f"bench-{args.nodes + i:06d}", False) for i in range(pairs)]
+    rng.shuffle(churn_ops)
+
+    with tempfile.TemporaryDirectory(prefix="bench-intake-") as tmp:
+        workdir = Path(tmp)
+        prepare_workdir(workdir, args.pod_cidr)
+        port = free_port()
+        ctx = multiprocessing.get_context("spawn")
+        proc = ctx.Process(target=serve, args=(tmp, port, args.kubectl_ms, args.lease_ttl, args.admit),
+                           daemon=True)
+        proc.start()
+        try:
+            wait_ready(port, proc)
+            recorder = Recorder()
+            client = Client(port, recorder, retry=args.admit)
+            walls = {}
+            log(f"join: {len(join_ops)} регистраций, параллельно {args.concurrency}...", "info")
+            walls["join"] = run_phase(client, "join", join_ops, args.concurrency)
+            if churn_ops:
+                log(f"churn: {pairs} удалений + {pairs} регистраций вперемешку...", "info")
+                walls["churn"] = run_phase(client, "churn", churn_ops, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.join()
+        violations = recorder.violations + check_store(workdir / "ipam.db", recorder.live)
+
+    results = summarize(recorder, walls)
+    print_table(results, TABLE_COLUMNS)
+    print(f"live nodes: {len(recorder.live)}, unique CIDRs: {len(set(recorder.live.values()))}")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"results": results, "violations": violations}, indent=2))
+        log(f"Результаты сохранены в {args.json}", "ok")
+    if violations:
+        for violation in violations[:20]:
+            log(violation, "error")
+        log(f"Нарушений корректности выдачи: {len(violations)}", "error")
+        sys.exit(1)
+    log("Корректность выдачи: дубликатов и пересечений CIDR нет", "ok")
+
+
+if __name__ == "__main__":
+    main()
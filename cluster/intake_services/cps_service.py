@@ -4,52 +4,416 @@ Control-plane Intake + IPAM Service
 Интеграционный сервис Intake + IPAM на control-plane
 
 Этот сервис запускается на control-plane узле Kubernetes и предоставляет HTTP API для:
- - регистрации новых worker/control-plane нод,
- - вызова mapper.py для выдачи или очистки CIDR,
+ - регистрации новых worker/control-plane нод (по одной и пакетом через /register-batch),
+ - выдачи или очистки CIDR через встроенный IPAM (Mapper из mapper.py, в памяти процесса),
  - назначения ролей нодам через kubectl label,
- - удаления нод из кластера и IPAM карт.
+ - удаления нод из кластера и IPAM карт (по одной и пакетом через /decommission:
+   cordon, drain не больше INTAKE_DRAIN_CONCURRENCY одновременно, удаление
+   Node/CiliumNode и освобождение CIDR одной транзакцией).
+
+Опционально сервис периодически сверяет IPAM с Node/CiliumNode кластера
+(reconcile.py): IPAM_RECONCILE_INTERVAL — период в секундах (0 — выключено),
+IPAM_RECONCILE_REPAIR=1 — исправлять расхождения, а не только сообщать о них.
+
+CIDR, выданный через API, сначала только арендуется на IPAM_LEASE_TTL секунд
+(0 — аренда выключена). Аренда подтверждается, как только нода промаркирована
+или её Node найдена сборщиком аренд; неподтверждённые аренды сборщик
+освобождает по истечении — CIDR нод, так и не вошедших в кластер, не теряются.
+
+Контроллер IPAM (controller.py, IPAM_CONTROLLER=1 по умолчанию) следит за Node
+и CiliumNode и сразу проставляет им podCIDRs из хранилища — воркерам не нужно
+опрашивать API и иметь права на патч.
+
+Обработчики не блокируют event loop: kubectl и SQLite выполняются в
+ограниченном пуле потоков (INTAKE_BLOCKING_WORKERS), поэтому параллельные
+регистрации не ждут самую медленную.
+
+Join-токены проверяет join_tokens.TokenVerifier: кэш в памяти, перечитывание
+collected_info.py по mtime, bootstrap-токены kubeadm из Secret
+(INTAKE_TOKEN_SECRETS=1), несколько действующих токенов с истечением.
+
+/register и /delete принимают ключ идемпотентности (заголовок Idempotency-Key
+или поле "idempotency_key"): повтор с тем же ключом получает сохранённый ответ
+без обращения к IPAM и API-серверу (idempotency.py, INTAKE_IDEMPOTENCY_TTL).
+
+GET /metrics отдаёт метрики Prometheus: задержки и коды ответов по эндпоинтам,
+выдачи/освобождения CIDR, заполненность пулов IPAM, задержки вызовов kubectl.
+
+Адрес и порт задают INTAKE_HOST / INTAKE_PORT. С INTAKE_WORKERS > 1 (0 — по
+числу ядер) запросы обслуживает пул процессов uvicorn; всё общее состояние
+лежит в SQLite (хранилище IPAM с поколением для сверки кэша Mapper, ответы
+идемпотентности, заменённые join-токены), метрики процессы сбрасывают в
+MAPS_DIR/metrics и /metrics их суммирует. Контроллер, сборщик аренд и сверка
+работают в одном экземпляре — в главном процессе.
+
+С INTAKE_TLS_PORT сервис дополнительно слушает IP ноды (INTAKE_TLS_HOST) по
+взаимному TLS: серверный сертификат intake.crt и проверка клиента по CA
+кластера (сертификат kubelet воркера). worker_bootstrap.py и worker_delete.py
+ходят туда напрямую одним HTTPS-запросом, SSH-путь (ssh_wrapper.sh →
+node_intake_client.py → 127.0.0.1:5050) остаётся запасным. Join-токен
+проверяется на обоих слушателях одинаково.
+
+/register, /register-batch и /delete проходят допуск (admission.py): лимиты
+частоты на клиента и общий (INTAKE_ADMIT_*_RATE/BURST) и ограниченная
+очередь перед INTAKE_ADMIT_ACTIVE одновременными запросами. При перегрузке
+сервис отвечает 429/503 с Retry-After, а не пропускает шторм регистраций к
+API-серверу и etcd; worker_bootstrap.py и worker_delete.py повторяют с
+джиттером. Все лимиты (и общие, и на клиента) делятся между процессами
+INTAKE_WORKERS.
 """
 
 import os
 import sys
-import subprocess
-import json
+import re
+import ssl
+import time
+import asyncio
+import math
+import functools
+import shutil
+import threading
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Request
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 import uvicorn
+from uvicorn.supervisors import Multiprocess
 
 # === Добавляем корень проекта для логгера ===
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 sys.path.insert(0, str(PROJECT_ROOT))
 
 from utils.logger import log  # централизованный логгер
+from utils import metrics
+from cluster.ipam_cilium.mapper import MAPS_DIR, Mapper
+from cluster.ipam_cilium.reconcile import Reconciler, kubectl
+from cluster.ipam_cilium.controller import NodeController
+from cluster.intake_services.join_tokens import TokenVerifier
+from cluster.intake_services.idempotency import ResponseCache, fingerprint
+from cluster.intake_services.admission import AdmissionControl, Throttled
 
 # === Константы ===
-API_HOST = "127.0.0.1"
-API_PORT = 5050
+API_HOST = os.environ.get("INTAKE_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("INTAKE_PORT", "5050"))
+
+# Процессов uvicorn (0 — по числу ядер, но не больше MAX_AUTO_WORKERS)
+MAX_AUTO_WORKERS = 8
+WORKERS = int(os.environ.get("INTAKE_WORKERS", "1")) or min(os.cpu_count() or 1, MAX_AUTO_WORKERS)
+
+# Прямой mTLS-слушатель для воркеров (0 — выключен, только SSH-путь);
+# адрес по умолчанию — IP ноды из collected_info.py
+TLS_PORT = int(os.environ.get("INTAKE_TLS_PORT", "0"))
+TLS_HOST = os.environ.get("INTAKE_TLS_HOST", "")
+PKI_DIR = Path("/etc/kubernetes/pki")
+TLS_CERT = Path(os.environ.get("INTAKE_TLS_CERT", str(PKI_DIR / "intake.crt")))
+TLS_KEY = Path(os.environ.get("INTAKE_TLS_KEY", str(PKI_DIR / "intake.key")))
+TLS_CA = Path(os.environ.get("INTAKE_TLS_CA", str(PKI_DIR / "ca.crt")))
 COLLECTED_INFO_PATH = PROJECT_ROOT / "data" / "collected_info.py"
-MAPPER_PATH = PROJECT_ROOT / "cluster" / "ipam_cilium" / "mapper.py"
 
 # Явно указываем kubeconfig для всех kubectl-команд
 KUBECONFIG_PATH = "/etc/kubernetes/admin.conf"
 
-app = FastAPI(title="Kubernetes Intake + IPAM Service", version="0.2.1")
+# Периодическая сверка IPAM с кластером
+RECONCILE_INTERVAL = int(os.environ.get("IPAM_RECONCILE_INTERVAL", "0"))
+RECONCILE_REPAIR = os.environ.get("IPAM_RECONCILE_REPAIR", "0") == "1"
 
+# Аренда CIDR до появления Node и период сборщика истёкших аренд
+LEASE_TTL = int(os.environ.get("IPAM_LEASE_TTL", "900"))
+LEASE_CHECK_INTERVAL = 30
 
-def load_join_token() -> str:
+# Патч podCIDRs у Node/CiliumNode прямо из сервиса
+CONTROLLER_ENABLED = os.environ.get("IPAM_CONTROLLER", "1") == "1"
+
+# Принимать также bootstrap-токены kubeadm из Secret kube-system
+TOKEN_SECRETS = os.environ.get("INTAKE_TOKEN_SECRETS", "1") == "1"
+
+# Сколько хранить ответы по ключам идемпотентности (секунды)
+IDEMPOTENCY_TTL = int(os.environ.get("INTAKE_IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_DB = MAPS_DIR / "intake_requests.db"
+
+# Заменённые join-токены в льготном периоде (общие для всех процессов)
+TOKENS_DB = MAPS_DIR / "intake_tokens.db"
+
+# Снимки метрик процессов при INTAKE_WORKERS > 1 и период их записи
+METRICS_DIR = MAPS_DIR / "metrics"
+METRICS_FLUSH_SEC = 5
+
+# Потоков для блокирующих вызовов (kubectl, SQLite) из обработчиков
+BLOCKING_WORKERS = int(os.environ.get("INTAKE_BLOCKING_WORKERS", "16"))
+
+# Максимум нод в одном запросе /register-batch и /decommission
+MAX_BATCH = 500
+
+# Одновременных kubectl drain в процессе (на все запросы /decommission) и таймаут одного drain
+DRAIN_CONCURRENCY = int(os.environ.get("INTAKE_DRAIN_CONCURRENCY", "4"))
+DRAIN_TIMEOUT = int(os.environ.get("INTAKE_DRAIN_TIMEOUT", "300"))
+
+# Допуск /register, /register-batch и /delete (admission.py), на весь сервис: одновременных
+# запросов, мест в очереди, ожидание в очереди (с), запросов в секунду и запас (0 — без лимита)
+ADMIT_ACTIVE = int(os.environ.get("INTAKE_ADMIT_ACTIVE", "16"))
+ADMIT_QUEUE = int(os.environ.get("INTAKE_ADMIT_QUEUE", "256"))
+ADMIT_QUEUE_TIMEOUT = float(os.environ.get("INTAKE_ADMIT_QUEUE_TIMEOUT", "5"))
+ADMIT_RATE = float(os.environ.get("INTAKE_ADMIT_RATE", "20"))
+ADMIT_BURST = float(os.environ.get("INTAKE_ADMIT_BURST", "40"))
+# То же на одного клиента (IP воркера или SSH-клиент из заголовка X-Intake-Client от 127.0.0.1)
+ADMIT_CLIENT_RATE = float(os.environ.get("INTAKE_ADMIT_CLIENT_RATE", "1"))
+ADMIT_CLIENT_BURST = float(os.environ.get("INTAKE_ADMIT_CLIENT_BURST", "3"))
+# Клиенты, которым сервис верит в заголовке X-Intake-Client (node_intake_client.py за ssh_wrapper.sh)
+LOCAL_CLIENTS = ("127.0.0.1", "::1")
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Worker process start/stop: flush metrics for the other processes in multi-worker mode
+    Старт/остановка процесса: в многопроцессном режиме сбрасывать метрики для остальных
+    """
+    if WORKERS > 1:
+        threading.Thread(target=metrics_flush_loop, daemon=True, name="metrics-flush").start()
+    yield
+    if WORKERS > 1:
+        metrics.write_snapshot(METRICS_DIR)
+
+
+app = FastAPI(title="Kubernetes Intake + IPAM Service", version="0.3.0", lifespan=lifespan)
+
+# === Метрики ===
+REQUEST_SECONDS = metrics.histogram("intake_request_duration_seconds", "HTTP request latency",
+                                    ("endpoint", "method"))
+REQUESTS = metrics.counter("intake_requests_total", "HTTP requests by response code",
+                           ("endpoint", "method", "code"))
+IN_FLIGHT = metrics.gauge("intake_requests_in_flight", "HTTP requests being served")
+# состояние IPAM одинаково для всех процессов — берём значения отдающего метрики
+POOL_FREE = metrics.gauge("ipam_pool_free_units", "Free allocator units in the IPAM pool", ("pool",),
+                          merge="local")
+POOL_TOTAL = metrics.gauge("ipam_pool_capacity_units", "Allocator units in the IPAM pool", ("pool",),
+                           merge="local")
+POOL_USED = metrics.gauge("ipam_pool_utilization_ratio", "Used share of the IPAM pool", ("pool",),
+                          merge="local")
+NODES = metrics.gauge("ipam_nodes", "Nodes with an allocated CIDR", ("role",), merge="local")
+LEASES = metrics.gauge("ipam_pending_leases", "CIDR leases waiting for their Node", merge="local")
+ADMIT_REJECTED = metrics.counter("intake_admission_rejected_total", "Requests refused by admission control",
+                                 ("endpoint", "reason"))
+ADMIT_WAITING = metrics.gauge("intake_admission_queue_depth", "Requests waiting for admission")
+ADMIT_ACTIVE_GAUGE = metrics.gauge("intake_admission_active", "Admitted requests being served")
+_in_flight = 0
+
+# IPAM загружается один раз при старте и живёт в памяти сервиса
+_IPAM = None
+
+# Контроллер Node/CiliumNode: watch запускает run_server, воркеры используют только sync
+_CONTROLLER = None
+
+# Кэш действующих join-токенов
+_VERIFIER = None
+
+# Ответы по ключам идемпотентности
+_RESPONSES = None
+
+# Допуск изменяющих запросов: у каждого процесса пула свои ведра, а ядро раздаёт соединения
+# по процессам — все лимиты, включая лимиты клиента, делятся между процессами
+_ADMISSION = AdmissionControl(max_active=math.ceil(ADMIT_ACTIVE / WORKERS),
+                              max_queue=math.ceil(ADMIT_QUEUE / WORKERS),
+                              queue_timeout=ADMIT_QUEUE_TIMEOUT,
+                              rate=ADMIT_RATE / WORKERS, burst=ADMIT_BURST / WORKERS,
+                              client_rate=ADMIT_CLIENT_RATE / WORKERS, client_burst=ADMIT_CLIENT_BURST / WORKERS)
+
+# Не больше DRAIN_CONCURRENCY drain одновременно — остальные потоки пула свободны для /register
+_DRAINS = asyncio.Semaphore(max(DRAIN_CONCURRENCY, 1))
+
+# Ограниченный пул: не больше BLOCKING_WORKERS одновременных kubectl/транзакций
+_EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="intake-io")
+
+
+def get_ipam() -> Mapper:
+    """
+    Return the process-wide IPAM allocator, loading it on first use
+    Возвращает IPAM-аллокатор процесса, загружая его при первом обращении
+    """
+    global _IPAM
+    if _IPAM is None:
+        _IPAM = Mapper(lease_ttl=LEASE_TTL)
+    return _IPAM
+
+
+async def offload(func, *args):
+    """
+    Run a blocking call on the bounded executor without blocking the event loop
+    Выполняет блокирующий вызов в ограниченном пуле, не блокируя event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, functools.partial(func, *args))
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """
+    Record latency and response code per endpoint (route template, not raw path)
+    Учитывает задержку и код ответа по эндпоинту (шаблон маршрута, а не сырой путь)
+    """
+    global _in_flight
+    _in_flight += 1
+    IN_FLIGHT.set(_in_flight)
+    started = time.perf_counter()
+    code = 500
+    try:
+        response = await call_next(request)
+        code = response.status_code
+        return response
+    finally:
+        _in_flight -= 1
+        IN_FLIGHT.set(_in_flight)
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "other")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, code=str(code))
+
+
+def client_id(request: Request) -> str:
+    """
+    Rate-limit key of the caller: its IP, or the SSH client forwarded by node_intake_client.py
+    Ключ лимита для вызывающего: его IP или SSH-клиент, переданный node_intake_client.py
+    """
+    host = request.client.host if request.client else "unknown"
+    if host in LOCAL_CLIENTS:
+        return request.headers.get("X-Intake-Client") or host
+    return host
+
+
+@asynccontextmanager
+async def admitted(endpoint: str, request: Request):
+    """
+    Hold an admission slot for the request body; 429/503 with Retry-After when saturated
+    Держит слот допуска на время запроса; при перегрузке — 429/503 с Retry-After
+    """
+    client = client_id(request)
+    ADMIT_WAITING.set(_ADMISSION.waiting + 1)
+    try:
+        await _ADMISSION.acquire(client)
+    except Throttled as e:
+        ADMIT_REJECTED.inc(endpoint=endpoint, reason=e.reason)
+        log(f"{endpoint} от {client} отклонён ({e.reason}), Retry-After {e.retry_after} с", "warn")
+        raise HTTPException(status_code=e.status, detail=f"Service saturated ({e.reason})",
+                            headers={"Retry-After": str(e.retry_after)})
+    finally:
+        ADMIT_WAITING.set(_ADMISSION.waiting)
+    ADMIT_ACTIVE_GAUGE.set(_ADMISSION.active)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _ADMISSION.release(time.monotonic() - started)
+        ADMIT_ACTIVE_GAUGE.set(_ADMISSION.active)
+
+
+def update_ipam_gauges() -> None:
+    """
+    Refresh pool/node gauges from the store (called on scrape)
+    Обновляет метрики пулов и нод по хранилищу (вызывается при сборе метрик)
+    """
+    ipam = get_ipam()
+    for pool, (free, total) in ipam.pool_usage().items():
+        POOL_FREE.set(free, pool=pool)
+        POOL_TOTAL.set(total, pool=pool)
+        POOL_USED.set(round(1 - free / total, 6) if total else 0, pool=pool)
+    for role, count in ipam.node_counts().items():
+        NODES.set(count, role=role)
+    LEASES.set(len(ipam.pending_leases()))
+
+
+def get_controller() -> NodeController | None:
+    """
+    Return the process-wide IPAM controller (None when IPAM_CONTROLLER=0)
+    Возвращает контроллер IPAM процесса (None при IPAM_CONTROLLER=0)
+    """
+    global _CONTROLLER
+    if _CONTROLLER is None and CONTROLLER_ENABLED:
+        _CONTROLLER = NodeController(get_ipam(), KUBECONFIG_PATH)
+    return _CONTROLLER
+
+
+def metrics_flush_loop():
+    """
+    Periodically write this process's metrics for /metrics of the other processes
+    Периодически записывает метрики процесса для /metrics остальных процессов
+    """
+    while True:
+        try:
+            metrics.write_snapshot(METRICS_DIR)
+        except OSError as e:
+            log(f"Не удалось записать метрики в {METRICS_DIR}: {e}", "warn")
+        time.sleep(METRICS_FLUSH_SEC)
+
+
+def get_responses() -> ResponseCache:
+    """
+    Return the idempotency response cache, opening it on first use
+    Возвращает кэш ответов по ключам идемпотентности, открывая его при первом обращении
     """
-    Load JOIN_TOKEN from collected_info.py
-    Загружает JOIN_TOKEN из collected_info.py
+    global _RESPONSES
+    if _RESPONSES is None:
+        _RESPONSES = ResponseCache(IDEMPOTENCY_DB, IDEMPOTENCY_TTL)
+    return _RESPONSES
+
+
+async def idempotent(endpoint: str, request: Request, data: dict, subject: str, work, still_valid=None):
+    """
+    Run `work()` once per idempotency key; repeats get the stored response.
+    `still_valid(body)` may reject a stored response that no longer matches IPAM.
+    Выполняет `work()` один раз на ключ идемпотентности; повторы получают сохранённый ответ.
+    `still_valid(body)` может отвергнуть сохранённый ответ, уже не совпадающий с IPAM.
     """
-    namespace = {}
-    if not COLLECTED_INFO_PATH.exists():
-        log(f"Файл collected_info.py не найден: {COLLECTED_INFO_PATH}", "error")
-        raise FileNotFoundError("Missing collected_info.py")
-    exec(COLLECTED_INFO_PATH.read_text(), namespace)
-    token = namespace.get("JOIN_TOKEN")
-    if not token:
-        raise ValueError("JOIN_TOKEN not found in collected_info.py")
-    return token
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    if not key:
+        return await work()
+    cache = get_responses()
+    digest = fingerprint(data)
+
+    state, stored = await offload(cache.begin, endpoint, str(key), subject, digest)
+    if state == "replay" and still_valid is not None and not await offload(still_valid, stored["body"]):
+        log(f"Сохранённый ответ {endpoint} для {subject} устарел — выполняем запрос заново", "warn")
+        await offload(cache.discard, endpoint, str(key))
+        state, stored = await offload(cache.begin, endpoint, str(key), subject, digest)
+    if state == "replay":
+        log(f"Повтор {endpoint} для {subject} по ключу идемпотентности — отдаём сохранённый ответ", "info")
+        return JSONResponse(stored["body"], status_code=stored["status"], headers={"Idempotent-Replayed": "true"})
+    if state == "busy":
+        raise HTTPException(status_code=409, detail="Request with this idempotency key is in progress",
+                            headers={"Retry-After": "1"})
+
+    try:
+        body = await work()
+    except BaseException:
+        await offload(cache.abort, endpoint, str(key))
+        raise
+    await offload(cache.complete, endpoint, str(key), 200, body)
+    return body
+
+
+def get_verifier() -> TokenVerifier:
+    """
+    Return the process-wide join token verifier
+    Возвращает верификатор join-токенов процесса
+    """
+    global _VERIFIER
+    if _VERIFIER is None:
+        _VERIFIER = TokenVerifier(COLLECTED_INFO_PATH, KUBECONFIG_PATH if TOKEN_SECRETS else None, TOKENS_DB)
+    return _VERIFIER
+
+
+async def check_token(data: dict) -> None:
+    """
+    Reject the request unless it carries a currently valid join token
+    Отклоняет запрос без действующего join-токена
+    """
+    token = data.get("token")
+    if not token or not isinstance(token, str):
+        raise HTTPException(status_code=400, detail="Missing token")
+    if not await offload(get_verifier().verify, token):
+        log("Ошибка авторизации: неверный токен", "error")
+        raise HTTPException(status_code=401, detail="Invalid token")
 
 
 def kubectl_label_node(hostname: str, role: str) -> bool:
@@ -58,84 +422,129 @@ def kubectl_label_node(hostname: str, role: str) -> bool:
     Назначает ноде Kubernetes роль через kubectl label
     """
     label_key = f"node-role.kubernetes.io/{role}"
-    cmd = [
-        "kubectl", "--kubeconfig", KUBECONFIG_PATH,
-        "label", "node", hostname,
-        f"{label_key}=true", "--overwrite"
-    ]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = kubectl(["label", "node", hostname, f"{label_key}=true", "--overwrite"], KUBECONFIG_PATH)
 
     if result.returncode == 0:
         log(f"Нода {hostname} успешно промаркирована ролью {role}", "ok")
         return True
     else:
-        log(f"Ошибка при назначении роли {role} ноде {hostname}: {result.stderr.decode()}", "error")
+        log(f"Ошибка при назначении роли {role} ноде {hostname}: {result.stderr}", "error")
         return False
 
 
+def kubectl_nodes_bulk(verb: list, hostnames: list, action: str, tail: tuple = ()) -> set:
+    """
+    Run one kubectl call over many nodes (`verb` + names + `tail`); returns the names that failed
+    Выполняет один вызов kubectl над многими нодами (`verb` + имена + `tail`); возвращает имена с ошибкой
+    """
+    result = kubectl([*verb, *hostnames, *tail], KUBECONFIG_PATH)
+    if result.returncode == 0:
+        return set()
+    stderr = result.stderr
+    # kubectl обрабатывает найденные ноды и сообщает об остальных: nodes "name" not found
+    failed = set(re.findall(r'nodes? "([^"]+)"', stderr)) & set(hostnames) or set(hostnames)
+    log(f"Ошибка ({action}) для нод {', '.join(sorted(failed))}: {stderr.strip()}", "error")
+    return failed
+
+
+def kubectl_label_nodes(hostnames: list, role: str) -> set:
+    """
+    Label many nodes with a role in one kubectl call; returns the names that failed
+    Назначает роль многим нодам одним вызовом kubectl; возвращает имена, которые не удалось промаркировать
+    """
+    label_key = f"node-role.kubernetes.io/{role}"
+    failed = kubectl_nodes_bulk(["label", "node"], hostnames, f"назначение роли {role}",
+                                (f"{label_key}=true", "--overwrite"))
+    if not failed:
+        log(f"{len(hostnames)} нод промаркированы ролью {role}", "ok")
+    return failed
+
+
+def kubectl_node_names() -> set | None:
+    """
+    Names of all Nodes in the cluster, None if kubectl failed
+    Имена всех Node кластера, None при ошибке kubectl
+    """
+    result = kubectl(["get", "nodes", "-o", "jsonpath={.items[*].metadata.name}"], KUBECONFIG_PATH)
+    if result.returncode != 0:
+        log(f"Ошибка получения списка нод: {result.stderr.strip()}", "error")
+        return None
+    return set(result.stdout.split())
+
+
 def kubectl_delete_node(hostname: str) -> bool:
     """
     Delete node from Kubernetes cluster
     Удаляет ноду из кластера Kubernetes
     """
-    cmd = ["kubectl", "--kubeconfig", KUBECONFIG_PATH, "delete", "node", hostname]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = kubectl(["delete", "node", hostname], KUBECONFIG_PATH)
 
     if result.returncode == 0:
         log(f"Нода {hostname} удалена из кластера", "ok")
         return True
     else:
-        log(f"Ошибка при удалении ноды {hostname}: {result.stderr.decode()}", "error")
+        log(f"Ошибка при удалении ноды {hostname}: {result.stderr}", "error")
         return False
 
 
-def run_mapper(action: str, hostname: str, role: str = None, ip: str = None) -> dict:
-    cmd = [sys.executable, str(MAPPER_PATH), "--action", action]
-
-    if action == "register":
-        cmd += ["--name", hostname, "--ip", ip, "--role", role]
-    elif action == "delete":
-        cmd += ["--name", hostname]
+def kubectl_drain_node(hostname: str, timeout: int) -> str | None:
+    """
+    Drain one cordoned node; returns the error text or None on success
+    Выселяет поды с одной закрытой ноды; возвращает текст ошибки или None при успехе
+    """
+    result = kubectl(["drain", hostname, "--ignore-daemonsets", "--delete-emptydir-data",
+                      f"--timeout={timeout}s"], KUBECONFIG_PATH)
+    if result.returncode == 0:
+        log(f"Нода {hostname} освобождена от подов", "ok")
+        return None
+    log(f"Ошибка drain ноды {hostname}: {result.stderr.strip()}", "error")
+    return result.stderr.strip() or f"kubectl drain exited with {result.returncode}"
 
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
+def kubectl_delete_cilium_nodes(hostnames: list) -> None:
+    """
+    Delete CiliumNode objects of the nodes (missing objects or CRD are not an error)
+    Удаляет объекты CiliumNode нод (отсутствие объектов или CRD — не ошибка)
+    """
+    result = kubectl(["delete", "ciliumnodes.cilium.io", *hostnames, "--ignore-not-found"], KUBECONFIG_PATH)
     if result.returncode != 0:
-        log(f"Ошибка mapper.py ({action}): {result.stderr.strip()}", "error")
-        raise HTTPException(status_code=500, detail=result.stderr.strip())
+        log(f"CiliumNode не удалены ({result.stderr.strip()}) — их уберёт cilium-operator", "warn")
 
-    stdout = result.stdout.strip()
 
-    # Находим JSON-блок внутри stdout
-    json_start = stdout.find("{")
-    json_end = stdout.rfind("}") + 1
-    if json_start != -1 and json_end > json_start:
-        try:
-            json_part = stdout[json_start:json_end]
-            return json.loads(json_part)
-        except json.JSONDecodeError:
-            log(f"Не удалось распарсить JSON-часть: {json_part}", "error")
-
-    # Если не нашли JSON, возвращаем сырое
-    log(f"mapper.py вернул не-JSON: {stdout}", "warn")
-    return {"raw": stdout}
+def ipam_register(hostname: str, role: str, ip: str, facts: dict | None = None) -> dict:
+    """
+    Assign a CIDR in-process, mapping allocator errors to HTTP errors
+    Выдаёт CIDR внутри процесса, переводя ошибки аллокатора в HTTP-ошибки
+    """
+    try:
+        return get_ipam().register(role, hostname, ip, facts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        log(f"Ошибка IPAM при регистрации {hostname}: {e}", "error")
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/register")
 async def register_node(request: Request):
     """
     Register a new node and assign a CIDR block.
-    Регистрирует новую ноду через mapper.py и выдает CIDR.
+    Регистрирует новую ноду во встроенном IPAM и выдает CIDR.
 
     Request JSON:
     {
       "node": {
         "hostname": "omen179046",
         "ip": "192.168.0.1",
-        "role": "worker"
+        "role": "worker",
+        "facts": {"cores": 64, "memory_gb": 256}    # опционально: cores, memory_gb, max_pods, class
       },
-      "token": "rizilz.ro3nxrm4ap8xryo3"
+      "token": "rizilz.ro3nxrm4ap8xryo3",
+      "idempotency_key": "3f1c...-omen179046"       # опционально (или заголовок Idempotency-Key)
     }
 
+    Размер CIDR выбирается по классу из data/conf/ipam_classes.yaml.
+
     Response JSON:
     {
       "role": "worker",
@@ -148,14 +557,7 @@ async def register_node(request: Request):
     data = await request.json()
 
     # === Проверка токена ===
-    token = data.get("token")
-    if not token:
-        raise HTTPException(status_code=400, detail="Missing token")
-
-    valid_token = load_join_token()
-    if token != valid_token:
-        log(f"Ошибка авторизации: неверный токен {token}", "error")
-        raise HTTPException(status_code=401, detail="Invalid token")
+    await check_token(data)
 
     node_info = data.get("node")
     if not node_info:
@@ -170,23 +572,131 @@ async def register_node(request: Request):
 
     log(f"Запрос на регистрацию ноды: {hostname} ({role}, {global_ip})", "info")
 
-    # === Вызов mapper.py register ===
-    cidr_entry = run_mapper("register", hostname, role, global_ip)
+    def still_valid(body: dict) -> bool:
+        entry = get_ipam().lookup(hostname)
+        return entry is not None and entry["cidr"] == body.get("cidr")
+
+    async with admitted("/register", request):
+        return await idempotent("/register", request, data, hostname,
+                                lambda: register_one(hostname, role, global_ip, node_info.get("facts")),
+                                still_valid)
+
+
+async def register_one(hostname: str, role: str, global_ip: str, facts: dict | None) -> dict:
+    """
+    Allocate, label and sync one node (the body of /register)
+    Выдаёт CIDR, маркирует и синхронизирует одну ноду (тело /register)
+    """
+    # === Выдача CIDR ===
+    cidr_entry = await offload(ipam_register, hostname, role, global_ip, facts)
 
     # === Промаркировать ноду ===
-    if not kubectl_label_node(hostname, role):
+    if not await offload(kubectl_label_node, hostname, role):
         raise HTTPException(status_code=500, detail="Failed to label node")
 
+    # === Node существует — аренда CIDR становится постоянной ===
+    if "lease_expires" in cidr_entry:
+        await offload(get_ipam().confirm, [hostname])
+        cidr_entry = {k: v for k, v in cidr_entry.items() if k != "lease_expires"}
+
+    # === podCIDR на Node сразу, CiliumNode пропатчит контроллер при создании ===
+    if (controller := get_controller()) is not None:
+        await offload(controller.sync, [hostname])
+
     log(f"Нода {hostname} зарегистрирована и получила CIDR {cidr_entry.get('cidr', '?')}", "ok")
+    # старый ответ /delete этой ноды больше не верен
+    await offload(get_responses().forget, "/delete", hostname)
 
     return cidr_entry
 
 
+@app.post("/register-batch")
+async def register_nodes_batch(request: Request):
+    """
+    Register many nodes at once: one IPAM transaction and one kubectl label call per role.
+    Пакетная регистрация нод: одна транзакция IPAM и один вызов kubectl label на роль.
+
+    Request JSON:
+    {
+      "nodes": [
+        {"hostname": "w-001", "ip": "192.168.0.11", "role": "worker", "facts": {"cores": 8}},
+        {"hostname": "w-002", "ip": "192.168.0.12", "role": "worker"}
+      ],
+      "token": "rizilz.ro3nxrm4ap8xryo3"
+    }
+
+    Response JSON:
+    {
+      "nodes": [
+        {"role": "worker", "name": "w-001", "cidr": "10.244.2.0/24", ..., "labeled": true},
+        ...
+      ],
+      "failed": ["w-002"]      # CIDR арендован, но роль не назначена (ноды ещё нет в кластере)
+    }
+
+    CIDR промаркированных нод подтверждается сразу, у остальных остаётся
+    "lease_expires" — аренда, которую освободят, если нода не появится.
+    """
+    data = await request.json()
+
+    # === Проверка токена ===
+    await check_token(data)
+
+    nodes = data.get("nodes")
+    if not isinstance(nodes, list) or not nodes:
+        raise HTTPException(status_code=400, detail="Missing nodes list")
+    if len(nodes) > MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"Too many nodes in one batch (max {MAX_BATCH})")
+    for node in nodes:
+        if not (isinstance(node, dict) and node.get("hostname") and node.get("ip") and node.get("role")):
+            raise HTTPException(status_code=400, detail=f"Incomplete node info: {node}")
+
+    log(f"Запрос на пакетную регистрацию {len(nodes)} нод", "info")
+
+    async with admitted("/register-batch", request):
+        return await register_batch(nodes)
+
+
+async def register_batch(nodes: list) -> dict:
+    """
+    Allocate, label and sync a batch of nodes (the body of /register-batch)
+    Выдаёт CIDR, маркирует и синхронизирует пакет нод (тело /register-batch)
+    """
+    # === Выдача CIDR одной транзакцией ===
+    try:
+        entries = await offload(get_ipam().register_batch, nodes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        log(f"Ошибка IPAM при пакетной регистрации: {e}", "error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # === Маркировка: один вызов kubectl на роль ===
+    by_role = {}
+    for node in nodes:
+        by_role.setdefault(node["role"], []).append(node["hostname"])
+    failed = set().union(*await asyncio.gather(
+        *(offload(kubectl_label_nodes, hostnames, role) for role, hostnames in by_role.items())))
+
+    # === Промаркированные ноды существуют — их аренды становятся постоянными ===
+    leased = [e["name"] for e in entries if "lease_expires" in e and e["name"] not in failed]
+    confirmed = set(await offload(get_ipam().confirm, leased)) if leased else set()
+    if (controller := get_controller()) is not None:
+        await offload(controller.sync, [e["name"] for e in entries if e["name"] not in failed])
+    result = []
+    for entry in entries:
+        if entry["name"] in confirmed:
+            entry = {k: v for k, v in entry.items() if k != "lease_expires"}
+        result.append({**entry, "labeled": entry["name"] not in failed})
+    log(f"Пакет из {len(nodes)} нод зарегистрирован, без роли: {len(failed)}", "ok" if not failed else "warn")
+    return {"nodes": result, "failed": sorted(failed)}
+
+
 @app.post("/delete")
 async def delete_node(request: Request):
     """
     Delete a node from cluster and cleanup IPAM map.
-    Удаляет ноду из кластера и IPAM карты через mapper.py
+    Удаляет ноду из кластера и освобождает её CIDR во встроенном IPAM
 
     Request JSON:
     {
@@ -194,25 +704,20 @@ async def delete_node(request: Request):
         "hostname": "worker_node",
         "role": "worker"
       },
-      "token": "qwerty.asdfghjklzxcvbn"
+      "token": "qwerty.asdfghjklzxcvbn",
+      "idempotency_key": "3f1c...-worker_node"      # опционально (или заголовок Idempotency-Key)
     }
 
     Response JSON:
     {
-      "status": "ok"
+      "status": "ok",
+      "released": {"role": "worker", "name": "worker_node", "cidr": "10.244.2.0/24", ...}
     }
     """
     data = await request.json()
 
     # === Проверка токена ===
-    token = data.get("token")
-    if not token:
-        raise HTTPException(status_code=400, detail="Missing token")
-
-    valid_token = load_join_token()
-    if token != valid_token:
-        log(f"Ошибка авторизации: неверный токен {token}", "error")
-        raise HTTPException(status_code=401, detail="Invalid token")
+    await check_token(data)
 
     node_info = data.get("node")
     if not node_info:
@@ -224,16 +729,220 @@ async def delete_node(request: Request):
 
     log(f"Запрос на удаление ноды: {hostname}", "warn")
 
+    async with admitted("/delete", request):
+        return await idempotent("/delete", request, data, hostname, lambda: delete_one(hostname))
+
+
+async def delete_one(hostname: str) -> dict:
+    """
+    Delete one node from the cluster and IPAM (the body of /delete)
+    Удаляет одну ноду из кластера и IPAM (тело /delete)
+    """
     # === Удаляем ноду из кластера ===
-    if not kubectl_delete_node(hostname):
+    if not await offload(kubectl_delete_node, hostname):
         raise HTTPException(status_code=500, detail="Failed to delete node from cluster")
 
-    # === Вызов mapper.py delete ===
-    mapper_response = run_mapper("delete", hostname)
+    # === Освобождение CIDR ===
+    released = await offload(get_ipam().delete, hostname)
+    if released is None:
+        log(f"Нода {hostname} не найдена в IPAM", "warn")
 
     log(f"Нода {hostname} удалена и очищена в IPAM", "ok")
+    # старый ответ /register этой ноды больше не верен
+    await offload(get_responses().forget, "/register", hostname)
+
+    return {"status": "ok", "released": released}
+
+
+@app.post("/decommission")
+async def decommission_nodes(request: Request):
+    """
+    Decommission many nodes at once: cordon, drain, delete Node/CiliumNode and free CIDRs.
+    Вывод многих нод из кластера: cordon, drain, удаление Node/CiliumNode и освобождение CIDR.
+
+    Request JSON:
+    {
+      "nodes": ["w-001", "w-002"],
+      "token": "rizilz.ro3nxrm4ap8xryo3",
+      "drain": true,            # опционально (по умолчанию true): выселять поды перед удалением
+      "drain_timeout": 300,     # опционально: таймаут drain одной ноды, секунды
+      "force": false            # опционально: удалять и ноды, drain которых не удался
+    }
+
+    Response JSON:
+    {
+      "decommissioned": ["w-001"],
+      "released": [{"role": "worker", "name": "w-001", "cidr": "10.244.2.0/24", ...}],
+      "failed": {"w-002": "drain: ..."}   # остаются в кластере закрытыми (cordon) и с CIDR
+    }
+
+    Cordon и удаление Node/CiliumNode — по одному вызову kubectl на весь пакет,
+    drain — параллельно, не больше INTAKE_DRAIN_CONCURRENCY одновременно,
+    CIDR освобождаются одной транзакцией IPAM. Нод, которых уже нет в кластере,
+    только освобождают CIDR (и удаляют CiliumNode).
+    """
+    data = await request.json()
+
+    # === Проверка токена ===
+    await check_token(data)
+
+    nodes = data.get("nodes")
+    if not isinstance(nodes, list) or not nodes or not all(isinstance(n, str) and n for n in nodes):
+        raise HTTPException(status_code=400, detail="Missing nodes list")
+    if len(nodes) > MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"Too many nodes in one batch (max {MAX_BATCH})")
+    nodes = list(dict.fromkeys(nodes))
+    drain = data.get("drain", True)
+    force = bool(data.get("force", False))
+    try:
+        drain_timeout = int(data.get("drain_timeout", DRAIN_TIMEOUT))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid drain_timeout")
+
+    log(f"Запрос на вывод из кластера {len(nodes)} нод (drain: {bool(drain)}, force: {force})", "warn")
+
+    present = await offload(kubectl_node_names)
+    if present is None:
+        raise HTTPException(status_code=500, detail="Failed to list cluster nodes")
+    in_cluster = [n for n in nodes if n in present]
+    failed = {}
+
+    # === Cordon: новые поды на эти ноды больше не планируются ===
+    if in_cluster:
+        for name in await offload(kubectl_nodes_bulk, ["cordon"], in_cluster, "cordon"):
+            failed[name] = "cordon failed"
+
+    # === Drain: параллельно, с общим ограничением на процесс ===
+    async def drain_one(name: str) -> None:
+        async with _DRAINS:
+            error = await offload(kubectl_drain_node, name, drain_timeout)
+        if error is not None and not force:
+            failed[name] = f"drain: {error}"
+
+    if drain:
+        await asyncio.gather(*(drain_one(n) for n in in_cluster if n not in failed))
+
+    # === Удаление Node одним вызовом, CiliumNode — тоже ===
+    to_delete = [n for n in in_cluster if n not in failed]
+    if to_delete:
+        for name in await offload(kubectl_nodes_bulk, ["delete", "node"], to_delete, "удаление",
+                                  ("--ignore-not-found",)):
+            failed[name] = "delete failed"
+    removed = [n for n in nodes if n not in failed]
+    if removed:
+        await offload(kubectl_delete_cilium_nodes, removed)
+
+    # === Освобождение CIDR одной транзакцией ===
+    released = await offload(get_ipam().delete_batch, removed) if removed else []
+    for name in removed:
+        # старые ответы /register этих нод больше не верны
+        await offload(get_responses().forget, "/register", name)
+
+    log(f"Выведено из кластера {len(removed)} нод, CIDR освобождено: {len(released)}, "
+        f"с ошибкой: {len(failed)}", "ok" if not failed else "warn")
+    return {"decommissioned": removed, "released": released, "failed": failed}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus metrics in text exposition format.
+    Метрики Prometheus в текстовом формате.
+    """
+    await offload(update_ipam_gauges)
+    text = metrics.render(METRICS_DIR if WORKERS > 1 else None, max_age=3 * METRICS_FLUSH_SEC)
+    return Response(content=text, media_type=metrics.CONTENT_TYPE)
+
+
+def reconcile_loop(interval: int, repair: bool):
+    """
+    Periodically reconcile IPAM with the cluster; leaks are released only after two passes
+    Периодически сверяет IPAM с кластером; утечки освобождаются только после двух проходов
+    """
+    reconciler = Reconciler(get_ipam(), KUBECONFIG_PATH, grace_passes=1)
+    while True:
+        time.sleep(interval)
+        try:
+            reconciler.run(repair=repair)
+        except Exception as e:
+            log(f"Ошибка периодической сверки IPAM: {e}", "error")
+
 
-    return mapper_response
+def lease_loop(interval: int):
+    """
+    Confirm leases whose Node appeared and release expired ones
+    Подтверждает аренды, чьи Node появились, и освобождает истёкшие
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            ipam = get_ipam()
+            pending = ipam.pending_leases()
+            if not pending:
+                continue
+            present = kubectl_node_names()
+            if present is None:
+                # без списка нод нельзя отличить незашедшую ноду от ошибки API — ничего не освобождаем
+                continue
+            ipam.confirm([name for name in pending if name in present])
+            ipam.reclaim_expired()
+        except Exception as e:
+            log(f"Ошибка сборщика аренд IPAM: {e}", "error")
+
+
+def tls_ready() -> bool:
+    """
+    mTLS listener is configured and its certificate, key and CA are in place
+    mTLS-слушатель включён, и его сертификат, ключ и CA на месте
+    """
+    return TLS_PORT > 0 and all(path.exists() for path in (TLS_CERT, TLS_KEY, TLS_CA))
+
+
+def tls_host() -> str:
+    """
+    Address of the mTLS listener: INTAKE_TLS_HOST or the node IP from collected_info.py
+    Адрес mTLS-слушателя: INTAKE_TLS_HOST или IP ноды из collected_info.py
+    """
+    if TLS_HOST:
+        return TLS_HOST
+    from data.collected_info import IP
+    return IP
+
+
+def listener_configs() -> list:
+    """
+    uvicorn configs of the listeners: plain HTTP (SSH path) and, if enabled, mTLS on the node IP
+    Конфиги uvicorn слушателей: HTTP (SSH-путь) и, если включён, mTLS на IP ноды
+    """
+    configs = [uvicorn.Config(app, host=API_HOST, port=API_PORT)]
+    if tls_ready():
+        # lifespan (сброс метрик) уже выполняет первый слушатель того же процесса
+        configs.append(uvicorn.Config(app, host=tls_host(), port=TLS_PORT, lifespan="off",
+                                      ssl_certfile=str(TLS_CERT), ssl_keyfile=str(TLS_KEY),
+                                      ssl_ca_certs=str(TLS_CA), ssl_cert_reqs=ssl.CERT_REQUIRED))
+    return configs
+
+
+async def serve_all(servers: list, sockets: list) -> None:
+    """
+    Serve several uvicorn servers in one loop; when one stops, stop the others
+    Обслуживает несколько серверов uvicorn в одном цикле; остановился один — останавливаем остальные
+    """
+    tasks = [asyncio.create_task(server.serve(sockets=[sock] if sock else None))
+             for server, sock in zip(servers, sockets)]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*tasks)
+
+
+def serve_listeners(sockets: list | None = None) -> None:
+    """
+    Run all listeners in this process (also the target of pool worker processes)
+    Запускает все слушатели в этом процессе (и в каждом процессе пула)
+    """
+    servers = [uvicorn.Server(config) for config in listener_configs()]
+    asyncio.run(serve_all(servers, sockets or [None] * len(servers)))
 
 
 def run_server():
@@ -241,8 +950,36 @@ def run_server():
     Run FastAPI server for control-plane intake
     Запускает FastAPI сервер intake на control-plane
     """
-    log(f"Запуск Intake + IPAM сервиса на {API_HOST}:{API_PORT}", "info")
-    uvicorn.run(app, host=API_HOST, port=API_PORT)
+    log(f"Запуск Intake + IPAM сервиса на {API_HOST}:{API_PORT} (процессов: {WORKERS})", "info")
+    if tls_ready():
+        log(f"mTLS-слушатель для воркеров: {tls_host()}:{TLS_PORT} (CA {TLS_CA})", "info")
+    elif TLS_PORT > 0:
+        log(f"mTLS-слушатель выключен: нет {TLS_CERT}, {TLS_KEY} или {TLS_CA} — "
+            f"воркеры регистрируются только по SSH", "warn")
+    get_ipam()
+    get_verifier().valid_tokens()
+    if (controller := get_controller()) is not None:
+        controller.start()
+    if LEASE_TTL > 0:
+        log(f"Аренда CIDR до появления Node: {LEASE_TTL} с", "info")
+        threading.Thread(target=lease_loop, args=(LEASE_CHECK_INTERVAL,),
+                         daemon=True, name="ipam-leases").start()
+    if RECONCILE_INTERVAL > 0:
+        log(f"Периодическая сверка IPAM каждые {RECONCILE_INTERVAL} с (repair: {RECONCILE_REPAIR})", "info")
+        threading.Thread(target=reconcile_loop, args=(RECONCILE_INTERVAL, RECONCILE_REPAIR),
+                         daemon=True, name="ipam-reconcile").start()
+    if WORKERS <= 1:
+        serve_listeners()
+        return
+    # снимки прошлого запуска не суммируем; главный процесс (фоновые циклы) тоже пишет свой
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    threading.Thread(target=metrics_flush_loop, daemon=True, name="metrics-flush").start()
+    # сокеты открывает главный процесс, воркеры принимают на них соединения;
+    # модуль в воркерах импортируется заново — фоновые циклы выше остаются только здесь
+    sockets = [config.bind_socket() for config in listener_configs()]
+    # конфиг супервизора передаётся воркерам через pickle — приложение строкой импорта
+    supervisor = uvicorn.Config("cluster.intake_services.cps_service:app", workers=WORKERS)
+    Multiprocess(supervisor, target=serve_listeners, sockets=sockets).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Idempotency keys for intake requests (SQLite in WAL mode).
+
+Ключи идемпотентности для запросов intake (SQLite в режиме WAL).
+
+A client that retries after a timeout sends the same key (worker_bootstrap
+uses machine-id + hostname), and the service answers with the stored response
+instead of allocating, labelling or deleting again:
+  - begin() claims the key; a finished request with the same fingerprint
+    (hash of the request body without token/key) is replayed, a claim still
+    in progress is reported as busy, a different body under the same key is
+    processed as a new request and replaces the stored response;
+  - only successful responses are stored (complete()); a failed request
+    releases its claim (abort()) so the retry really runs;
+  - forget() drops responses of the opposite operation for the same node —
+    after /delete an old /register reply must not be replayed, and back;
+  - responses expire after `ttl` seconds; the table lives in its own file
+    next to the IPAM store, so every service process sees the same keys.
+
+Клиент, повторяющий запрос после таймаута, присылает тот же ключ
+(worker_bootstrap — machine-id + hostname), и сервис отвечает сохранённым
+ответом, не выдавая CIDR, не маркируя и не удаляя ноду повторно:
+  - begin() занимает ключ; завершённый запрос с тем же отпечатком (хеш тела
+    без токена/ключа) воспроизводится, ещё выполняющийся — «занят», другое
+    тело под тем же ключом выполняется как новый запрос и заменяет ответ;
+  - сохраняются только успешные ответы (complete()); неудачный запрос
+    освобождает ключ (abort()), чтобы повтор действительно выполнился;
+  - forget() удаляет ответы противоположной операции для той же ноды — после
+    /delete нельзя воспроизводить старый ответ /register, и наоборот;
+  - ответы живут `ttl` секунд; таблица — в отдельном файле рядом с хранилищем
+    IPAM, поэтому ключи видны всем процессам сервиса.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+BUSY_TIMEOUT_MS = 30000
+
+# claim без ответа дольше этого считается брошенным (процесс упал посреди запроса)
+PENDING_TIMEOUT_SEC = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    key         TEXT PRIMARY KEY,
+    subject     TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status      INTEGER,
+    body        TEXT,
+    created     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_subject ON requests(subject);
+CREATE INDEX IF NOT EXISTS requests_created ON requests(created);
+"""
+
+
+def fingerprint(data: dict) -> str:
+    """
+    Stable hash of a request body without credentials and the key itself.
+
+    Стабильный хеш тела запроса без учётных данных и самого ключа.
+    """
+    payload = {k: v for k, v in data.items() if k not in ("token", "idempotency_key")}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Stored responses by (endpoint, idempotency key) with one connection per thread.
+
+    Сохранённые ответы по (эндпоинт, ключ идемпотентности), соединение на поток.
+    """
+
+    def __init__(self, db_path: Path, ttl: float):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def begin(self, endpoint: str, key: str, subject: str, digest: str) -> tuple[str, dict | None]:
+        """
+        Claim a key. Returns ("new", None) — run the request; ("replay", {"status", "body"}) —
+        answer with the stored response; ("busy", None) — the same key is being processed.
+
+        Занять ключ. ("new", None) — выполнять запрос; ("replay", {"status", "body"}) —
+        ответить сохранённым; ("busy", None) — этот ключ уже обрабатывается.
+        """
+        now = time.time()
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM requests WHERE created < ?", (now - self.ttl,))
+            row = db.execute("SELECT * FROM requests WHERE key = ?", (f"{endpoint}:{key}",)).fetchone()
+            if row is not None and row["fingerprint"] == digest:
+                if row["status"] is not None:
+                    db.execute("COMMIT")
+                    return "replay", {"status": row["status"], "body": json.loads(row["body"])}
+                if row["created"] > now - PENDING_TIMEOUT_SEC:
+                    db.execute("COMMIT")
+                    return "busy", None
+            db.execute("INSERT OR REPLACE INTO requests (key, subject, fingerprint, created) VALUES (?, ?, ?, ?)",
+                       (f"{endpoint}:{key}", subject, digest, now))
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return "new", None
+
+    def complete(self, endpoint: str, key: str, status: int, body) -> None:
+        self._conn().execute("UPDATE requests SET status = ?, body = ?, created = ? WHERE key = ?",
+                             (status, json.dumps(body), time.time(), f"{endpoint}:{key}"))
+
+    def abort(self, endpoint: str, key: str) -> None:
+        self._conn().execute("DELETE FROM requests WHERE key = ? AND status IS NULL", (f"{endpoint}:{key}",))
+
+    def discard(self, endpoint: str, key: str) -> None:
+        self._conn().execute("DELETE FROM requests WHERE key = ?", (f"{endpoint}:{key}",))
+
+    def forget(self, endpoint: str, subject: str) -> None:
+        """
+        Drop stored responses of `endpoint` for `subject` (a node name).
+
+        Удалить сохранённые ответы `endpoint` для `subject` (имени ноды).
+        """
+        self._conn().execute("DELETE FROM requests WHERE key LIKE ? AND subject = ?", (f"{endpoint}:%", subject))
@@ -17,6 +17,8 @@ import subprocess
 import sys
 from pathlib import Path
 
+import yaml
+
 # === Добавляем корень проекта для логгера ===
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -30,29 +32,46 @@ WORKER_BOOTSTRAP = CURRENT_DIR / "worker_bootstrap.py"
 WORKER_DELETE = CURRENT_DIR / "worker_delete.py"
 SYSTEMD_TEMPLATE = PROJECT_ROOT / "data/systemd/intake_ipam.service.j2"
 SYSTEMD_TARGET = Path("/etc/systemd/system/intake_ipam.service")
+ARTIFACT_TEMPLATE = PROJECT_ROOT / "data/systemd/artifact_server.service.j2"
+ARTIFACT_TARGET = Path("/etc/systemd/system/artifact_server.service")
+REGISTRY_CACHE_TEMPLATE = PROJECT_ROOT / "data/systemd/registry_cache.service.j2"
+REGISTRY_CACHE_TARGET = Path("/etc/systemd/system/registry_cache.service")
+REGISTRY_MIRRORS_FILE = PROJECT_ROOT / "data/conf/registry_mirrors.yaml"
 
 
-def install_and_start_systemd_service():
+def install_and_start_systemd_service(template: Path = SYSTEMD_TEMPLATE, target: Path = SYSTEMD_TARGET):
     """
-    Install and start the intake_ipam systemd service
-    Устанавливает и запускает systemd-сервис intake_ipam
+    Install and start a systemd service from template (intake_ipam by default)
+    Устанавливает и запускает systemd-сервис из шаблона (по умолчанию intake_ipam)
     """
-    if not SYSTEMD_TEMPLATE.exists():
-        log(f"Шаблон systemd не найден: {SYSTEMD_TEMPLATE}", "error")
+    unit = target.name
+    if not template.exists():
+        log(f"Шаблон systemd не найден: {template}", "error")
         sys.exit(1)
 
-    log("Копирование systemd юнита intake_ipam...", "info")
+    log(f"Копирование systemd юнита {target.stem}...", "info")
     # Просто копируем шаблон как есть (пока без jinja-рендера)
-    SYSTEMD_TARGET.write_text(SYSTEMD_TEMPLATE.read_text())
+    target.write_text(template.read_text())
 
     log("Перезапуск systemd-демона...", "info")
     subprocess.run(["systemctl", "daemon-reexec"], check=True)
 
-    log("Включение и запуск intake_ipam...", "info")
-    subprocess.run(["systemctl", "enable", "--now", "intake_ipam.service"], check=True)
+    log(f"Включение и запуск {target.stem}...", "info")
+    subprocess.run(["systemctl", "enable", "--now", unit], check=True)
+
+    log(f"Сервис {target.stem} успешно установлен и запущен", "ok")
+    subprocess.run(["systemctl", "status", "--no-pager", unit])
 
-    log("Сервис intake_ipam успешно установлен и запущен", "ok")
-    subprocess.run(["systemctl", "status", "--no-pager", "intake_ipam.service"])
+
+def registry_cache_enabled() -> bool:
+    """
+    Check `cache.enabled` in registry_mirrors.yaml
+    Проверяет `cache.enabled` в registry_mirrors.yaml
+    """
+    if not REGISTRY_MIRRORS_FILE.exists():
+        return False
+    data = yaml.safe_load(REGISTRY_MIRRORS_FILE.read_text()) or {}
+    return bool((data.get("cache") or {}).get("enabled"))
 
 
 def run_service(script_path: Path, extra_args=None):
@@ -88,11 +107,11 @@ def main():
     Точка входа для лаунчера сервисов.
 
     It parses the CLI arguments, determines the mode and:
-     - for control-plane installs and starts systemd unit (intake_ipam)
+     - for control-plane installs and starts systemd unit (intake_ipam, artifact_server or registry_cache)
      - for worker runs one-shot bootstrap/delete scripts
 
     Парсит CLI аргументы, определяет режим и:
-     - для control-plane устанавливает и запускает systemd-юнит intake_ipam
+     - для control-plane устанавливает и запускает systemd-юнит intake_ipam, artifact_server или registry_cache
      - для worker выполняет одноразовый bootstrap/delete
     """
     parser = argparse.ArgumentParser(
@@ -105,6 +124,20 @@ def main():
         help="Install & start control-plane intake_ipam systemd service"
     )
 
+    parser.add_argument(
+        "-as",
+        dest="artifact_server",
+        action="store_true",
+        help="Install & start control-plane artifact server for worker nodes / Запустить сервер артефактов"
+    )
+
+    parser.add_argument(
+        "-rc",
+        dest="registry_cache",
+        action="store_true",
+        help="Install & start control-plane pull-through registry cache / Запустить кэш реестров"
+    )
+
     parser.add_argument(
         "-wb",
         action="store_true",
@@ -123,6 +156,17 @@ def main():
         log("Режим: Control-plane systemd service install (-cps)", "ok")
         install_and_start_systemd_service()
 
+    elif args.artifact_server:
+        log("Режим: Control-plane artifact server install (-as)", "ok")
+        install_and_start_systemd_service(ARTIFACT_TEMPLATE, ARTIFACT_TARGET)
+
+    elif args.registry_cache:
+        log("Режим: Control-plane registry cache install (-rc)", "ok")
+        if not registry_cache_enabled():
+            log(f"Кэш реестров выключен в {REGISTRY_MIRRORS_FILE} (cache.enabled) — пропускаем", "info")
+            return
+        install_and_start_systemd_service(REGISTRY_CACHE_TEMPLATE, REGISTRY_CACHE_TARGET)
+
     elif args.wb:
         log("Режим: Worker bootstrap (-wb)", "ok")
         run_service(WORKER_BOOTSTRAP)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Direct mTLS calls from a worker to the intake service.
+
+Прямые вызовы intake-сервиса с воркера по взаимному TLS.
+
+The SSH path starts ssh on the worker, ssh_wrapper.sh and a fresh python3
+with node_intake_client.py on the control-plane for every request. With
+INTAKE_TLS_PORT in join_info.json the worker posts to cps_service on the
+control-plane IP directly — one HTTPS round trip:
+  - the client certificate is the kubelet one issued on `kubeadm join`
+    (kubelet-client-current.pem, CN=system:node:<hostname>), the server
+    certificate (certs/generate_all.py, "intake") is checked against the
+    cluster CA, so both sides are authenticated by the same CA;
+  - the join token and the idempotency key go in the body exactly as on the
+    SSH path, so a fallback to SSH after a failed call is a safe retry;
+  - only the standard library is used (urllib + ssl), the worker needs no
+    extra packages.
+
+SSH-путь на каждый запрос запускает ssh на воркере, а на control-plane —
+ssh_wrapper.sh и новый python3 с node_intake_client.py. С INTAKE_TLS_PORT в
+join_info.json воркер обращается к cps_service на IP control-plane напрямую —
+один HTTPS-запрос:
+  - клиентский сертификат — сертификат kubelet, выданный при `kubeadm join`
+    (kubelet-client-current.pem, CN=system:node:<hostname>), серверный
+    (certs/generate_all.py, "intake") проверяется по CA кластера — обе стороны
+    аутентифицирует один CA;
+  - join-токен и ключ идемпотентности передаются в теле так же, как по SSH,
+    поэтому переход на SSH после неудачного вызова — безопасный повтор;
+  - используется только стандартная библиотека (urllib + ssl), лишние пакеты
+    на воркере не нужны.
+"""
+
+import ssl
+import json
+import urllib.request
+from pathlib import Path
+
+CA_CERT = Path("/etc/kubernetes/pki/ca.crt")
+CLIENT_CERT = Path("/var/lib/kubelet/pki/kubelet-client-current.pem")
+
+REQUEST_TIMEOUT_SEC = 15
+
+
+def available() -> bool:
+    """
+    Are the cluster CA and the kubelet client certificate present on this node?
+
+    Есть ли на ноде CA кластера и клиентский сертификат kubelet?
+    """
+    return CA_CERT.exists() and CLIENT_CERT.exists()
+
+
+def client_context() -> ssl.SSLContext:
+    """
+    TLS context: server verified by the cluster CA, client presents the kubelet certificate.
+
+    TLS-контекст: сервер проверяется по CA кластера, клиент предъявляет сертификат kubelet.
+    """
+    context = ssl.create_default_context(cafile=str(CA_CERT))
+    # pem kubelet содержит и сертификат, и ключ
+    context.load_cert_chain(str(CLIENT_CERT))
+    return context
+
+
+def post(host: str, port: int, path: str, payload: dict, idempotency_key: str | None = None,
+         timeout: float = REQUEST_TIMEOUT_SEC) -> dict:
+    """
+    POST `payload` to https://`host`:`port``path` and return the JSON response.
+    Raises OSError (connection, TLS, HTTP status — urllib.error.HTTPError) or
+    ValueError (not JSON).
+
+    POST `payload` на https://`host`:`port``path`, возвращает JSON-ответ.
+    OSError — ошибка соединения, TLS или HTTP-статус (urllib.error.HTTPError),
+    ValueError — ответ не JSON.
+    """
+    headers = {"Content-Type": "application/json"}
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+    request = urllib.request.Request(f"https://{host}:{port}{path}", data=json.dumps(payload).encode(),
+                                     headers=headers, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout, context=client_context()) as response:
+        return json.loads(response.read())
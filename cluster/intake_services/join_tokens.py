@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Join token verification for the intake service.
+
+Проверка join-токенов для intake-сервиса.
+
+Valid tokens are cached in memory, so /register and /delete no longer exec
+collected_info.py per request:
+  - JOIN_TOKEN of collected_info.py is re-read only when the file's mtime
+    changes; a replaced token stays valid for ROTATION_GRACE_SEC so joins
+    already holding it are not broken by a rotation;
+  - kubeadm bootstrap-token Secrets (kube-system, type
+    bootstrap.kubernetes.io/token) are listed at most every
+    SECRETS_REFRESH_SEC and honour their `expiration`, so every token from
+    `kubeadm token create` is accepted without restarting the service; one
+    thread runs kubectl outside the lock while the others keep checking
+    against the previous list;
+  - tokens are compared with hmac.compare_digest against every valid token;
+  - with `state_path` retired tokens are also kept in a small SQLite file, so
+    every process of a multi-worker service honours the grace period, even
+    one started after the rotation.
+
+Действующие токены кэшируются в памяти, поэтому /register и /delete больше
+не выполняют collected_info.py на каждый запрос:
+  - JOIN_TOKEN из collected_info.py перечитывается только при смене mtime
+    файла; заменённый токен остаётся действительным ROTATION_GRACE_SEC, чтобы
+    ротация не ломала уже начатые join;
+  - Secret bootstrap-токенов kubeadm (kube-system, тип
+    bootstrap.kubernetes.io/token) читаются не чаще SECRETS_REFRESH_SEC с учётом
+    их `expiration` — любой токен из `kubeadm token create` принимается без
+    перезапуска сервиса; kubectl запускает один поток вне блокировки, остальные
+    тем временем проверяют по прошлому списку;
+  - сравнение через hmac.compare_digest со всеми действующими токенами;
+  - с `state_path` заменённые токены хранятся ещё и в небольшом файле SQLite,
+    поэтому льготный период соблюдают все процессы многопроцессного сервиса,
+    даже запущенные после ротации.
+"""
+
+import re
+import sys
+import hmac
+import json
+import time
+import base64
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+from cluster.ipam_cilium.reconcile import kubectl
+
+# collected_info.py хранит все значения строками в кавычках
+TOKEN_RE = re.compile(r'^JOIN_TOKEN\s*=\s*["\']([^"\']+)["\']', re.MULTILINE)
+
+BOOTSTRAP_SECRET_TYPE = "bootstrap.kubernetes.io/token"
+SECRETS_REFRESH_SEC = 60
+ROTATION_GRACE_SEC = 600
+
+RETIRED_SCHEMA = "CREATE TABLE IF NOT EXISTS retired_tokens (token TEXT PRIMARY KEY, expires REAL NOT NULL)"
+
+
+def parse_bootstrap_secrets(items: list, now: float) -> dict:
+    """
+    {token: expiry epoch or None} of usable bootstrap-token Secrets.
+
+    {токен: время истечения (epoch) или None} для годных Secret bootstrap-токенов.
+    """
+    tokens = {}
+    for item in items:
+        data = {k: base64.b64decode(v).decode() for k, v in (item.get("data") or {}).items()}
+        if data.get("usage-bootstrap-authentication") != "true":
+            continue
+        if not (data.get("token-id") and data.get("token-secret")):
+            continue
+        expires = None
+        if data.get("expiration"):
+            expires = datetime.fromisoformat(data["expiration"].replace("Z", "+00:00")).timestamp()
+            if expires <= now:
+                continue
+        tokens[f"{data['token-id']}.{data['token-secret']}"] = expires
+    return tokens
+
+
+class TokenVerifier:
+    """
+    In-memory set of valid join tokens, refreshed from collected_info.py and
+    (optionally) bootstrap-token Secrets. Thread-safe.
+
+    Набор действующих join-токенов в памяти, обновляемый из collected_info.py
+    и (опционально) из Secret bootstrap-токенов. Потокобезопасен.
+    """
+
+    def __init__(self, info_path: Path, kubeconfig: str | None = None, state_path: Path | None = None):
+        self.info_path = Path(info_path)
+        self.kubeconfig = kubeconfig
+        self._lock = threading.Lock()
+        self._state = None
+        if state_path is not None:
+            Path(state_path).parent.mkdir(parents=True, exist_ok=True)
+            # одно соединение, используется только под self._lock
+            self._state = sqlite3.connect(str(state_path), timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+            self._state.execute("PRAGMA journal_mode=WAL")
+            self._state.execute(RETIRED_SCHEMA)
+        self._mtime = None
+        self._file_token = None
+        self._retired = {}
+        self._secret_tokens = {}
+        self._secrets_at = 0.0
+
+    def _refresh_file(self, now: float) -> None:
+        try:
+            mtime = self.info_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            if self._mtime is not None:
+                log(f"Файл {self.info_path} пропал, его токен больше не принимается", "warn")
+            self._mtime, self._file_token = None, None
+            return
+        if mtime == self._mtime:
+            return
+        match = TOKEN_RE.search(self.info_path.read_text())
+        token = match.group(1) if match else None
+        if self._file_token and token != self._file_token:
+            self._retired[self._file_token] = now + ROTATION_GRACE_SEC
+            if self._state is not None:
+                # ротацию замечает каждый процесс — срок остаётся от первого
+                self._state.execute("DELETE FROM retired_tokens WHERE expires <= ?", (now,))
+                self._state.execute("INSERT OR IGNORE INTO retired_tokens VALUES (?, ?)",
+                                    (self._file_token, now + ROTATION_GRACE_SEC))
+            log(f"JOIN_TOKEN сменился, старый действует ещё {ROTATION_GRACE_SEC} с", "info")
+        self._mtime, self._file_token = mtime, token
+
+    def _refresh_retired(self, now: float) -> None:
+        if self._state is None:
+            return
+        for token, expires in self._state.execute("SELECT token, expires FROM retired_tokens WHERE expires > ?",
+                                                  (now,)):
+            self._retired.setdefault(token, expires)
+
+    def _refresh_secrets(self, now: float) -> None:
+        if not self.kubeconfig:
+            return
+        with self._lock:
+            if now - self._secrets_at < SECRETS_REFRESH_SEC:
+                return
+            # обновляет один поток, остальные пока проверяют по прошлому списку
+            self._secrets_at = now
+        # kubectl — вне блокировки: медленный API-сервер не должен останавливать проверку токенов
+        result = kubectl(["get", "secrets", "-n", "kube-system",
+                          f"--field-selector=type={BOOTSTRAP_SECRET_TYPE}", "-o", "json"], self.kubeconfig)
+        if result.returncode != 0:
+            # оставляем последний удачный список — сбой API не должен отзывать токены
+            log(f"Не удалось прочитать bootstrap-токены: {result.stderr.strip()}", "warn")
+            return
+        secret_tokens = parse_bootstrap_secrets(json.loads(result.stdout).get("items", []), now)
+        with self._lock:
+            self._secret_tokens = secret_tokens
+
+    def valid_tokens(self) -> dict:
+        """
+        Refresh stale sources and return {token: expiry epoch or None}.
+
+        Обновить устаревшие источники и вернуть {токен: время истечения или None}.
+        """
+        now = time.time()
+        self._refresh_secrets(now)
+        with self._lock:
+            self._refresh_file(now)
+            self._refresh_retired(now)
+            self._retired = {t: exp for t, exp in self._retired.items() if exp > now}
+            tokens = {t: exp for t, exp in self._secret_tokens.items() if exp is None or exp > now}
+            tokens.update(self._retired)
+            if self._file_token:
+                tokens[self._file_token] = None
+        return tokens
+
+    def verify(self, token: str) -> bool:
+        """
+        Constant-time check of `token` against every valid token.
+
+        Проверка `token` за постоянное время против всех действующих токенов.
+        """
+        given = token.encode()
+        matched = False
+        for valid in self.valid_tokens():
+            # без короткого замыкания — время не зависит от позиции совпадения
+            matched |= hmac.compare_digest(given, valid.encode())
+        return matched
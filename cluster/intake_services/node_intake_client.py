@@ -4,12 +4,27 @@ Node Intake Client
 Одноразовый клиент для взаимодействия с FastAPI-сервисом cps_service.py
 
 Функционал:
- - register: регистрирует новую ноду в кластере (отправляет hostname, ip, role)
+ - register: регистрирует новую ноду в кластере (отправляет hostname, ip, role и
+   необязательные факты ноды для выбора размера CIDR: ядра, память, maxPods, класс)
+ - register-batch: пакетная регистрация нод из JSON-файла (пачками по --batch-size)
  - delete: удаляет ноду из кластера и IPAM
+ - decommission: выводит из кластера много нод сразу (cordon, drain, удаление
+   Node/CiliumNode, освобождение CIDR)
+
+register и delete принимают --idempotency-key: повтор с тем же ключом (например,
+после таймаута) получает сохранённый ответ сервиса и ничего не выполняет заново.
+
+Если сервис перегружен (429/503 с Retry-After, admission.py), register и delete
+завершаются с кодом 75 и печатают в stderr строку "Throttled: <код> Retry-After: <с>" —
+worker_bootstrap.py и worker_delete.py по ней ждут и повторяют. register-batch
+повторяет пакет сам. Запущенный через ssh_wrapper.sh клиент передаёт сервису адрес
+SSH-клиента (X-Intake-Client), чтобы лимит на клиента считался по воркеру.
 
 Пример использования:
     python3 node_intake_client.py register --host 127.0.0.1 --hostname omen179046 --ip 192.168.0.1 --role worker --token rizilz.ro3nxrm4ap8xryo3
+    python3 node_intake_client.py register-batch --host 127.0.0.1 --file nodes.json --token rizilz.ro3nxrm4ap8xryo3
     python3 node_intake_client.py delete --host 127.0.0.1 --hostname omen179046 --role worker --token rizilz.ro3nxrm4ap8xryo3
+    python3 node_intake_client.py decommission --host 127.0.0.1 --hostnames w-001 w-002 --token rizilz.ro3nxrm4ap8xryo3
 """
 
 import os
@@ -23,12 +38,40 @@ PROJECT_ROOT = Path(__file__).resolve().parents[2]
 sys.path.insert(0, str(PROJECT_ROOT))
 
 from utils.logger import log  # централизованный логгер
+from cluster.intake_services.admission import (RETRY_LATER_CODES, THROTTLED_EXIT, Throttled, parse_retry_after,
+                                               retry_throttled, throttled_line)
+
+# Сколько register-batch ждёт перегруженный сервис для одного пакета (секунды)
+BATCH_THROTTLE_DEADLINE_SEC = 600
+
+
+def client_headers() -> dict:
+    """
+    Forward the SSH client address (ssh_wrapper.sh) as the rate-limit key for this worker.
+    Передаёт адрес SSH-клиента (ssh_wrapper.sh) как ключ лимита для этого воркера.
+    """
+    ssh_client = os.environ.get("SSH_CLIENT", "").split()
+    return {"X-Intake-Client": ssh_client[0]} if ssh_client else {}
 
 
-def register_node(server_host: str, hostname: str, node_ip: str, role: str, token: str, port: int = 5050):
+def exit_if_throttled(resp) -> None:
     """
-    Send /register request to intake server.
-    Отправляет запрос на регистрацию ноды на intake сервер.
+    On a retry-later answer print throttled_line() to stderr and exit with THROTTLED_EXIT.
+    На ответ «повторите позже» печатает throttled_line() в stderr и завершается с THROTTLED_EXIT.
+    """
+    if resp.status_code not in RETRY_LATER_CODES:
+        return
+    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+    log(f"Сервис перегружен ({resp.status_code}), повторите через {retry_after or '?'} с", "warn")
+    print(throttled_line(resp.status_code, retry_after), file=sys.stderr)
+    sys.exit(THROTTLED_EXIT)
+
+
+def register_node(server_host: str, hostname: str, node_ip: str, role: str, token: str, port: int = 5050,
+                  facts: dict | None = None, idempotency_key: str | None = None):
+    """
+    Send /register request to intake server (facts select the CIDR size class).
+    Отправляет запрос на регистрацию ноды на intake сервер (факты определяют класс размера CIDR).
     """
     url = f"http://{server_host}:{port}/register"
 
@@ -40,14 +83,19 @@ def register_node(server_host: str, hostname: str, node_ip: str, role: str, toke
         },
         "token": token
     }
+    if facts:
+        payload["node"]["facts"] = facts
+    if idempotency_key:
+        payload["idempotency_key"] = idempotency_key
 
     log(f"Отправка запроса на регистрацию {hostname} ({role}, {node_ip}) -> {url}", "info")
 
     try:
-        resp = requests.post(url, json=payload, timeout=15)
+        resp = requests.post(url, json=payload, headers=client_headers(), timeout=15)
     except requests.exceptions.RequestException as e:
         log(f"Ошибка подключения к серверу {url}: {e}", "error")
         sys.exit(1)
+    exit_if_throttled(resp)
 
     if resp.status_code == 200:
         try:
@@ -63,7 +111,71 @@ def register_node(server_host: str, hostname: str, node_ip: str, role: str, toke
         sys.exit(1)
 
 
-def delete_node(server_host: str, hostname: str, role: str, token: str, port: int = 5050):
+def load_batch_file(path: str) -> list:
+    """
+    Load nodes for batch registration: a JSON list (or {"nodes": [...]}) from a file or stdin ("-").
+    Загружает ноды для пакетной регистрации: JSON-список (или {"nodes": [...]}) из файла или stdin ("-").
+    """
+    try:
+        data = json.load(sys.stdin) if path == "-" else json.loads(Path(path).read_text())
+    except (OSError, json.JSONDecodeError) as e:
+        log(f"Не удалось прочитать список нод {path}: {e}", "error")
+        sys.exit(1)
+    nodes = data.get("nodes") if isinstance(data, dict) else data
+    if not isinstance(nodes, list) or not nodes:
+        log(f"В {path} нет списка нод", "error")
+        sys.exit(1)
+    return nodes
+
+
+def register_nodes_batch(server_host: str, nodes: list, token: str, port: int = 5050, batch_size: int = 100):
+    """
+    Send nodes to /register-batch in chunks of `batch_size`.
+    Отправляет ноды на /register-batch пачками по `batch_size`.
+    """
+    url = f"http://{server_host}:{port}/register-batch"
+    registered, failed = [], []
+
+    def send(chunk: list):
+        resp = requests.post(url, json={"nodes": chunk, "token": token}, headers=client_headers(), timeout=60)
+        if resp.status_code in RETRY_LATER_CODES:
+            raise Throttled(resp.status_code, parse_retry_after(resp.headers.get("Retry-After")))
+        return resp
+
+    for start in range(0, len(nodes), batch_size):
+        chunk = nodes[start:start + batch_size]
+        what = f"Пакет {start + 1}-{start + len(chunk)} из {len(nodes)}"
+        log(f"Отправка: {what} -> {url}", "info")
+        try:
+            resp = retry_throttled(lambda: send(chunk), BATCH_THROTTLE_DEADLINE_SEC, log, what)
+        except requests.exceptions.RequestException as e:
+            log(f"Ошибка подключения к серверу {url}: {e}", "error")
+            sys.exit(1)
+        except Throttled as e:
+            log(f"{what}: сервис перегружен дольше {BATCH_THROTTLE_DEADLINE_SEC} с ({e})", "error")
+            sys.exit(THROTTLED_EXIT)
+
+        if resp.status_code != 200:
+            log(f"Ошибка пакетной регистрации ({resp.status_code}): {resp.text}", "error")
+            sys.exit(1)
+        try:
+            data = resp.json()
+        except json.JSONDecodeError:
+            log("Сервер вернул некорректный JSON", "error")
+            print(resp.text)
+            sys.exit(1)
+        registered.extend(data.get("nodes", []))
+        failed.extend(data.get("failed", []))
+
+    print(json.dumps({"nodes": registered, "failed": failed}, indent=2))
+    if failed:
+        log(f"CIDR выданы, но роль не назначена нодам: {', '.join(failed)}", "error")
+        sys.exit(1)
+    log(f"Пакетная регистрация завершена: {len(registered)} нод", "ok")
+
+
+def delete_node(server_host: str, hostname: str, role: str, token: str, port: int = 5050,
+                idempotency_key: str | None = None):
     """
     Send /delete request to intake server.
     Отправляет запрос на удаление ноды с intake сервера.
@@ -77,14 +189,17 @@ def delete_node(server_host: str, hostname: str, role: str, token: str, port: in
         },
         "token": token
     }
+    if idempotency_key:
+        payload["idempotency_key"] = idempotency_key
 
     log(f"Отправка запроса на удаление {hostname} ({role}) -> {url}", "warn")
 
     try:
-        resp = requests.post(url, json=payload, timeout=15)
+        resp = requests.post(url, json=payload, headers=client_headers(), timeout=15)
     except requests.exceptions.RequestException as e:
         log(f"Ошибка подключения к серверу {url}: {e}", "error")
         sys.exit(1)
+    exit_if_throttled(resp)
 
     if resp.status_code == 200:
         try:
@@ -100,9 +215,43 @@ def delete_node(server_host: str, hostname: str, role: str, token: str, port: in
         sys.exit(1)
 
 
+def decommission_nodes(server_host: str, hostnames: list, token: str, port: int = 5050, drain: bool = True,
+                       drain_timeout: int = 300, force: bool = False):
+    """
+    Send /decommission request: cordon, drain and delete many nodes, free their CIDRs.
+    Отправляет запрос /decommission: cordon, drain и удаление многих нод, освобождение их CIDR.
+    """
+    url = f"http://{server_host}:{port}/decommission"
+    payload = {"nodes": hostnames, "token": token, "drain": drain, "drain_timeout": drain_timeout, "force": force}
+
+    log(f"Отправка запроса на вывод {len(hostnames)} нод из кластера -> {url}", "warn")
+
+    try:
+        # drain идёт пачками по INTAKE_DRAIN_CONCURRENCY — ждём дольше одного drain
+        resp = requests.post(url, json=payload, timeout=None)
+    except requests.exceptions.RequestException as e:
+        log(f"Ошибка подключения к серверу {url}: {e}", "error")
+        sys.exit(1)
+
+    if resp.status_code != 200:
+        log(f"Ошибка вывода нод ({resp.status_code}): {resp.text}", "error")
+        sys.exit(1)
+    try:
+        data = resp.json()
+    except json.JSONDecodeError:
+        log("Сервер вернул некорректный JSON", "error")
+        print(resp.text)
+        sys.exit(1)
+    print(json.dumps(data, indent=2))
+    if data.get("failed"):
+        log(f"Не выведены: {', '.join(sorted(data['failed']))}", "error")
+        sys.exit(1)
+    log(f"Выведено из кластера нод: {len(data.get('decommissioned', []))}", "ok")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Node Intake Client")
-    subparsers = parser.add_subparsers(dest="action", help="Action: register or delete")
+    subparsers = parser.add_subparsers(dest="action", help="Action: register, register-batch, delete or decommission")
 
     # === register ===
     reg_parser = subparsers.add_parser("register", help="Register new node")
@@ -112,6 +261,20 @@ def main():
     reg_parser.add_argument("--role", required=True, choices=["worker", "control-plane"], help="Node role")
     reg_parser.add_argument("--token", required=True, help="JOIN_TOKEN for auth")
     reg_parser.add_argument("--port", default=5050, type=int, help="Server port (default 5050)")
+    reg_parser.add_argument("--cores", type=int, help="Node CPU cores (CIDR size class)")
+    reg_parser.add_argument("--memory-gb", type=float, help="Node memory in GiB (CIDR size class)")
+    reg_parser.add_argument("--max-pods", type=int, help="Node maxPods (CIDR size class)")
+    reg_parser.add_argument("--pod-class", help="Explicit CIDR size class")
+    reg_parser.add_argument("--idempotency-key", help="Same key on retries returns the stored response")
+
+    # === register-batch ===
+    batch_parser = subparsers.add_parser("register-batch", help="Register many nodes from a JSON file")
+    batch_parser.add_argument("--host", required=True, help="Intake server host/IP")
+    batch_parser.add_argument("--file", required=True,
+                              help='JSON list of {"hostname", "ip", "role", "facts"} ("-" for stdin)')
+    batch_parser.add_argument("--token", required=True, help="JOIN_TOKEN for auth")
+    batch_parser.add_argument("--port", default=5050, type=int, help="Server port (default 5050)")
+    batch_parser.add_argument("--batch-size", default=100, type=int, help="Nodes per request (default 100)")
 
     # === delete ===
     del_parser = subparsers.add_parser("delete", help="Delete node")
@@ -120,13 +283,35 @@ def main():
     del_parser.add_argument("--role", required=True, choices=["worker", "control-plane"], help="Node role")
     del_parser.add_argument("--token", required=True, help="JOIN_TOKEN for auth")
     del_parser.add_argument("--port", default=5050, type=int, help="Server port (default 5050)")
+    del_parser.add_argument("--idempotency-key", help="Same key on retries returns the stored response")
+
+    # === decommission ===
+    dec_parser = subparsers.add_parser("decommission", help="Cordon, drain and delete many nodes")
+    dec_parser.add_argument("--host", required=True, help="Intake server host/IP")
+    dec_source = dec_parser.add_mutually_exclusive_group(required=True)
+    dec_source.add_argument("--hostnames", nargs="+", help="Node hostnames")
+    dec_source.add_argument("--file", help='JSON list of hostnames or {"hostname": ...} ("-" for stdin)')
+    dec_parser.add_argument("--token", required=True, help="JOIN_TOKEN for auth")
+    dec_parser.add_argument("--port", default=5050, type=int, help="Server port (default 5050)")
+    dec_parser.add_argument("--no-drain", action="store_true", help="Delete without evicting pods")
+    dec_parser.add_argument("--drain-timeout", default=300, type=int, help="Drain timeout per node, seconds")
+    dec_parser.add_argument("--force", action="store_true", help="Delete nodes even if their drain failed")
 
     args = parser.parse_args()
 
     if args.action == "register":
-        register_node(args.host, args.hostname, args.ip, args.role, args.token, args.port)
+        facts = {"cores": args.cores, "memory_gb": args.memory_gb,
+                 "max_pods": args.max_pods, "class": args.pod_class}
+        register_node(args.host, args.hostname, args.ip, args.role, args.token, args.port,
+                      {k: v for k, v in facts.items() if v is not None}, args.idempotency_key)
+    elif args.action == "register-batch":
+        register_nodes_batch(args.host, load_batch_file(args.file), args.token, args.port, args.batch_size)
     elif args.action == "delete":
-        delete_node(args.host, args.hostname, args.role, args.token, args.port)
+        delete_node(args.host, args.hostname, args.role, args.token, args.port, args.idempotency_key)
+    elif args.action == "decommission":
+        hostnames = args.hostnames or [n["hostname"] if isinstance(n, dict) else n for n in load_batch_file(args.file)]
+        decommission_nodes(args.host, hostnames, args.token, args.port, not args.no_drain,
+                           args.drain_timeout, args.force)
     else:
         parser.print_help()
         sys.exit(1)
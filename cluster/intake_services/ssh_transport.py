@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Multiplexed SSH transport to the control-plane (OpenSSH ControlMaster).
+
+Мультиплексированный SSH-транспорт до control-plane (OpenSSH ControlMaster).
+
+worker_bootstrap.py and worker_delete.py used to start a fresh ssh/sshpass
+with a full handshake for every remote call. SshTransport keeps one master
+connection per (user, host, port) and runs every command as a channel over it:
+  - connect() starts the master in the background (`ssh -M -N -f`) with
+    ControlPersist, so it also serves later calls, retries and runs on the
+    same machine; the socket lives in ~/.ssh/cm-<hash> (ControlPath=%C);
+  - run() checks the master (`ssh -O check`) before every command and
+    reconnects if it is gone; without a master the command simply connects
+    directly, so multiplexing never makes a call fail;
+  - ConnectTimeout and ServerAlive* bound the handshake and detect a dead
+    peer, every command has a timeout; an ssh-level failure (exit code 255)
+    or a timeout drops the master, so a retry starts from a fresh connection;
+  - get_transport() returns one shared transport per target within a process.
+
+worker_bootstrap.py и worker_delete.py запускали новый ssh/sshpass с полным
+рукопожатием на каждый удалённый вызов. SshTransport держит одно
+мастер-соединение на (пользователь, хост, порт) и выполняет каждую команду
+каналом поверх него:
+  - connect() запускает мастер в фоне (`ssh -M -N -f`) с ControlPersist,
+    поэтому он обслуживает и последующие вызовы, повторы и запуски на той же
+    машине; сокет — ~/.ssh/cm-<хеш> (ControlPath=%C);
+  - run() перед каждой командой проверяет мастер (`ssh -O check`) и
+    переподключается, если его нет; без мастера команда просто подключается
+    напрямую, поэтому мультиплексирование не может сломать вызов;
+  - ConnectTimeout и ServerAlive* ограничивают рукопожатие и выявляют мёртвый
+    узел, у каждой команды есть таймаут; ошибка уровня ssh (код 255) или
+    таймаут закрывают мастер, и повтор начинается с нового соединения;
+  - get_transport() возвращает один общий транспорт на цель в пределах процесса.
+"""
+
+import sys
+import fcntl
+import subprocess
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+
+# Таймауты: рукопожатие, одна удалённая команда, проверка/закрытие мастера
+CONNECT_TIMEOUT_SEC = 10
+COMMAND_TIMEOUT_SEC = 60
+CONTROL_TIMEOUT_SEC = 5
+
+# Сколько мастер живёт после последнего канала
+CONTROL_PERSIST_SEC = 300
+
+# Keepalive: мёртвое соединение обнаруживается за SERVER_ALIVE_SEC * SERVER_ALIVE_COUNT
+SERVER_ALIVE_SEC = 10
+SERVER_ALIVE_COUNT = 3
+
+# ssh возвращает 255 при ошибке самого соединения (а не удалённой команды)
+SSH_ERROR_CODE = 255
+
+_TRANSPORTS = {}
+
+
+class SshTransport:
+    """
+    One ControlMaster connection to `user`@`host`:`port`, authenticated by
+    password (sshpass) or by `key_path`.
+
+    Одно ControlMaster-соединение к `user`@`host`:`port` с аутентификацией
+    по паролю (sshpass) или ключом `key_path`.
+    """
+
+    def __init__(self, host: str, user: str, port: str, password: str | None = None,
+                 key_path: Path | None = None, persist: int = CONTROL_PERSIST_SEC):
+        self.host = host
+        self.user = user
+        self.port = str(port)
+        self.password = password or None
+        self.key_path = key_path
+        self.persist = persist
+        self.control_path = str(Path.home() / ".ssh" / "cm-%C")
+        self.lock_path = Path.home() / ".ssh" / f".cm-{user}@{host}-{port}.lock"
+
+    @property
+    def target(self) -> str:
+        return f"{self.user}@{self.host}"
+
+    def _ssh(self, *args: str, auth: bool = True) -> list[str]:
+        argv = ["ssh", "-p", self.port,
+                "-o", "StrictHostKeyChecking=no",
+                "-o", "UserKnownHostsFile=/dev/null",
+                "-o", f"ConnectTimeout={CONNECT_TIMEOUT_SEC}",
+                "-o", f"ServerAliveInterval={SERVER_ALIVE_SEC}",
+                "-o", f"ServerAliveCountMax={SERVER_ALIVE_COUNT}",
+                "-o", f"ControlPath={self.control_path}"]
+        if auth and self.key_path:
+            argv += ["-i", str(self.key_path)]
+        argv += args
+        if auth and self.password:
+            return ["sshpass", "-p", self.password, *argv]
+        return argv
+
+    def command(self, remote_cmd: str) -> list[str]:
+        """
+        argv running `remote_cmd` over the master (or directly when there is none).
+
+        argv, выполняющий `remote_cmd` через мастер (или напрямую, если его нет).
+        """
+        return self._ssh("-o", "ControlMaster=no", self.target, remote_cmd)
+
+    def alive(self) -> bool:
+        """
+        Health check: is the master connection up?
+
+        Проверка: поднято ли мастер-соединение?
+        """
+        try:
+            result = subprocess.run(self._ssh("-O", "check", self.target, auth=False),
+                                    capture_output=True, timeout=CONTROL_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            return False
+        return result.returncode == 0
+
+    def connect(self) -> bool:
+        """
+        Start the background master unless it is already up. False if it could not be started.
+
+        Запустить фоновый мастер, если он ещё не поднят. False, если запустить не удалось.
+        """
+        if self.alive():
+            return True
+        self.lock_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            # второй мастер на том же сокете стал бы обычным фоновым соединением без конца жизни
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.alive():
+                return True
+            return self._start_master()
+
+    def _start_master(self) -> bool:
+        cmd = self._ssh("-M", "-N", "-f", "-o", "ControlMaster=yes",
+                        "-o", f"ControlPersist={self.persist}", self.target)
+        # stderr во временный файл: фоновый мастер держит унаследованные дескрипторы,
+        # и чтение из pipe ждало бы его завершения
+        with tempfile.TemporaryFile(mode="w+") as err:
+            try:
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err,
+                                        timeout=CONNECT_TIMEOUT_SEC + CONTROL_TIMEOUT_SEC)
+                code = result.returncode
+            except subprocess.TimeoutExpired:
+                code = None
+            err.seek(0)
+            stderr = err.read().strip()
+        if code == 0:
+            log(f"SSH-мастер до {self.target}:{self.port} поднят", "info")
+            return True
+        log(f"Не удалось поднять SSH-мастер до {self.target}:{self.port} "
+            f"({'таймаут' if code is None else f'код {code}'}){': ' + stderr if stderr else ''}", "warn")
+        return False
+
+    def run(self, remote_cmd: str, timeout: float = COMMAND_TIMEOUT_SEC,
+            check: bool = True) -> subprocess.CompletedProcess:
+        """
+        Run `remote_cmd` on the target. Raises CalledProcessError (check=True) on a
+        non-zero exit and TimeoutExpired after `timeout` seconds.
+
+        Выполнить `remote_cmd` на цели. CalledProcessError (check=True) при ненулевом
+        коде и TimeoutExpired через `timeout` секунд.
+        """
+        self.connect()
+        cmd = self.command(remote_cmd)
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.close()
+            raise
+        if result.returncode == SSH_ERROR_CODE:
+            # мастер мог повиснуть — следующий вызов начнёт с нового соединения
+            self.close()
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+        return result
+
+    def close(self) -> None:
+        """
+        Stop the master connection, if any.
+
+        Закрыть мастер-соединение, если оно есть.
+        """
+        try:
+            subprocess.run(self._ssh("-O", "exit", self.target, auth=False),
+                           capture_output=True, timeout=CONTROL_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            log(f"SSH-мастер до {self.target}:{self.port} не ответил на exit", "warn")
+
+
+def get_transport(host: str, user: str, port: str, password: str | None = None,
+                  key_path: Path | None = None) -> SshTransport:
+    """
+    Shared transport for one target within the process (fleet operations reuse it).
+
+    Общий транспорт к одной цели в пределах процесса (его переиспользуют операции над флотом).
+    """
+    key = (user, host, str(port))
+    if key not in _TRANSPORTS:
+        _TRANSPORTS[key] = SshTransport(host, user, port, password, key_path)
+    return _TRANSPORTS[key]
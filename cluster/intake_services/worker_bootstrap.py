@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Worker Bootstrap Script
-Подключается к control-plane по SSH, регистрирует воркер-ноду через register
+Регистрирует воркер-ноду на control-plane (напрямую по mTLS или по SSH через register)
 и сохраняет полученный JSON в cluster/ipam_cilium/maps/worker_map.json
 """
 
@@ -11,10 +11,18 @@ Module purpose and flow (EN)
       1) Ensuring local SSH prerequisites (known_hosts file);
       2) Loading local node facts from data/collected_info.py;
       3) Loading join parameters from data/join_info.json;
-      4) Performing SSH connection to the control-plane (by password or key);
-      5) Executing remote "register" command and parsing JSON from stdout;
+      4) With INTAKE_TLS_PORT in join_info.json: posting /register directly
+         to cps_service over mutual TLS (kubelet client certificate);
+      5) Otherwise, or if that fails: performing SSH connection to the
+         control-plane (by password or key), executing remote "register"
+         command and parsing JSON from stdout;
       6) Saving the received IPAM allocation JSON into worker_map.json.
 
+    When the intake service is saturated (429/503 with Retry-After from its
+    admission control, e.g. during an autoscaler join storm) registration is
+    retried after Retry-After plus jittered exponential backoff for up to
+    THROTTLE_DEADLINE_SEC, on the same path and without falling back to SSH.
+
     The script exits with non-zero status on critical failures and logs
     all major steps via utils.logger.log.
 
@@ -23,15 +31,22 @@ Module purpose and flow (EN)
       1) Гарантирует наличие SSH-предпосылок (known_hosts);
       2) Загружает факты о ноде из data/collected_info.py;
       3) Читает параметры подключения из data/join_info.json;
-      4) Подключается к control-plane по паролю или по ключу;
-      5) Выполняет удалённую команду "register" и парсит JSON из stdout;
+      4) С INTAKE_TLS_PORT в join_info.json отправляет /register напрямую в
+         cps_service по взаимному TLS (клиентский сертификат kubelet);
+      5) Иначе или при ошибке — подключается к control-plane по SSH (паролем
+         или ключом), выполняет удалённую команду "register" и парсит JSON из stdout;
       6) Сохраняет полученный JSON-ответ IPAM в worker_map.json.
 
+    Если intake-сервис перегружен (429/503 с Retry-After от контроля допуска,
+    например при шторме присоединений от автоскейлера), регистрация повторяется
+    через Retry-After плюс экспоненциальную задержку с джиттером в течение
+    THROTTLE_DEADLINE_SEC — тем же путём, без перехода на SSH.
+
     При критических ошибках завершает работу с ненулевым кодом,
     ключевые этапы логируются через utils.logger.log.
 """
 
-import sys, json, subprocess, re, os
+import sys, json, subprocess, re, os, time, urllib.error
 from pathlib import Path
 
 CURRENT_DIR = Path(__file__).resolve().parent
@@ -43,10 +58,21 @@ SSH_KEY_PATH = Path.home() / ".ssh" / "ipam-client.key"
 
 sys.path.insert(0, str(PROJECT_ROOT))
 from utils.logger import log
+from cluster.intake_services.ssh_transport import SshTransport, get_transport
+from cluster.intake_services import intake_tls
+from cluster.intake_services.admission import (RETRY_LATER_CODES, THROTTLED_EXIT, Throttled, parse_retry_after,
+                                               parse_throttled, retry_throttled)
 
 SSH_PORT = "3333"
 REMOTE_USER = "ipam-client"
 
+# повторы регистрации по SSH (с ключом идемпотентности повтор не выдаёт второй CIDR)
+REGISTER_ATTEMPTS = 3
+REGISTER_RETRY_DELAY_SEC = 5
+
+# сколько ждать перегруженный intake-сервис (429/503), повторяя с джиттером
+THROTTLE_DEADLINE_SEC = 900
+
 
 def ensure_known_hosts():
     """
@@ -71,11 +97,13 @@ def load_collected_info():
     """
     Load local node facts from data/collected_info.py (EN)
         Executes the Python file and extracts HOSTNAME, IP, ROLE. Exits on
-        absence. Returns a dict: {"hostname": str, "ip": str, "role": str}.
+        absence. Returns a dict: {"hostname": str, "ip": str, "role": str, "facts": dict};
+        facts (CORES, MEMORY_GB, POD_CIDR_CLASS) are optional and select the CIDR size class.
 
     Загрузка локальных фактов ноды из data/collected_info.py (RU)
         Исполняет Python-файл и извлекает HOSTNAME, IP, ROLE. Завершает работу
-        при отсутствии. Возвращает словарь: {"hostname": str, "ip": str, "role": str}.
+        при отсутствии. Возвращает словарь: {"hostname": str, "ip": str, "role": str, "facts": dict};
+        факты (CORES, MEMORY_GB, POD_CIDR_CLASS) необязательны и определяют класс размера CIDR.
     """
     collected_file = DATA_DIR / "collected_info.py"
     if not collected_file.exists():
@@ -85,18 +113,22 @@ def load_collected_info():
     for r in ["HOSTNAME","IP","ROLE"]:
         if r not in ns:
             log(f"Не найден параметр {r} в collected_info.py", "error"); sys.exit(1)
-    return {"hostname": ns["HOSTNAME"], "ip": ns["IP"], "role": ns["ROLE"]}
+    facts = {"cores": ns.get("CORES"), "memory_gb": ns.get("MEMORY_GB"), "pod_class": ns.get("POD_CIDR_CLASS")}
+    return {"hostname": ns["HOSTNAME"], "ip": ns["IP"], "role": ns["ROLE"],
+            "facts": {k: v for k, v in facts.items() if v}}
 
 
 def load_join_info():
     """
     Load join parameters from data/join_info.json (EN)
         Requires CONTROL_PLANE_IP and JOIN_TOKEN keys. Optionally reads
-        IPAM_PASSWORD (defaults to empty string). Returns the parsed dict.
+        IPAM_PASSWORD (defaults to empty string) and INTAKE_TLS_PORT (port of
+        the direct mTLS intake API, 0 or absent — SSH only). Returns the parsed dict.
 
     Загрузка параметров присоединения из data/join_info.json (RU)
         Требует наличия ключей CONTROL_PLANE_IP и JOIN_TOKEN. Опционально читает
-        IPAM_PASSWORD (по умолчанию пустая строка). Возвращает прочитанный словарь.
+        IPAM_PASSWORD (по умолчанию пустая строка) и INTAKE_TLS_PORT (порт прямого
+        mTLS API intake, 0 или нет ключа — только SSH). Возвращает прочитанный словарь.
     """
     join_file = DATA_DIR / "join_info.json"
     if not join_file.exists():
@@ -106,8 +138,9 @@ def load_join_info():
     for r in ["CONTROL_PLANE_IP","JOIN_TOKEN"]:
         if r not in jd:
             log(f"Не найден параметр {r} в join_info.json", "error"); sys.exit(1)
-    # пароль опционален
+    # пароль и порт mTLS опциональны
     jd.setdefault("IPAM_PASSWORD", "")
+    jd["INTAKE_TLS_PORT"] = int(jd.get("INTAKE_TLS_PORT") or 0)
     return jd
 
 
@@ -131,67 +164,120 @@ def is_valid_private_key(path: Path) -> bool:
         return False
 
 
-def build_ssh_cmd(control_plane_ip: str, password: str | None, remote_cmd: str) -> list[str]:
+def open_transport(control_plane_ip: str, password: str | None) -> SshTransport:
     """
-    Construct SSH command for password or key-based authentication (EN)
+    Get the multiplexed SSH transport to the control-plane (EN)
         Uses port SSH_PORT and disables strict host key handling for automation.
-        - If 'password' is provided: uses 'sshpass' to invoke ssh without '-i'.
+        - If 'password' is provided: authenticates through 'sshpass', without '-i'.
         - Otherwise: requires a valid private key at SSH_KEY_PATH, uses 'ssh -i'.
-        Returns the argv list for subprocess.run.
+        Commands run as channels over one ControlMaster connection
+        (ssh_transport.py), so retries do not repeat the handshake.
 
         Parameters:
             control_plane_ip: str  - control-plane public IP
             password        : str|None - password for sshpass, or None to use key
-            remote_cmd      : str  - command to execute remotely
 
         Returns:
-            list[str]: fully-built argv for subprocess
+            SshTransport: shared transport for REMOTE_USER@control_plane_ip:SSH_PORT
 
         Side effects / Exit:
             Logs errors and exits if key mode selected but key is invalid.
 
-    Конструирует SSH-команду для пароля или ключа (RU)
+    Возвращает мультиплексированный SSH-транспорт до control-plane (RU)
         Использует порт SSH_PORT и отключает строгую проверку хост-ключей для автоматизации.
-        - Если передан 'password': применяет 'sshpass', ssh без '-i'.
+        - Если передан 'password': аутентификация через 'sshpass', ssh без '-i'.
         - Иначе: требует валидный ключ в SSH_KEY_PATH и использует 'ssh -i'.
-        Возвращает список аргументов для subprocess.run.
+        Команды выполняются каналами поверх одного ControlMaster-соединения
+        (ssh_transport.py), поэтому повторы не повторяют рукопожатие.
 
         Параметры:
             control_plane_ip: str        - публичный IP control-plane
             password        : str|None   - пароль для sshpass или None для ключа
-            remote_cmd      : str        - удалённая команда
 
         Возвращает:
-            list[str]: полностью сформированный argv для subprocess
+            SshTransport: общий транспорт до REMOTE_USER@control_plane_ip:SSH_PORT
 
         Побочные эффекты / Завершение:
             Логирует ошибки и завершает работу, если выбран режим ключа, но ключ не валиден.
     """
-    base = [
-        "-p", SSH_PORT,
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/dev/null",
-    ]
     if password:
         # парольный режим — НЕ добавляем -i
-        return ["sshpass", "-p", password, "ssh", *base, f"{REMOTE_USER}@{control_plane_ip}", remote_cmd]
-    else:
-        # режим ключа — добавим -i только если ключ валиден
-        if is_valid_private_key(SSH_KEY_PATH):
-            return ["ssh", "-i", str(SSH_KEY_PATH), *base, f"{REMOTE_USER}@{control_plane_ip}", remote_cmd]
-        else:
-            log(f"Ключ {SSH_KEY_PATH} отсутствует или поврежден. Для ключевого режима положите валидный ключ "
-                f"или укажите IPAM_PASSWORD в data/join_info.json", "error")
-            sys.exit(1)
+        return get_transport(control_plane_ip, REMOTE_USER, SSH_PORT, password=password)
+    # режим ключа — добавим -i только если ключ валиден
+    if is_valid_private_key(SSH_KEY_PATH):
+        return get_transport(control_plane_ip, REMOTE_USER, SSH_PORT, key_path=SSH_KEY_PATH)
+    log(f"Ключ {SSH_KEY_PATH} отсутствует или поврежден. Для ключевого режима положите валидный ключ "
+        f"или укажите IPAM_PASSWORD в data/join_info.json", "error")
+    sys.exit(1)
+
+
+def idempotency_key(hostname: str) -> str:
+    """
+    Idempotency key of this node's intake requests: machine-id + hostname (EN)
+        Stable across retries and reboots; a reinstalled machine gets a new
+        machine-id and therefore a new key. Falls back to the hostname alone.
+
+    Ключ идемпотентности запросов этой ноды: machine-id + hostname (RU)
+        Не меняется между повторами и перезагрузками; у переустановленной машины
+        новый machine-id и, значит, новый ключ. Без machine-id — только hostname.
+    """
+    try:
+        machine_id = Path("/etc/machine-id").read_text().strip()
+    except OSError:
+        machine_id = ""
+    return f"{machine_id}-{hostname}" if machine_id else hostname
+
+
+def tls_register_node(control_plane_ip: str, port: int, node_info: dict, token: str) -> dict | None:
+    """
+    Register the worker node directly over mutual TLS (EN)
+        Posts /register to cps_service on control_plane_ip:port with the kubelet
+        client certificate, the join token and the same idempotency key as the
+        SSH path. Returns the parsed response, or None (with a warning) when
+        the certificates are missing or the call fails — the caller then falls
+        back to SSH, which is safe thanks to the idempotency key. Raises
+        Throttled on a retry-later answer (429/503/409).
+
+    Регистрирует воркер-ноду напрямую по взаимному TLS (RU)
+        Отправляет /register в cps_service на control_plane_ip:port с клиентским
+        сертификатом kubelet, join-токеном и тем же ключом идемпотентности, что и
+        SSH-путь. Возвращает разобранный ответ или None (с предупреждением), если
+        сертификатов нет или вызов не удался — тогда вызывающий переходит на SSH,
+        что безопасно благодаря ключу идемпотентности. На ответ «повторите позже»
+        (429/503/409) бросает Throttled.
+    """
+    if not intake_tls.available():
+        log(f"Нет {intake_tls.CA_CERT} или {intake_tls.CLIENT_CERT} — регистрация по SSH", "warn")
+        return None
+    hostname = node_info["hostname"]
+    facts = {("class" if k == "pod_class" else k): v for k, v in node_info.get("facts", {}).items()}
+    payload = {"node": {"hostname": hostname, "ip": node_info["ip"], "role": node_info["role"]}, "token": token}
+    if facts:
+        payload["node"]["facts"] = facts
+    log(f"Регистрация ноды напрямую: https://{control_plane_ip}:{port}/register", "info")
+    try:
+        data = intake_tls.post(control_plane_ip, port, "/register", payload, idempotency_key(hostname))
+    except (OSError, ValueError) as e:
+        if isinstance(e, urllib.error.HTTPError) and e.code in RETRY_LATER_CODES:
+            raise Throttled(e.code, parse_retry_after(e.headers.get("Retry-After")))
+        log(f"Прямая регистрация не удалась ({e}) — переходим на SSH", "warn")
+        return None
+    log(f"Регистрация успешна. CIDR: {data.get('cidr','?')}", "ok")
+    return data
 
 
 def ssh_register_node(control_plane_ip, node_info, token, password: str | None):
     """
     Register the worker node on the control-plane via SSH and parse JSON response (EN)
         Builds a remote "register" command from provided node_info and token,
-        runs it over SSH, logs stderr as warnings (host key additions, libcrypto
-        messages, etc.). Extracts the first JSON object from stdout (greedy)
-        and returns it as a Python dict. Exits on SSH failure or invalid JSON.
+        runs it over the multiplexed SSH transport (with a timeout), logs
+        stderr as warnings (host key additions, libcrypto messages, etc.).
+        Extracts the first JSON object from stdout (greedy)
+        and returns it as a Python dict. A failed SSH call is retried
+        REGISTER_ATTEMPTS times with the same idempotency key, so a retry after
+        a lost response gets the already allocated CIDR. Exits when all
+        attempts fail or on invalid JSON; raises Throttled when the remote
+        client reports a saturated service (exit code THROTTLED_EXIT).
 
         Parameters:
             control_plane_ip: str                 - control-plane IP
@@ -204,9 +290,14 @@ def ssh_register_node(control_plane_ip, node_info, token, password: str | None):
 
     Регистрирует воркер-ноду на control-plane по SSH и разбирает JSON-ответ (RU)
         Формирует удалённую команду "register" из node_info и token, выполняет её
-        по SSH, stderr логируется как предупреждение (host key add, libcrypto и т.п.).
+        через мультиплексированный SSH-транспорт (с таймаутом), stderr логируется
+        как предупреждение (host key add, libcrypto и т.п.).
         Извлекает первый JSON-объект из stdout (жадным поиском) и возвращает его
-        как словарь. Завершает работу при ошибке SSH или некорректном JSON.
+        как словарь. Неудачный вызов SSH повторяется до REGISTER_ATTEMPTS раз с тем
+        же ключом идемпотентности — повтор после потерянного ответа получает уже
+        выданный CIDR. Завершает работу, если все попытки неудачны, или при
+        некорректном JSON; бросает Throttled, если удалённый клиент сообщил о
+        перегрузке сервиса (код THROTTLED_EXIT).
 
         Параметры:
             control_plane_ip: str                 - IP control-plane
@@ -218,12 +309,28 @@ def ssh_register_node(control_plane_ip, node_info, token, password: str | None):
             dict: разобранный JSON, обычно содержит поле 'cidr'
     """
     hostname, node_ip, role = node_info["hostname"], node_info["ip"], node_info["role"]
-    remote_cmd = f"register --host 127.0.0.1 --hostname {hostname} --ip {node_ip} --role {role} --token {token}"
-    cmd = build_ssh_cmd(control_plane_ip, password, remote_cmd)
-
-    log(f"Подключение к control-plane {control_plane_ip}:{SSH_PORT} и регистрация ноды...", "info")
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    remote_cmd = (f"register --host 127.0.0.1 --hostname {hostname} --ip {node_ip} --role {role} --token {token}"
+                  f" --idempotency-key {idempotency_key(hostname)}")
+    for fact, value in node_info.get("facts", {}).items():
+        remote_cmd += f" --{fact.replace('_', '-')} {value}"
+    transport = open_transport(control_plane_ip, password)
+
+    for attempt in range(1, REGISTER_ATTEMPTS + 1):
+        log(f"Подключение к control-plane {control_plane_ip}:{SSH_PORT} и регистрация ноды "
+            f"(попытка {attempt}/{REGISTER_ATTEMPTS})...", "info")
+        try:
+            result = transport.run(remote_cmd)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # сервис перегружен — ждать решает вызывающий (Retry-After), попытку не тратим
+            if getattr(e, "returncode", None) == THROTTLED_EXIT and (throttled := parse_throttled(e.stderr)):
+                raise throttled
+            log(f"Ошибка SSH подключения: {e}", "error")
+            print("STDOUT:", e.stdout); print("STDERR:", e.stderr)
+            if attempt == REGISTER_ATTEMPTS:
+                sys.exit(1)
+            # повтор безопасен: с тем же ключом сервис вернёт уже выданный CIDR
+            time.sleep(REGISTER_RETRY_DELAY_SEC)
+            continue
         if result.stderr.strip():
             # libcrypto warning, hostkey add и т.п. — как warn
             log(f"STDERR: {result.stderr.strip()}", "warn")
@@ -234,9 +341,29 @@ def ssh_register_node(control_plane_ip, node_info, token, password: str | None):
         data = json.loads(m.group(0))
         log(f"Регистрация успешна. CIDR: {data.get('cidr','?')}", "ok")
         return data
-    except subprocess.CalledProcessError as e:
-        log(f"Ошибка SSH подключения: {e}", "error")
-        print("STDOUT:", e.stdout); print("STDERR:", e.stderr); sys.exit(1)
+
+
+def register(join_info: dict, node_info: dict) -> dict:
+    """
+    One registration attempt: mTLS first (if configured), then SSH (EN)
+        Raises Throttled when the service asks to retry later; a throttled
+        mTLS call is not retried over SSH, which would only add load.
+
+    Одна попытка регистрации: сначала mTLS (если настроен), затем SSH (RU)
+        Бросает Throttled, если сервис просит повторить позже; отклонённый
+        вызов по mTLS не повторяется по SSH — это только добавило бы нагрузки.
+    """
+    data = None
+    if join_info["INTAKE_TLS_PORT"]:
+        data = tls_register_node(join_info["CONTROL_PLANE_IP"], join_info["INTAKE_TLS_PORT"],
+                                 node_info, join_info["JOIN_TOKEN"])
+    if data is None:
+        # опционально удалим старую запись known_hosts для IP:PORT
+        subprocess.run(["ssh-keygen", "-R", f"[{join_info['CONTROL_PLANE_IP']}]:{SSH_PORT}"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pw = (join_info.get("IPAM_PASSWORD") or "").strip() or None
+        data = ssh_register_node(join_info["CONTROL_PLANE_IP"], node_info, join_info["JOIN_TOKEN"], pw)
+    return data
 
 
 def save_worker_map(data):
@@ -265,12 +392,16 @@ def main():
     """
     Entry point: orchestrate worker bootstrap flow (EN)
         1) Prepare known_hosts; 2) Load node facts; 3) Verify role=worker;
-        4) Load join info; 5) Remove old host key for [IP]:PORT; 6) Register via SSH;
+        4) Load join info; 5) Register over mTLS if INTAKE_TLS_PORT is set;
+        6) Otherwise remove old host key for [IP]:PORT and register via SSH;
+           a saturated service is retried with jittered backoff (register());
         7) Save IPAM map JSON; exit with proper code on failures.
 
     Точка входа: оркестрация bootstrap воркер-ноды (RU)
         1) Подготовка known_hosts; 2) Загрузка фактов ноды; 3) Проверка role=worker;
-        4) Загрузка join info; 5) Удаление старого хост-ключа для [IP]:PORT; 6) Регистрация по SSH;
+        4) Загрузка join info; 5) Регистрация по mTLS, если задан INTAKE_TLS_PORT;
+        6) Иначе удаление старого хост-ключа для [IP]:PORT и регистрация по SSH;
+           перегруженный сервис — повтор с джиттером (register());
         7) Сохранение JSON карты IPAM; корректное завершение при ошибках.
     """
     log("Bootstrap воркер-ноды...", "info")
@@ -280,12 +411,11 @@ def main():
         log(f"Роль ноды не worker (ROLE={node_info['role']}). Прерывание.", "error"); sys.exit(1)
     join_info = load_join_info()
 
-    # опционально удалим старую запись known_hosts для IP:PORT
-    subprocess.run(["ssh-keygen", "-R", f"[{join_info['CONTROL_PLANE_IP']}]:{SSH_PORT}"],
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    pw = (join_info.get("IPAM_PASSWORD") or "").strip() or None
-    data = ssh_register_node(join_info["CONTROL_PLANE_IP"], node_info, join_info["JOIN_TOKEN"], pw)
+    try:
+        data = retry_throttled(lambda: register(join_info, node_info), THROTTLE_DEADLINE_SEC, log, "Регистрация")
+    except Throttled as e:
+        log(f"Intake-сервис перегружен дольше {THROTTLE_DEADLINE_SEC} с ({e}). Прерывание.", "error")
+        sys.exit(1)
     save_worker_map(data)
 
 
@@ -2,32 +2,43 @@
 """
 Worker node deletion & local cleanup orchestrator (EN)
     This script removes a Kubernetes worker node from the control-plane
-    via SSH (invoking a remote CLI 'delete') and then performs a local
+    (directly over mutual TLS when INTAKE_TLS_PORT is set in join_info.json,
+    otherwise or on failure via SSH invoking a remote CLI 'delete') and then performs a local
     reset/cleanup sequence on the node:
       1) Stop & disable kubelet;
       2) kubeadm reset -f;
       3) Remove kube/cni/cilium-related state (including BPF paths);
       4) Restart the container runtime (containerd by default);
       5) Optionally unmount bpffs if mounted and no longer needed.
+    The removals of step 3 run in parallel; once they are done, steps 4 and 5
+    run in parallel with each other.
+    A saturated intake service (429/503 with Retry-After) is retried with
+    jittered backoff for up to THROTTLE_DEADLINE_SEC.
     SSH supports both password and key-based auth. Errors on the remote
     deletion step do not prevent local cleanup from running. Logging is
     performed through utils.logger.log.
 
 Оркестрация удаления воркер-ноды и локальной очистки (RU)
-    Скрипт удаляет воркер-ноду с control-plane по SSH (удалённый CLI 'delete'),
-    после чего выполняет локальный сброс/очистку на ноде:
+    Скрипт удаляет воркер-ноду с control-plane (напрямую по взаимному TLS, если в
+    join_info.json задан INTAKE_TLS_PORT, иначе или при ошибке — по SSH через
+    удалённый CLI 'delete'), после чего выполняет локальный сброс/очистку на ноде:
       1) Остановка и отключение kubelet;
       2) kubeadm reset -f;
       3) Удаление состояния kube/cni/cilium (включая пути BPF);
       4) Перезапуск контейнерного рантайма (по умолчанию containerd);
       5) Опциональное размонтирование bpffs, если смонтирован и более не нужен.
+    Удаления шага 3 выполняются параллельно; после них параллельно друг с
+    другом выполняются шаги 4 и 5.
+    Перегруженный intake-сервис (429/503 с Retry-After) — повтор с джиттером
+    в течение THROTTLE_DEADLINE_SEC.
     Поддерживаются парольный и ключевой режимы SSH. Ошибка при удалении на
     control-plane не блокирует локальную очистку. Логирование через
     utils.logger.log.
 """
 
-import os, sys, json, subprocess, re, errno
+import os, sys, json, subprocess, re, errno, time, urllib.error
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Пути
 CURRENT_DIR = Path(__file__).resolve().parent
@@ -38,10 +49,21 @@ SSH_KEY_PATH = Path.home() / ".ssh" / "ipam-client.key"
 # Логгер
 sys.path.insert(0, str(PROJECT_ROOT))
 from utils.logger import log
+from cluster.intake_services.ssh_transport import SshTransport, get_transport
+from cluster.intake_services import intake_tls
+from cluster.intake_services.admission import (RETRY_LATER_CODES, THROTTLED_EXIT, Throttled, parse_retry_after,
+                                               parse_throttled, retry_throttled)
 
 SSH_PORT = "3333"
 REMOTE_USER = "ipam-client"
 
+# повторы удаления по SSH (ключ идемпотентности делает повтор безопасным)
+DELETE_ATTEMPTS = 3
+DELETE_RETRY_DELAY_SEC = 5
+
+# сколько ждать перегруженный intake-сервис (429/503), повторяя с джиттером
+THROTTLE_DEADLINE_SEC = 300
+
 
 def ensure_known_hosts():
     """
@@ -107,11 +129,13 @@ def load_join_info():
     """
     Load join/control-plane parameters from data/join_info.json (EN)
         Requires CONTROL_PLANE_IP and JOIN_TOKEN. Optionally uses IPAM_PASSWORD
-        (defaults to empty string). Returns the parsed dict.
+        (defaults to empty string) and INTAKE_TLS_PORT (direct mTLS intake API,
+        0 or absent — SSH only). Returns the parsed dict.
 
     Загружает параметры присоединения/control-plane из data/join_info.json (RU)
         Требует CONTROL_PLANE_IP и JOIN_TOKEN. Опционально использует IPAM_PASSWORD
-        (по умолчанию пустая строка). Возвращает словарь с параметрами.
+        (по умолчанию пустая строка) и INTAKE_TLS_PORT (прямой mTLS API intake,
+        0 или нет ключа — только SSH). Возвращает словарь с параметрами.
     """
     jf = DATA_DIR / "join_info.json"
     if not jf.exists():
@@ -122,53 +146,97 @@ def load_join_info():
         if r not in jd:
             log(f"Не найден параметр {r} в join_info.json", "error"); sys.exit(1)
     jd.setdefault("IPAM_PASSWORD", "")
+    jd["INTAKE_TLS_PORT"] = int(jd.get("INTAKE_TLS_PORT") or 0)
     return jd
 
 
-def build_ssh_cmd(host: str, password: str|None, remote_cmd: str) -> list[str]:
+def open_transport(host: str, password: str|None) -> SshTransport:
     """
-    Build SSH command argv for password or key-based auth (EN)
+    Get the multiplexed SSH transport for password or key-based auth (EN)
         - Password mode: uses sshpass, no '-i';
         - Key mode     : requires a valid key at SSH_KEY_PATH and uses '-i'.
-        Disables strict host key checking for automation.
+        Disables strict host key checking for automation. Commands run as
+        channels over one ControlMaster connection (ssh_transport.py).
 
         Parameters:
             host       : str        - control-plane IP/host
             password   : str|None   - sshpass password or None to use key
-            remote_cmd : str        - remote command to execute
 
         Returns:
-            list[str]: argv list suitable for subprocess.run
+            SshTransport: shared transport for REMOTE_USER@host:SSH_PORT
 
         Exit behavior:
             Exits(1) if key mode is selected but the key is missing/invalid.
 
-    Формирует argv для SSH с паролем или ключом (RU)
+    Возвращает мультиплексированный SSH-транспорт с паролем или ключом (RU)
         - Парольный режим: использует sshpass, без '-i';
         - Ключевой режим : требует валидный ключ в SSH_KEY_PATH и использует '-i'.
-        Строгая проверка ключа хоста отключена для автоматизации.
+        Строгая проверка ключа хоста отключена для автоматизации. Команды
+        выполняются каналами поверх одного ControlMaster-соединения (ssh_transport.py).
 
         Параметры:
             host       : str        - IP/хост control-plane
             password   : str|None   - пароль для sshpass или None для ключа
-            remote_cmd : str        - удалённая команда
 
         Возвращает:
-            list[str]: список аргументов для subprocess.run
+            SshTransport: общий транспорт до REMOTE_USER@host:SSH_PORT
 
         Поведение при ошибке:
             Завершает работу (exit 1), если выбран режим ключа, но ключ отсутствует/повреждён.
     """
-    base = ["-p", SSH_PORT,
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null"]
     if password:
-        return ["sshpass","-p",password,"ssh",*base,f"{REMOTE_USER}@{host}",remote_cmd]
-    else:
-        if is_valid_private_key(SSH_KEY_PATH):
-            return ["ssh","-i",str(SSH_KEY_PATH),*base,f"{REMOTE_USER}@{host}",remote_cmd]
-        log(f"Ключ {SSH_KEY_PATH} отсутствует или повреждён, а IPAM_PASSWORD не задан — нечем аутентифицироваться", "error")
-        sys.exit(1)
+        return get_transport(host, REMOTE_USER, SSH_PORT, password=password)
+    if is_valid_private_key(SSH_KEY_PATH):
+        return get_transport(host, REMOTE_USER, SSH_PORT, key_path=SSH_KEY_PATH)
+    log(f"Ключ {SSH_KEY_PATH} отсутствует или повреждён, а IPAM_PASSWORD не задан — нечем аутентифицироваться", "error")
+    sys.exit(1)
+
+
+def idempotency_key(hostname: str) -> str:
+    """
+    Idempotency key of this node's intake requests: machine-id + hostname (EN)
+        Same key as worker_bootstrap.py uses for /register.
+
+    Ключ идемпотентности запросов этой ноды: machine-id + hostname (RU)
+        Тот же ключ, что worker_bootstrap.py передаёт в /register.
+    """
+    try:
+        machine_id = Path("/etc/machine-id").read_text().strip()
+    except OSError:
+        machine_id = ""
+    return f"{machine_id}-{hostname}" if machine_id else hostname
+
+
+def tls_unregister_on_cp(cp_ip: str, port: int, hostname: str, token: str) -> bool:
+    """
+    Unregister the worker node directly over mutual TLS (EN)
+        Posts /delete to cps_service on cp_ip:port with the kubelet client
+        certificate (still present: local cleanup runs afterwards) and the same
+        idempotency key as the SSH path. Returns False when the certificates
+        are missing or the call fails, so the caller falls back to SSH.
+        Raises Throttled on a retry-later answer (429/503/409).
+
+    Удаляет регистрацию воркер-ноды напрямую по взаимному TLS (RU)
+        Отправляет /delete в cps_service на cp_ip:port с клиентским сертификатом
+        kubelet (он ещё на месте: локальная очистка идёт после) и тем же ключом
+        идемпотентности, что и SSH-путь. Возвращает False, если сертификатов нет
+        или вызов не удался, — тогда вызывающий переходит на SSH. На ответ
+        «повторите позже» (429/503/409) бросает Throttled.
+    """
+    if not intake_tls.available():
+        log(f"Нет {intake_tls.CA_CERT} или {intake_tls.CLIENT_CERT} — удаление по SSH", "warn")
+        return False
+    payload = {"node": {"hostname": hostname, "role": "worker"}, "token": token}
+    log(f"Удаление ноды напрямую: https://{cp_ip}:{port}/delete", "info")
+    try:
+        intake_tls.post(cp_ip, port, "/delete", payload, idempotency_key(hostname))
+    except (OSError, ValueError) as e:
+        if isinstance(e, urllib.error.HTTPError) and e.code in RETRY_LATER_CODES:
+            raise Throttled(e.code, parse_retry_after(e.headers.get("Retry-After")))
+        log(f"Прямое удаление не удалось ({e}) — переходим на SSH", "warn")
+        return False
+    log("Ответ control-plane: JSON принят", "ok")
+    return True
 
 
 def unregister_on_cp(cp_ip: str, hostname: str, token: str, password: str|None):
@@ -176,8 +244,10 @@ def unregister_on_cp(cp_ip: str, hostname: str, token: str, password: str|None):
     Unregister the worker node on the control-plane via SSH (EN)
         Executes remote CLI 'delete' with provided hostname and token.
         Logs stderr as warnings (e.g. host key messages). Accepts either a JSON
-        response or plain text like 'OK'. Does not raise on failure—continues
-        to local cleanup.
+        response or plain text like 'OK'. A failed call is retried
+        DELETE_ATTEMPTS times with the same idempotency key. Does not raise on
+        failure—continues to local cleanup; raises Throttled when the remote
+        client reports a saturated service (exit code THROTTLED_EXIT).
 
         Parameters:
             cp_ip    : str        - control-plane IP
@@ -188,8 +258,10 @@ def unregister_on_cp(cp_ip: str, hostname: str, token: str, password: str|None):
     Удаляет регистрацию воркер-ноды на control-plane по SSH (RU)
         Выполняет удалённую CLI-команду 'delete' с указанными hostname и token.
         stderr логируется как предупреждение. Ожидается либо JSON-ответ, либо
-        простой текст вроде 'OK'. При ошибке не прерывает процесс — далее будет
-        выполнена локальная очистка.
+        простой текст вроде 'OK'. Неудачный вызов повторяется до DELETE_ATTEMPTS
+        раз с тем же ключом идемпотентности. При ошибке не прерывает процесс —
+        далее будет выполнена локальная очистка; бросает Throttled, если удалённый
+        клиент сообщил о перегрузке сервиса (код THROTTLED_EXIT).
         
         Параметры:
             cp_ip    : str        - IP control-plane
@@ -197,11 +269,23 @@ def unregister_on_cp(cp_ip: str, hostname: str, token: str, password: str|None):
             token    : str        - токен аутентификации
             password : str|None   - пароль для sshpass или None для ключа
     """
-    REMOTE_DELETE_CMD = f"delete --host 127.0.0.1 --hostname {hostname} --role worker --token {token}"
-    cmd = build_ssh_cmd(cp_ip, password, REMOTE_DELETE_CMD)
-    log(f"Удаление ноды на control-plane {cp_ip}:{SSH_PORT} ...", "info")
-    try:
-        res = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    REMOTE_DELETE_CMD = (f"delete --host 127.0.0.1 --hostname {hostname} --role worker --token {token}"
+                         f" --idempotency-key {idempotency_key(hostname)}")
+    transport = open_transport(cp_ip, password)
+    for attempt in range(1, DELETE_ATTEMPTS + 1):
+        log(f"Удаление ноды на control-plane {cp_ip}:{SSH_PORT} (попытка {attempt}/{DELETE_ATTEMPTS}) ...", "info")
+        try:
+            res = transport.run(REMOTE_DELETE_CMD)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # сервис перегружен — ждать решает вызывающий (Retry-After), попытку не тратим
+            if getattr(e, "returncode", None) == THROTTLED_EXIT and (throttled := parse_throttled(e.stderr)):
+                raise throttled
+            log(f"Ошибка при удалении ноды на control-plane: {e}", "warn")
+            print("STDOUT:", e.stdout); print("STDERR:", e.stderr)
+            if attempt < DELETE_ATTEMPTS:
+                time.sleep(DELETE_RETRY_DELAY_SEC)
+            # не фейлим весь процесс — продолжим локальную очистку
+            continue
         if res.stderr.strip():
             log(f"STDERR: {res.stderr.strip()}", "warn")
         # допустим сервер вернёт JSON или 'OK'
@@ -210,44 +294,74 @@ def unregister_on_cp(cp_ip: str, hostname: str, token: str, password: str|None):
             log("Ответ control-plane: JSON принят", "ok")
         else:
             log(f"Ответ control-plane: {res.stdout.strip() or 'OK'}", "ok")
-    except subprocess.CalledProcessError as e:
-        log(f"Ошибка при удалении ноды на control-plane: {e}", "warn")
-        print("STDOUT:", e.stdout); print("STDERR:", e.stderr)
-        # не фейлим весь процесс — продолжим локальную очистку
+        return
+
+
+def unregister(ji: dict, hostname: str) -> None:
+    """
+    One unregister attempt: mTLS first (if configured), then SSH (EN)
+        Raises Throttled when the service asks to retry later.
+
+    Одна попытка дерегистрации: сначала mTLS (если настроен), затем SSH (RU)
+        Бросает Throttled, если сервис просит повторить позже.
+    """
+    if ji["INTAKE_TLS_PORT"] and tls_unregister_on_cp(ji["CONTROL_PLANE_IP"], ji["INTAKE_TLS_PORT"],
+                                                      hostname, ji["JOIN_TOKEN"]):
+        return
+    # подчистим хостключ
+    subprocess.run(["ssh-keygen","-R",f"[{ji['CONTROL_PLANE_IP']}]:{SSH_PORT}"],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    pw = (ji.get("IPAM_PASSWORD") or "").strip() or None
+    unregister_on_cp(ji["CONTROL_PLANE_IP"], hostname, ji["JOIN_TOKEN"], pw)
+    # нода уходит из кластера — мастер-соединение до control-plane больше не нужно
+    open_transport(ji["CONTROL_PLANE_IP"], pw).close()
+
+
+def run_parallel(commands: list) -> None:
+    """
+    Run independent best-effort commands concurrently and wait for all (EN)
+        Each command is an argv list run with check=False; the whole group
+        takes as long as its slowest step instead of the sum of all steps.
+
+    Параллельно выполняет независимые команды best-effort и ждёт все (RU)
+        Каждая команда — список argv, запускается с check=False; группа
+        длится столько, сколько самый долгий шаг, а не сумму всех шагов.
+    """
+    with ThreadPoolExecutor(max_workers=len(commands) or 1) as pool:
+        list(pool.map(lambda cmd: subprocess.run(cmd, check=False), commands))
 
 
 def local_reset_and_cleanup():
     """
     Perform local kube reset and cleanup of node state (EN)
-        - Stop & disable kubelet;
-        - kubeadm reset -f;
-        - Remove kubelet, CNI, Cilium, and BPF-related paths;
-        - Restart containerd;
-        - Attempt to unmount /sys/fs/bpf if mounted.
+        - Stop & disable kubelet (in parallel);
+        - kubeadm reset -f (needs kubelet stopped, runs alone);
+        - Remove kubelet, CNI, Cilium, and BPF-related paths (in parallel);
+        - Then restart containerd and unmount /sys/fs/bpf if mounted (in
+          parallel), so the runtime comes up on already cleaned state.
 
         Notes:
             All steps are best-effort (check=False). Errors are tolerated
             to ensure the cleanup proceeds as far as possible.
 
     Выполняет локальный сброс и очистку состояния ноды (RU)
-        - Останавливает и отключает kubelet;
-        - Выполняет kubeadm reset -f;
-        - Удаляет пути kubelet, CNI, Cilium и связанные с BPF;
-        - Перезапускает containerd;
-        - Пытается отмонтировать /sys/fs/bpf, если смонтирован.
+        - Останавливает и отключает kubelet (параллельно);
+        - Выполняет kubeadm reset -f (нужен остановленный kubelet, идёт отдельно);
+        - Удаляет пути kubelet, CNI, Cilium и связанные с BPF (параллельно);
+        - Затем перезапускает containerd и отмонтирует /sys/fs/bpf, если
+          смонтирован (параллельно), — рантайм поднимается на уже очищенном состоянии.
 
         Примечание:
             Все шаги выполняются по принципу best-effort (check=False).
             Ошибки допускаются, чтобы очистка завершилась максимально полно.
     """
     log("Остановка kubelet и локальный reset...", "info")
-    subprocess.run(["systemctl","stop","kubelet"], check=False)
-    subprocess.run(["systemctl","disable","kubelet"], check=False)
+    run_parallel([["systemctl","stop","kubelet"], ["systemctl","disable","kubelet"]])
     subprocess.run(["kubeadm","reset","-f"], check=False)
 
     paths = [
         "/etc/kubernetes",
-        "/var/lib/kubelet/pki",
         "/var/lib/kubelet/*",
         "/etc/cni/net.d",
         "/var/lib/cni",
@@ -255,20 +369,20 @@ def local_reset_and_cleanup():
         "/var/lib/cilium",
         "/run/cilium",
     ]
-    for p in paths:
-        subprocess.run(["bash","-lc",f"rm -rf {p}"], check=False)
+    run_parallel([["bash","-lc",f"rm -rf {p}"] for p in paths])
 
-    # Перезапуск контейнерного рантайма (containerd по умолчанию)
-    subprocess.run(["systemctl","restart","containerd"], check=False)
+    # Перезапуск контейнерного рантайма (containerd по умолчанию) — после очистки
+    steps = [["systemctl","restart","containerd"]]
 
     # На всякий — отмонтировать bpffs, если пустой и смонтирован
     try:
         mounts = Path("/proc/mounts").read_text()
         if "/sys/fs/bpf" in mounts:
-            subprocess.run(["umount","/sys/fs/bpf"], check=False)
+            steps.append(["umount","/sys/fs/bpf"])
     except Exception:
         pass
 
+    run_parallel(steps)
     log("Локальная очистка завершена", "ok")
 
 
@@ -277,15 +391,19 @@ def main():
     Entry point for worker deletion workflow (EN)
         1) Prepare known_hosts; 2) Load node facts & join info;
         3) Validate role is 'worker';
-        4) Clean old SSH hostkey entry for [IP]:PORT;
-        5) Attempt remote unregister on control-plane;
+        4) Attempt unregister over mTLS if INTAKE_TLS_PORT is set;
+        5) Otherwise clean old SSH hostkey entry for [IP]:PORT and attempt
+           remote unregister on control-plane via SSH (unregister()), a
+           saturated service is retried with jittered backoff;
         6) Perform local reset & cleanup; 7) Log completion.
 
     Точка входа рабочего процесса удаления воркер-ноды (RU)
         1) Подготовка known_hosts; 2) Загрузка фактов ноды и join-параметров;
         3) Проверка, что роль — 'worker';
-        4) Удаление старого ключа хоста для [IP]:PORT;
-        5) Попытка дерегистрации на control-plane;
+        4) Попытка дерегистрации по mTLS, если задан INTAKE_TLS_PORT;
+        5) Иначе удаление старого ключа хоста для [IP]:PORT и попытка
+           дерегистрации на control-plane по SSH (unregister()), перегруженный
+           сервис — повтор с джиттером;
         6) Локальный reset и очистка; 7) Логирование завершения.
     """
     log("Удаление воркер-ноды...", "warn")
@@ -296,12 +414,11 @@ def main():
     if ci["role"] != "worker":
         log(f"Роль ноды не worker (ROLE={ci['role']}). Прерывание.", "error"); sys.exit(1)
 
-    # подчистим хостключ
-    subprocess.run(["ssh-keygen","-R",f"[{ji['CONTROL_PLANE_IP']}]:{SSH_PORT}"],
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    pw = (ji.get("IPAM_PASSWORD") or "").strip() or None
-    unregister_on_cp(ji["CONTROL_PLANE_IP"], ci["hostname"], ji["JOIN_TOKEN"], pw)
+    try:
+        retry_throttled(lambda: unregister(ji, ci["hostname"]), THROTTLE_DEADLINE_SEC, log, "Удаление на control-plane")
+    except Throttled as e:
+        # как и другие ошибки удаления на control-plane, не мешает локальной очистке
+        log(f"Intake-сервис перегружен дольше {THROTTLE_DEADLINE_SEC} с ({e}) — продолжаем локальную очистку", "warn")
     local_reset_and_cleanup()
     log("Готово", "ok")
 
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Subnet allocator for the IPAM mapper.
+
+Аллокатор подсетей для IPAM mapper.
+
+The pool `base` is split into subnets of `prefix`; each subnet is addressed by
+its integer index, so nothing is ever materialised per subnet. Free indices
+are kept as a sorted list of half-open intervals [start, end):
+  - allocate() scans the free ranges for the best fit — O(n) in the number
+    of free ranges, O(1) for a fresh pool or when a perfect fit comes first;
+  - release()/reserve() locate the interval with bisect — O(log n) in the
+    number of free ranges, which stays tiny compared to the pool size;
+  - the state serialises as the interval list (see store.py) and can be
+    rebuilt from the assigned CIDRs in O(k log k) for k used subnets.
+
+Mixed sizes: `prefix` is the smallest unit, and allocate(prefix=N) for a
+shorter N hands out an aligned run of 2**(prefix-N) units, i.e. a real /N.
+Such blocks are placed best-fit — into the tightest free range that holds an
+aligned run — so a released /23 is reused by the next /23 instead of being
+eaten by small blocks while fresh space gets split. Unit blocks take the start
+of the free range that can hold the smallest aligned block there (the lowest
+such range on a tie), so they fill odd holes before splitting a released /23.
+A CIDR longer than the unit cannot be tracked: from_used() rejects it, the
+unit must not be widened over such allocations.
+
+Пул `base` делится на подсети длины `prefix`; каждая подсеть адресуется
+целым индексом, поэтому подсети никогда не материализуются списком.
+Свободные индексы хранятся отсортированным списком полуинтервалов [start, end):
+  - allocate() ищет лучший свободный диапазон — O(n) по числу свободных
+    диапазонов, O(1) для нового пула или когда точное попадание идёт первым;
+  - release()/reserve() находят интервал через bisect — O(log n) по числу
+    свободных диапазонов, которое намного меньше размера пула;
+  - состояние сериализуется как список интервалов (см. store.py) и может быть
+    пересобрано по выданным CIDR за O(k log k) для k занятых подсетей.
+
+Смешанные размеры: `prefix` — минимальная единица, а allocate(prefix=N) для
+более короткого N выдаёт выровненную серию из 2**(prefix-N) единиц, т.е.
+настоящую /N. Такие блоки размещаются по best-fit — в самый тесный свободный
+диапазон, где есть выровненная серия, — поэтому освобождённая /23 достаётся
+следующей /23, а не дробится мелкими блоками. Единичная подсеть берётся из
+начала того свободного диапазона, где там помещается наименьший выровненный
+блок (при равенстве — из наименьшего), поэтому единицы сначала заполняют
+нечётные дыры, а не дробят освобождённую /23. CIDR длиннее единицы учесть
+нельзя: from_used() его отвергает, расширять единицу поверх таких выдач нельзя.
+"""
+
+import bisect
+import ipaddress
+
+
+class SubnetAllocator:
+    """
+    Interval free-list over subnet indices of `base` split by `prefix`.
+    The first `skip` subnets are never handed out.
+
+    Free-list интервалов по индексам подсетей `base`, нарезанной по `prefix`.
+    Первые `skip` подсетей никогда не выдаются.
+    """
+
+    def __init__(self, base: str, prefix: int, skip: int = 0):
+        self.base = ipaddress.ip_network(base)
+        self.prefix = prefix
+        self.skip = skip
+        if prefix < self.base.prefixlen or prefix > self.base.max_prefixlen:
+            raise ValueError(f"prefix /{prefix} does not fit into {self.base}")
+
+        self.host_bits = self.base.max_prefixlen - prefix
+        self.size = 1 << (prefix - self.base.prefixlen)
+        self.free = [[skip, self.size]] if skip < self.size else []
+
+    @classmethod
+    def from_used(cls, base: str, prefix: int, used, skip: int = 0) -> "SubnetAllocator":
+        """
+        Build the allocator from already assigned CIDRs in O(k log k) for k used subnets.
+        CIDRs outside the pool are ignored; a CIDR inside it that is longer than
+        the unit raises ValueError (its unit would be handed out again).
+
+        Построить аллокатор по уже выданным CIDR за O(k log k) для k занятых подсетей.
+        CIDR вне пула игнорируются; CIDR внутри пула длиннее единицы — ValueError
+        (его единица была бы выдана повторно).
+        """
+        alloc = cls(base, prefix, skip)
+        spans = []
+        for cidr in used:
+            span = alloc.span_of(cidr)
+            if span is not None:
+                spans.append(span)
+            elif alloc.is_longer(cidr):
+                raise ValueError(f"{cidr} is longer than the /{prefix} unit of {alloc.base}")
+        spans.sort()
+
+        free, cursor = [], skip
+        for start, end in spans:
+            if start > cursor:
+                free.append([cursor, start])
+            cursor = max(cursor, end)
+        if cursor < alloc.size:
+            free.append([cursor, alloc.size])
+        alloc.free = free
+        return alloc
+
+    def index_of(self, cidr: str) -> int | None:
+        """
+        Subnet index of a unit-sized `cidr` inside the pool, or None if it does not belong to it.
+
+        Индекс подсети `cidr` единичного размера в пуле или None, если она ему не принадлежит.
+        """
+        span = self.span_of(cidr)
+        return span[0] if span and span[1] - span[0] == 1 else None
+
+    def span_of(self, cidr: str) -> tuple[int, int] | None:
+        """
+        Unit range [start, end) covered by `cidr` (any prefix between the pool and the unit),
+        or None if it does not belong to the pool or lies in the skipped part.
+
+        Диапазон единиц [start, end), занятый `cidr` (любой префикс от пула до единицы),
+        или None, если подсеть вне пула или в пропущенной части.
+        """
+        net = ipaddress.ip_network(cidr, strict=False)
+        if (net.version != self.base.version or not self.base.prefixlen <= net.prefixlen <= self.prefix
+                or not net.subnet_of(self.base)):
+            return None
+        start = (int(net.network_address) - int(self.base.network_address)) >> self.host_bits
+        end = start + (1 << (self.prefix - net.prefixlen))
+        return (start, end) if start >= self.skip else None
+
+    def is_longer(self, cidr: str) -> bool:
+        """
+        True if `cidr` lies in the pool but is longer than the unit.
+
+        True, если `cidr` лежит в пуле, но длиннее единицы.
+        """
+        net = ipaddress.ip_network(cidr, strict=False)
+        return net.version == self.base.version and net.prefixlen > self.prefix and net.subnet_of(self.base)
+
+    def subnet_at(self, index: int, prefix: int | None = None):
+        """
+        Subnet object for an index (of `prefix` length, the unit by default).
+
+        Объект подсети по индексу (длины `prefix`, по умолчанию — единица).
+        """
+        addr = int(self.base.network_address) + (index << self.host_bits)
+        return ipaddress.ip_network((addr, prefix or self.prefix))
+
+    @property
+    def free_count(self) -> int:
+        return sum(end - start for start, end in self.free)
+
+    def allocate(self, prefix: int | None = None):
+        """
+        Take a best-fit unit subnet or aligned /`prefix` block.
+        Raises RuntimeError when no such block is free.
+
+        Взять единичную подсеть или выровненный блок /`prefix` по best-fit.
+        RuntimeError, если такого блока нет.
+        """
+        prefix = prefix or self.prefix
+        if not self.base.prefixlen <= prefix <= self.prefix:
+            raise ValueError(f"prefix /{prefix} is outside /{self.base.prefixlen}../{self.prefix}")
+        count = 1 << (self.prefix - prefix)
+        if count == 1:
+            if not self.free:
+                raise RuntimeError("CIDR pool exhausted")
+            # наибольший выровненный блок, начинающийся с начала диапазона: чем он меньше,
+            # тем меньше единица отнимет у блоков больших классов
+            best = None
+            for pos, (start, end) in enumerate(self.free):
+                block = min(start & -start or self.size, 1 << ((end - start).bit_length() - 1))
+                if best is None or block < best[0]:
+                    best = (block, pos)
+                    if block == 1:
+                        break
+            _, pos = best
+            index = self.free[pos][0]
+            self._take(pos, index, index + 1)
+            return self.subnet_at(index)
+
+        best = None
+        for pos, (start, end) in enumerate(self.free):
+            aligned = -(-start // count) * count
+            if aligned + count <= end and (best is None or end - start < best[0]):
+                best = (end - start, pos, aligned)
+                if best[0] == count:
+                    break
+        if best is None:
+            raise RuntimeError(f"CIDR pool exhausted for /{prefix}")
+        _, pos, index = best
+        self._take(pos, index, index + count)
+        return self.subnet_at(index, prefix)
+
+    def _take(self, pos: int, start: int, end: int) -> None:
+        lo, hi = self.free[pos]
+        self.free[pos:pos + 1] = [r for r in ([lo, start], [end, hi]) if r[0] < r[1]]
+
+    def reserve(self, cidr: str) -> bool:
+        """
+        Mark a specific subnet as used. Returns False if it was not entirely free.
+
+        Пометить конкретную подсеть занятой. False, если она была свободна не целиком.
+        """
+        span = self.span_of(cidr)
+        if span is None:
+            return False
+        start, end = span
+        pos = bisect.bisect_right(self.free, start, key=lambda r: r[0]) - 1
+        if pos < 0 or not (self.free[pos][0] <= start and end <= self.free[pos][1]):
+            return False
+        self._take(pos, start, end)
+        return True
+
+    def release(self, cidr: str) -> bool:
+        """
+        Return a subnet to the pool, merging with neighbouring free ranges.
+        Returns False if it is outside the pool, skipped or already free.
+
+        Вернуть подсеть в пул, склеивая с соседними свободными диапазонами.
+        False, если она вне пула, в зарезервированной части или уже свободна.
+        """
+        span = self.span_of(cidr)
+        if span is None:
+            return False
+        start, end = span
+
+        pos = bisect.bisect_right(self.free, start, key=lambda r: r[0])
+        prev = self.free[pos - 1] if pos > 0 else None
+        nxt = self.free[pos] if pos < len(self.free) else None
+        if (prev and start < prev[1]) or (nxt and nxt[0] < end):
+            return False
+
+        if prev and prev[1] == start and nxt and nxt[0] == end:
+            prev[1] = nxt[1]
+            del self.free[pos]
+        elif prev and prev[1] == start:
+            prev[1] = end
+        elif nxt and nxt[0] == end:
+            nxt[0] = start
+        else:
+            self.free.insert(pos, [start, end])
+        return True
+
+    def to_dict(self) -> dict:
+        return {"base": str(self.base), "prefix": self.prefix, "skip": self.skip, "free": self.free}
+
+    def matches(self, base: str, prefix: int, skip: int) -> bool:
+        return (str(self.base), self.prefix, self.skip) == (str(ipaddress.ip_network(base)), prefix, skip)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SubnetAllocator":
+        alloc = cls(data["base"], data["prefix"], data.get("skip", 0))
+        alloc.free = [list(r) for r in data["free"]]
+        return alloc
+
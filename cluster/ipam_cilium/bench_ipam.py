@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Offline IPAM benchmark: allocation/free churn for large node counts.
+
+Офлайн-бенчмарк IPAM: выдача/освобождение CIDR при большом числе нод.
+
+For every (backend, class mix, node count) the pool is filled with N nodes,
+then `--churn` × N random release+allocate pairs are run. Reported per case:
+per-operation latency (mean/p50/p99/max), throughput, peak RSS of the case
+process, free ranges and fragmentation — the share of free space that cannot
+hold a block of the largest class. `--tracemalloc` adds the peak Python heap
+but slows allocation-heavy backends several times, so latencies from such a
+run are not comparable.
+
+Backends:
+  - legacy-scan — the original mapper algorithm: list every subnet of the
+    pool and take the first one not in the used set (single prefix only);
+  - legacy-json — the same plus loading and rewriting the sorted JSON map on
+    every operation, as mapper.py did before the store;
+  - allocator   — SubnetAllocator (allocator.py) in memory;
+  - store       — IpamStore (store.py), one SQLite transaction per operation.
+
+Legacy backends are O(pool) per operation and only run up to --legacy-max
+nodes. Each case runs in its own process against a temporary directory; no
+cluster, collected_info or real maps are touched.
+
+Для каждого сочетания (бэкенд, набор классов, число нод) пул заполняется N
+нодами, затем выполняется `--churn` × N случайных пар освобождение+выдача.
+В отчёте: задержка операции (mean/p50/p99/max), пропускная способность,
+пик RSS процесса кейса, число свободных диапазонов и фрагментация — доля
+свободного места, куда не помещается блок самого крупного класса.
+`--tracemalloc` добавляет пик Python-кучи, но в разы замедляет бэкенды с
+активным выделением памяти — задержки такого прогона несравнимы. Legacy-бэкенды работают за O(размер пула) на
+операцию и запускаются только до --legacy-max нод. Каждый кейс выполняется в
+отдельном процессе во временном каталоге.
+
+Usage / Использование:
+    python3 cluster/ipam_cilium/bench_ipam.py --nodes 10000 100000 --classes 24 --classes 23,24,25
+"""
+
+import argparse
+import ipaddress
+import json
+import math
+import multiprocessing
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+from cluster.ipam_cilium.allocator import SubnetAllocator
+from cluster.ipam_cilium.store import IpamStore
+
+BACKENDS = ("legacy-scan", "legacy-json", "allocator", "store")
+LEGACY_BACKENDS = ("legacy-scan", "legacy-json")
+# Запас пула сверх нужного числа единиц, чтобы churn не упирался в исчерпание
+POOL_HEADROOM = 1.25
+
+# Столбцы таблицы результатов
+TABLE_COLUMNS = ("backend", "classes", "nodes", "ops", "ops_per_s", "mean_us", "p50_us", "p99_us", "max_us",
+                 "py_peak_mb", "maxrss_mb", "free_ranges", "fragmentation")
+
+
+class LegacyScan:
+    """
+    Original mapper algorithm: materialise all subnets, first one not in the used set.
+
+    Исходный алгоритм mapper: материализовать все подсети, взять первую не из used.
+    """
+
+    def __init__(self, base: str, unit: int, skip: int, workdir: Path):
+        self.base, self.unit, self.skip = ipaddress.ip_network(base), unit, skip
+        self.data = {}
+
+    def load(self) -> dict:
+        return self.data
+
+    def save(self, data: dict) -> None:
+        self.data = data
+
+    def allocate(self, name: str, prefix: int) -> str:
+        if prefix != self.unit:
+            raise ValueError("legacy backends support a single prefix")
+        data = self.load()
+        used = {entry["cidr"] for entry in data.values()}
+        for subnet in list(self.base.subnets(new_prefix=self.unit))[self.skip:]:
+            cidr = str(subnet)
+            if cidr not in used:
+                data[name] = {"role": "worker", "name": name, "globalip": "0.0.0.0",
+                              "cidr": cidr, "clasterip": str(subnet.network_address)}
+                self.save(data)
+                return cidr
+        raise RuntimeError("CIDR pool exhausted")
+
+    def release(self, name: str) -> None:
+        data = self.load()
+        del data[name]
+        self.save(data)
+
+    def used(self) -> list:
+        return [entry["cidr"] for entry in self.load().values()]
+
+    def close(self) -> None:
+        pass
+
+
+class LegacyJson(LegacyScan):
+    """
+    Legacy scan plus a full JSON map read and sorted rewrite per operation.
+
+    Legacy-перебор плюс полное чтение JSON-карты и сортированная перезапись на каждую операцию.
+    """
+
+    def __init__(self, base: str, unit: int, skip: int, workdir: Path):
+        super().__init__(base, unit, skip, workdir)
+        self.path = workdir / "worker_map.json"
+        self.path.write_text("{}")
+
+    def load(self) -> dict:
+        return json.loads(self.path.read_text())
+
+    def save(self, data: dict) -> None:
+        items = sorted(data.items(), key=lambda x: ipaddress.ip_network(x[1]["cidr"]).network_address)
+        self.path.write_text(json.dumps(dict(items), indent=4))
+
+
+class AllocatorBackend:
+    """
+    SubnetAllocator in memory.
+
+    SubnetAllocator в памяти.
+    """
+
+    def __init__(self, base: str, unit: int, skip: int, workdir: Path):
+        self.alloc = SubnetAllocator(base, unit, skip)
+        self.names = {}
+
+    def allocate(self, name: str, prefix: int) -> str:
+        cidr = str(self.alloc.allocate(prefix))
+        self.names[name] = cidr
+        return cidr
+
+    def release(self, name: str) -> None:
+        self.alloc.release(self.names.pop(name))
+
+    def used(self) -> list:
+        return list(self.names.values())
+
+    def close(self) -> None:
+        pass
+
+
+class StoreBackend:
+    """
+    IpamStore (SQLite WAL) in a temporary directory, one transaction per operation.
+
+    IpamStore (SQLite WAL) во временном каталоге, одна транзакция на операцию.
+    """
+
+    def __init__(self, base: str, unit: int, skip: int, workdir: Path):
+        self.pool = (base, unit, skip)
+        self.store = IpamStore(workdir / "ipam.db")
+
+    def allocate(self, name: str, prefix: int) -> str:
+        entry, _ = self.store.assign("worker", name, "0.0.0.0", *self.pool, node_prefix=prefix)
+        return entry["cidr"]
+
+    def release(self, name: str) -> None:
+        self.store.release(name, {"worker": self.pool})
+
+    def used(self) -> list:
+        return [entry["cidr"] for entry in self.store.entries("worker").values()]
+
+    def close(self) -> None:
+        pass
+
+
+BACKEND_CLASSES = {"legacy-scan": LegacyScan, "legacy-json": LegacyJson,
+                   "allocator": AllocatorBackend, "store": StoreBackend}
+
+
+def pool_for(nodes: int, classes: list) -> tuple[str, int, int]:
+    """
+    Pool (base, unit, skip) big enough for `nodes` nodes of the class mix plus headroom.
+    The first unit is skipped, like the control-plane block in the worker pool.
+
+    Пул (base, unit, skip), вмещающий `nodes` нод данного набора классов с запасом.
+    Первая единица пропускается, как блок control-plane в пуле воркеров.
+    """
+    unit = max(classes)
+    avg_units = statistics.mean(2 ** (unit - p) for p in classes)
+    bits = math.ceil(math.log2(nodes * avg_units * POOL_HEADROOM + 1))
+    base = ipaddress.ip_network(f"10.0.0.0/{unit}").supernet(new_prefix=unit - bits)
+    return str(base), unit, 1
+
+
+def fragmentation(base: str, unit: int, skip: int, used: list, largest: int) -> dict:
+    """
+    Free ranges and the share of free units unusable for a block of the `largest` class.
+
+    Число свободных диапазонов и доля свободных единиц, непригодных для блока класса `largest`.
+    """
+    alloc = SubnetAllocator.from_used(base, unit, used, skip)
+    count = 2 ** (unit - largest)
+    fits = 0
+    for start, end in alloc.free:
+        aligned = -(-start // count) * count
+        fits += max(0, (end - aligned) // count)
+    ideal = alloc.free_count // count
+    return {"free_units": alloc.free_count, "free_ranges": len(alloc.free),
+            "fragmentation": round(1 - fits / ideal, 4) if ideal else 0.0}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_case(backend: str, classes: list, nodes: int, churn: float, seed: int,
+             trace_memory: bool = False) -> dict:
+    """
+    Fill the pool with `nodes` nodes, then run churn; returns the metrics of the case.
+
+    Заполнить пул `nodes` нодами, затем выполнить churn; возвращает метрики кейса.
+    """
+    rng = random.Random(seed)
+    base, unit, skip = pool_for(nodes, classes)
+    latencies = []
+
+    if trace_memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory(prefix="bench-ipam-") as tmp:
+        impl = BACKEND_CLASSES[backend](base, unit, skip, Path(tmp))
+        live, serial = [], 0
+
+        def timed(fn, *args):
+            t0 = time.perf_counter_ns()
+            fn(*args)
+            latencies.append(time.perf_counter_ns() - t0)
+
+        started = time.perf_counter()
+        for _ in range(nodes):
+            name = f"node-{serial}"
+            serial += 1
+            timed(impl.allocate, name, rng.choice(classes))
+            live.append(name)
+        fill_seconds = time.perf_counter() - started
+
+        for _ in range(int(nodes * churn)):
+            victim = live.pop(rng.randrange(len(live)))
+            timed(impl.release, victim)
+            name = f"node-{serial}"
+            serial += 1
+            timed(impl.allocate, name, rng.choice(classes))
+            live.append(name)
+        total_seconds = time.perf_counter() - started
+
+        frag = fragmentation(base, unit, skip, impl.used(), min(classes))
+        impl.close()
+    py_peak = None
+    if trace_memory:
+        py_peak = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "classes": ",".join(f"/{p}" for p in classes),
+        "nodes": nodes,
+        "pool": base,
+        "ops": len(latencies),
+        "fill_s": round(fill_seconds, 3),
+        "total_s": round(total_seconds, 3),
+        "ops_per_s": round(len(latencies) / total_seconds) if total_seconds else 0,
+        "mean_us": round(statistics.fmean(latencies) / 1000, 1),
+        "p50_us": round(percentile(latencies, 0.50) / 1000, 1),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 1),
+        "max_us": round(latencies[-1] / 1000, 1),
+        "py_peak_mb": py_peak if py_peak is not None else "-",
+        "maxrss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        **frag,
+    }
+
+
+def print_table(results: list, columns: tuple = TABLE_COLUMNS) -> None:
+    """
+    Print `results` as a plain-text table of `columns` (also used by bench_intake.py).
+
+    Печатает `results` текстовой таблицей по столбцам `columns` (используется и в bench_intake.py).
+    """
+    widths = {c: max(len(c), *(len(str(r[c])) for r in results)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(widths[c]) for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline IPAM allocation/free churn benchmark")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 10000, 100000], help="Node counts")
+    parser.add_argument("--classes", action="append",
+                        help="Comma-separated per-node prefixes of one class mix, e.g. 23,24,25 (repeatable)")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--churn", type=float, default=1.0, help="Release+allocate pairs per node after fill")
+    parser.add_argument("--legacy-max", type=int, default=2000, help="Largest node count for legacy backends")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Also report peak Python heap (slows the run, latencies not comparable)")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    mixes = [sorted({int(p) for p in c.split(",")}) for c in (args.classes or ["24", "23,24,25"])]
+    cases = []
+    for classes in mixes:
+        for nodes in args.nodes:
+            for backend in args.backends:
+                if backend in LEGACY_BACKENDS and (len(classes) > 1 or nodes > args.legacy_max):
+                    continue
+                cases.append((backend, classes, nodes))
+
+    # отдельный процесс на кейс — честный пик RSS и чистое состояние
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for backend, classes, nodes in cases:
+        log(f"Кейс: {backend}, классы {classes}, нод {nodes}...", "info")
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(run_case, (backend, classes, nodes, args.churn, args.seed,
+                                                  args.tracemalloc)))
+
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        log(f"Результаты сохранены в {args.json}", "ok")
+
+
+if __name__ == "__main__":
+    main()
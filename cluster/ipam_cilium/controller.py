@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+IPAM controller: applies podCIDRs from the store as Nodes and CiliumNodes appear.
+
+Контроллер IPAM: проставляет podCIDRs из хранилища при появлении Node и CiliumNode.
+
+Runs inside cps_service on the control-plane with its kubeconfig, so workers
+no longer poll for the CRD and their CiliumNode (`patcher.py --w`) and need no
+credentials to patch cluster objects:
+  - one `kubectl get --watch --output-watch-events` stream per resource
+    (Node, CiliumNode); the initial ADDED events cover objects created while
+    the controller was down, a closed or failed stream is restarted;
+  - on ADDED/MODIFIED of a node known to IPAM: Node.spec.podCIDR(s) is patched
+    if empty (it is immutable afterwards), CiliumNode.spec.ipam.podCIDRs is
+    patched whenever it differs from the store, and an unconfirmed lease is
+    confirmed (store.py);
+  - sync(names) is called by /register right after labelling: the Node joins
+    before it registers, so its ADDED event came before the CIDR existed.
+
+Работает внутри cps_service на control-plane с его kubeconfig, поэтому
+воркеры больше не опрашивают CRD и свой CiliumNode (`patcher.py --w`) и не
+нуждаются в правах на патч объектов кластера:
+  - по одному потоку `kubectl get --watch --output-watch-events` на ресурс
+    (Node, CiliumNode); начальные события ADDED покрывают объекты, созданные,
+    пока контроллер не работал, закрытый или упавший поток перезапускается;
+  - на ADDED/MODIFIED известной IPAM ноды: Node.spec.podCIDR(s) патчится, если
+    пуст (потом он неизменяем), CiliumNode.spec.ipam.podCIDRs — всякий раз,
+    когда отличается от хранилища, неподтверждённая аренда подтверждается;
+  - sync(names) вызывается из /register сразу после маркировки: нода входит в
+    кластер до регистрации, и её событие ADDED пришло, когда CIDR ещё не было.
+
+Usage / Использование:
+    python3 cluster/ipam_cilium/controller.py [--kubeconfig PATH]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+from cluster.ipam_cilium.store import pod_cidrs
+from cluster.ipam_cilium.reconcile import KUBECONFIG_PATH, item_pod_cidrs, kubectl, patch_pod_cidrs
+
+# ресурс kubectl → kind объекта
+RESOURCES = {"nodes": "Node", "ciliumnodes.cilium.io": "CiliumNode"}
+
+# пауза перед перезапуском оборвавшегося watch (например, CRD Cilium ещё не установлен)
+RESTART_DELAY_SEC = 10
+
+
+def json_stream(lines):
+    """
+    Decode a stream of pretty-printed JSON documents (kubectl -o json --watch).
+    kubectl indents nested lines, so a document can only end on a bare "}".
+
+    Декодировать поток форматированных JSON-документов (kubectl -o json --watch).
+    kubectl делает отступы во вложенных строках, поэтому документ может
+    закончиться только на строке "}".
+    """
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if line.rstrip() != "}":
+            continue
+        try:
+            doc = json.loads("".join(buf))
+        except ValueError:
+            continue
+        buf = []
+        yield doc
+
+
+class NodeController:
+    """
+    Watches Nodes and CiliumNodes and patches their podCIDRs from a Mapper.
+
+    Следит за Node и CiliumNode и патчит их podCIDRs по данным Mapper.
+    """
+
+    def __init__(self, mapper, kubeconfig: str = KUBECONFIG_PATH):
+        self.mapper = mapper
+        self.kubeconfig = kubeconfig
+        self._reported = set()
+
+    def start(self) -> None:
+        """
+        Start one daemon watch thread per resource.
+
+        Запустить по одному daemon-потоку watch на ресурс.
+        """
+        for resource, kind in RESOURCES.items():
+            threading.Thread(target=self._watch, args=(resource, kind), daemon=True,
+                             name=f"ipam-watch-{kind.lower()}").start()
+        log(f"Контроллер IPAM следит за {', '.join(RESOURCES.values())}", "info")
+
+    def _watch(self, resource: str, kind: str) -> None:
+        cmd = ["kubectl", "--kubeconfig", self.kubeconfig, "get", resource,
+               "--watch", "--output-watch-events", "-o", "json"]
+        failures = 0
+        while True:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            events = 0
+            for event in json_stream(proc.stdout):
+                events += 1
+                try:
+                    self.handle(kind, event.get("type"), event.get("object") or {})
+                except Exception as e:
+                    log(f"Ошибка обработки события {kind}: {e}", "error")
+            stderr = proc.stderr.read().strip()
+            proc.wait()
+
+            if proc.returncode == 0 and events:
+                # сервер штатно закрыл watch по таймауту — переподключаемся сразу
+                failures = 0
+                continue
+            failures = 0 if events else failures + 1
+            # не засоряем журнал, пока ресурс недоступен (CRD Cilium ещё не установлен)
+            if failures <= 1:
+                log(f"Watch {kind} завершён (код {proc.returncode}){': ' + stderr if stderr else ''}, "
+                    f"перезапуск через {RESTART_DELAY_SEC} с", "warn")
+            time.sleep(RESTART_DELAY_SEC)
+
+    def handle(self, kind: str, event_type: str, item: dict) -> str | None:
+        """
+        Apply the store's CIDRs to one Node/CiliumNode object. Returns the action
+        taken ("patch", "conflict") or None when nothing had to be done.
+
+        Применить CIDR из хранилища к одному объекту Node/CiliumNode. Возвращает
+        выполненное действие ("patch", "conflict") или None, если делать нечего.
+        """
+        if event_type not in ("ADDED", "MODIFIED"):
+            return None
+        name = item["metadata"]["name"]
+        entry = self.mapper.lookup(name) or self.mapper.store.get(name)
+        if entry is None:
+            return None
+        if kind == "Node" and "lease_expires" in entry:
+            self.mapper.confirm([name])
+
+        want, have = pod_cidrs(entry), item_pod_cidrs({**item, "kind": kind})
+        if sorted(have) == sorted(want):
+            self._reported.discard((kind, name))
+            return None
+        if kind == "Node" and have:
+            # spec.podCIDR у Node неизменяем — сообщаем один раз, чинить через перерегистрацию
+            if (kind, name) not in self._reported:
+                self._reported.add((kind, name))
+                log(f"Node {name}: podCIDRs {have} не совпадают с IPAM {want}", "error")
+            return "conflict"
+        return "patch" if patch_pod_cidrs(name, kind, want, self.kubeconfig) else None
+
+    def sync(self, names: list) -> None:
+        """
+        Fetch the given Nodes once and apply their CIDRs (after registration).
+
+        Один раз прочитать указанные Node и применить их CIDR (после регистрации).
+        """
+        if not names:
+            return
+        result = kubectl(["get", "nodes", *names, "-o", "json"], self.kubeconfig)
+        if result.returncode != 0:
+            log(f"Не все ноды найдены при синхронизации CIDR: {result.stderr.strip()}", "warn")
+        if not result.stdout.strip():
+            return
+        data = json.loads(result.stdout)
+        for item in data.get("items", [data]):
+            self.handle("Node", "ADDED", item)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch Nodes/CiliumNodes and patch podCIDRs from IPAM")
+    parser.add_argument("--kubeconfig", default=KUBECONFIG_PATH, help="kubeconfig for kubectl")
+    args = parser.parse_args()
+
+    from cluster.ipam_cilium.mapper import Mapper
+
+    NodeController(Mapper(), args.kubeconfig).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,71 +6,104 @@ Mapper module for assigning and removing static CIDR blocks for Kubernetes nodes
 Поддерживает два режима:
   - register (назначить CIDR)
   - delete (удалить ноду из карты)
+
+Класс Mapper — тот же аллокатор в виде объекта для долгоживущих процессов
+(cps_service держит его в памяти): параметры пулов читаются один раз,
+записи кэшируются, изменения сохраняются через хранилище. Кэш сверяется с
+поколением хранилища и перечитывается, если записи менял другой процесс
+(другой воркер cps_service или CLI mapper.py).
+
+Записи хранятся в IpamStore (store.py, SQLite WAL): register/delete — одна
+транзакция на несколько строк, безопасная для параллельных вызовов; свободные
+подсети ведёт SubnetAllocator (allocator.py). JSON-карты control_plane_map.json
+и worker_map.json остаются как экспорт: control-plane карта выгружается при
+каждом изменении, полная выгрузка — `--action export`.
+
+Размер подсети на ноду задаётся классами из data/conf/ipam_classes.yaml и
+выбирается по фактам ноды (ядра, память, max_pods, явный класс), присланным
+при регистрации; блоки разных размеров делят один пул роли.
+
+Dual-stack: если в collected_info.py задан CLUSTER_POD_CIDR_V6, каждой ноде
+вместе с IPv4 выдаётся IPv6-подсеть длины CIDR_V6 из общего пула (`cidr_v6`).
 """
 
 import argparse
 import json
+import operator
 import sys
-import os
-import ipaddress
-from ipaddress import IPv4Network
+import threading
+from ipaddress import IPv4Network, ip_network
 from pathlib import Path
 
+import yaml
+
 # Добавляем корень проекта
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
 
 from utils.logger import log
+from utils.metrics import counter
+from cluster.ipam_cilium.allocator import SubnetAllocator
+from cluster.ipam_cilium.store import IPV6_POOL, IpamStore, pod_cidrs
 
-# Базовая директория карт
-MAPS_DIR = Path("cluster/ipam_cilium/maps")
+# Базовая директория карт (абсолютная — модуль импортируется и из cps_service)
+MAPS_DIR = PROJECT_ROOT / "cluster" / "ipam_cilium" / "maps"
 MAPS_DIR.mkdir(parents=True, exist_ok=True)
 
 # Пути до JSON файлов карт
 CONTROL_MAP = MAPS_DIR / "control_plane_map.json"
 WORKER_MAP = MAPS_DIR / "worker_map.json"
-COLLECTED_INFO = Path("data/collected_info.py")
-
-
-def ensure_map_file(path: Path):
+MAP_FILES = {"control-plane": CONTROL_MAP, "worker": WORKER_MAP}
+DB_PATH = MAPS_DIR / "ipam.db"
+COLLECTED_INFO = PROJECT_ROOT / "data" / "collected_info.py"
+CLASSES_FILE = PROJECT_ROOT / "data" / "conf" / "ipam_classes.yaml"
+
+# Блок control-plane в начале кластерного CIDR; воркерам он не выдаётся
+CONTROL_PLANE_POOL = "10.244.0.0/24"
+
+# Классы по умолчанию — прежние фиксированные размеры (/26 control-plane, /24 worker)
+DEFAULT_CLASSES = {
+    "control-plane": {"default": "standard", "classes": {"standard": {"prefix": 26}}},
+    "worker": {"default": "standard", "classes": {"standard": {"prefix": 24}}},
+}
+# ограничение класса → (факт ноды, условие «факт <op> порог»)
+FACT_LIMITS = {
+    "min_cores": ("cores", operator.ge),
+    "max_cores": ("cores", operator.le),
+    "min_memory_gb": ("memory_gb", operator.ge),
+    "max_memory_gb": ("memory_gb", operator.le),
+}
+
+# метрики Mapper (отдаются через /metrics в cps_service)
+ALLOCATIONS = counter("ipam_allocations_total", "CIDRs allocated to new nodes", ("role", "size_class"))
+RELEASES = counter("ipam_releases_total", "CIDRs returned to the pool", ("role", "reason"))
+
+_STORE = None
+
+
+def get_store() -> IpamStore:
     """
-    Ensure the map file exists, create empty if missing
-    Гарантирует наличие карты, создаёт пустую если её нет
-    """
-    if not path.exists():
-        log(f"Карта {path.name} отсутствует – создаём новую", "warn")
-        path.write_text("{}")
-
+    Open the IPAM store (created on first use, legacy JSON maps are imported once)
 
-def load_map(path: Path) -> dict:
+    Открывает хранилище IPAM (создаётся при первом обращении, старые JSON-карты импортируются один раз)
     """
-    Load JSON map from file, ensure it exists
+    global _STORE
+    if _STORE is None:
+        _STORE = IpamStore(DB_PATH, legacy_maps={"control-plane": CONTROL_MAP, "worker": WORKER_MAP})
+    return _STORE
 
-    Загружает JSON-карту из файла, гарантирует её существование
-    """
-    ensure_map_file(path)
-    try:
-        return json.loads(path.read_text())
-    except Exception as e:
-        log(f"Ошибка чтения карты {path.name}: {e}", "error")
-        # если повреждена – пересоздаём
-        path.write_text("{}")
-        return {}
 
-
-def save_map(path: Path, data: dict) -> None:
+def export_maps(roles=("control-plane", "worker")) -> None:
     """
-    Save JSON map to file in sorted order by CIDR
+    Export JSON maps from the store for compatibility (patcher.py --cpb reads control_plane_map.json)
 
-    Сохраняет JSON-карту в файл с сортировкой по CIDR
+    Выгружает JSON-карты из хранилища для совместимости (patcher.py --cpb читает control_plane_map.json)
     """
-    # сортируем по IPv4Network(data[n]["cidr"])
-    sorted_items = sorted(
-        data.items(),
-        key=lambda x: ipaddress.IPv4Network(x[1]["cidr"]).network_address
-    )
-    sorted_data = {k: v for k, v in sorted_items}
-
-    path.write_text(json.dumps(sorted_data, indent=4))
+    store = get_store()
+    for role in roles:
+        path = MAP_FILES[role]
+        count = store.export_json(role, path)
+        log(f"Карта {path.name} выгружена ({count} записей)", "info")
 
 
 def extract_info_from_py() -> tuple[str, str, str, str]:
@@ -89,6 +122,32 @@ def extract_info_from_py() -> tuple[str, str, str, str]:
     )
 
 
+def extract_facts_from_py() -> dict:
+    """
+    Extract size-class facts of the local node from collected_info.py
+
+    Извлекает факты локальной ноды для выбора класса размера из collected_info.py
+    """
+    namespace = {}
+    exec(COLLECTED_INFO.read_text(), namespace)
+    facts = {"cores": namespace.get("CORES"), "memory_gb": namespace.get("MEMORY_GB"),
+             "class": namespace.get("POD_CIDR_CLASS")}
+    return normalize_facts({k: v for k, v in facts.items() if v})
+
+
+def normalize_facts(facts: dict | None) -> dict:
+    """
+    Coerce node facts to numbers (collected_info and JSON may carry strings); ValueError if malformed
+
+    Приводит факты ноды к числам (в collected_info и JSON они могут быть строками); ValueError при ошибке
+    """
+    casts = {"cores": int, "memory_gb": float, "max_pods": int, "class": str}
+    try:
+        return {k: casts[k](v) for k, v in (facts or {}).items() if k in casts and v not in (None, "")}
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid node facts: {facts}")
+
+
 def get_cluster_pod_cidr() -> IPv4Network:
     """
     Get cluster-wide Pod CIDR from collected_info.py
@@ -103,134 +162,493 @@ def get_cluster_pod_cidr() -> IPv4Network:
     return IPv4Network(cidr)
 
 
-def find_next_subnet(base: IPv4Network, used: set[str], mask: int, role: str) -> tuple[str, str]:
+def pool_v6() -> tuple[str, int, int] | None:
     """
-    Find next unused subnet in base network and return its CIDR and clasterip
+    Return the shared IPv6 pool (CIDR, per-node prefix, skip) or None if dual-stack is off
 
-    Находит следующую неиспользуемую подсеть в базовой сети
-    и возвращает её CIDR и clasterip
+    Возвращает общий IPv6-пул (CIDR, префикс на ноду, skip) или None, если dual-stack выключен
     """
-    available = list(base.subnets(new_prefix=mask))
+    namespace = {}
+    exec(COLLECTED_INFO.read_text(), namespace)
+    cidr = namespace.get("CLUSTER_POD_CIDR_V6")
+    if not cidr:
+        return None
+    return cidr, int(namespace.get("CIDR_V6") or 64), 0
 
-    # Если worker – пропускаем первый блок (10.244.0.0/24)
-    if role == "worker" and available:
-        available = available[1:]
 
-    for subnet in available:
-        cidr = str(subnet)
-        if cidr in used:
-            continue
+def configured_pools() -> dict:
+    """
+    Collect pool parameters for every role plus the IPv6 pool; unavailable pools are skipped
 
-        clasterip = str(subnet.network_address)
-        return cidr, clasterip
+    Собирает параметры пулов всех ролей и IPv6-пула; недоступные пулы пропускаются
+    """
+    pools = {}
+    classes = load_classes()
+    for role in MAP_FILES:
+        try:
+            pools[role] = pool_for_role(role, classes)[1:]
+        except (OSError, ValueError) as e:
+            # без collected_info пул воркеров неизвестен — запись всё равно удалим
+            log(f"Пул {role} недоступен: {e}", "warn")
+    try:
+        v6 = pool_v6()
+    except OSError:
+        v6 = None
+    if v6:
+        pools[IPV6_POOL] = v6
+    return pools
 
-    raise RuntimeError("CIDR pool exhausted")
 
+def load_classes() -> dict:
+    """
+    Load per-role size classes from ipam_classes.yaml (defaults if the file is missing)
 
-def assign_cidr(role: str, nodename: str, globalip: str) -> dict:
+    Загружает классы размеров по ролям из ipam_classes.yaml (по умолчанию, если файла нет)
     """
-    Assign next free CIDR block to a node and update map
+    if not CLASSES_FILE.exists():
+        return DEFAULT_CLASSES
+    with CLASSES_FILE.open("r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    classes = {}
+    for role, default in DEFAULT_CLASSES.items():
+        spec = data.get(role) or default
+        if not spec.get("classes") or spec.get("default") not in spec["classes"]:
+            raise ValueError(f"{CLASSES_FILE.name}: role {role} needs classes and a default class")
+        # блок ноды должен помещаться в пул роли и быть не уже /32
+        widest = (ip_network(CONTROL_PLANE_POOL) if role == "control-plane" else get_cluster_pod_cidr()).prefixlen
+        for name, cls in spec["classes"].items():
+            prefix = cls.get("prefix")
+            if not isinstance(prefix, int) or not widest <= prefix <= 32:
+                raise ValueError(f"{CLASSES_FILE.name}: class {role}/{name} prefix {prefix!r} "
+                                 f"must be an integer between {widest} and 32")
+        classes[role] = spec
+    return classes
+
+
+def select_class(spec: dict, facts: dict | None) -> str:
+    """
+    Pick a size class from node facts: explicit class, then max_pods, then core/memory limits, then default
 
-    Назначает следующий CIDR блок ноде и обновляет карту
+    Выбирает класс размера по фактам ноды: явный класс, затем max_pods, затем ограничения по ядрам/памяти, затем default
     """
-    if role == "control-plane":
-        path = CONTROL_MAP
-        base = IPv4Network("10.244.0.0/24")  # вся /24 выделена под control-plane
-        mask = 26                            # каждой control-plane выдаём /26
-    elif role == "worker":
-        path = WORKER_MAP
-        cluster_base = get_cluster_pod_cidr()  # читаем из collected_info.py, например 10.244.0.0/16
-        mask = 24                              # воркеру выдаём отдельную /24
-        base = cluster_base
-    else:
+    classes, facts = spec["classes"], facts or {}
+    if facts.get("class") in classes:
+        return facts["class"]
+
+    if facts.get("max_pods"):
+        # рекомендация Kubernetes: адресов на ноде вдвое больше, чем подов
+        need = 2 * int(facts["max_pods"])
+        by_size = sorted(classes, key=lambda c: -classes[c]["prefix"])
+        fitting = [c for c in by_size if 2 ** (32 - classes[c]["prefix"]) >= need]
+        return fitting[0] if fitting else by_size[-1]
+
+    for name, cls in classes.items():
+        limits = [(fact, op, cls[key]) for key, (fact, op) in FACT_LIMITS.items() if key in cls]
+        if limits and all(facts.get(fact) is not None and op(facts[fact], limit)
+                          for fact, op, limit in limits):
+            return name
+    return spec["default"]
+
+
+def pool_for_role(role: str, classes: dict | None = None) -> tuple[Path, str, int, int]:
+    """
+    Return (map path, pool CIDR, allocation unit prefix, leading units to skip) for a role.
+    The unit is the longest prefix among the role's classes.
+
+    Возвращает (путь к карте, CIDR пула, префикс единицы аллокации, сколько первых единиц пропустить) для роли.
+    Единица — самый длинный префикс среди классов роли.
+    """
+    if role not in DEFAULT_CLASSES:
         raise ValueError(f"Unknown role: {role}")
+    spec = (classes or load_classes())[role]
+    unit = max(c["prefix"] for c in spec["classes"].values())
+    if role == "control-plane":
+        # вся /24 выделена под control-plane, каждой control-plane по умолчанию выдаём /26
+        return CONTROL_MAP, CONTROL_PLANE_POOL, unit, 0
+    # читаем из collected_info.py, например 10.244.0.0/16; воркеру по умолчанию выдаём /24,
+    # блок control-plane (10.244.0.0/24) пропускаем
+    # сколько единиц занимает /24 control-plane: при единице шире /24 она лежит внутри единицы 0
+    control_prefix = ip_network(CONTROL_PLANE_POOL).prefixlen
+    skip = 2 ** (unit - control_prefix) if unit >= control_prefix else 1
+    return WORKER_MAP, str(get_cluster_pod_cidr()), unit, skip
 
-    # загружаем карту (создаётся если нет)
-    data = load_map(path)
 
-    # если нода уже есть – возвращаем старую запись
-    if nodename in data:
-        log(f"Нода {nodename} уже присутствует в карте {path.name}", "warn")
-        return data[nodename]
+def node_prefix(role: str, facts: dict | None, classes: dict | None = None) -> tuple[str, int]:
+    """
+    Return (class name, per-node prefix) for a node of `role` with the given facts
 
-    # собираем список уже занятых CIDR
-    used_cidrs = {entry["cidr"] for entry in data.values()}
+    Возвращает (имя класса, префикс на ноду) для ноды роли `role` с данными фактами
+    """
+    spec = (classes or load_classes())[role]
+    name = select_class(spec, normalize_facts(facts))
+    return name, spec["classes"][name]["prefix"]
 
-    # ищем следующую свободную
-    cidr, clasterip = find_next_subnet(base, used_cidrs, mask, role)
 
-    entry = {
-        "role": role,
-        "name": nodename,
-        "globalip": globalip,
-        "cidr": cidr,
-        "clasterip": clasterip
-    }
+def format_cidrs(entry: dict) -> str:
+    """
+    All pod CIDRs of an entry for log messages
 
-    # добавляем и сохраняем
-    data[nodename] = entry
-    save_map(path, data)
+    Все pod CIDR записи для сообщений лога
+    """
+    return ", ".join(pod_cidrs(entry))
+
+
+def assign_cidr(role: str, nodename: str, globalip: str, facts: dict | None = None) -> dict:
+    """
+    Assign a free CIDR block of the node's size class in a single store transaction
 
-    log(f"Добавлен узел {nodename} в карту {path.name} с CIDR {cidr}", "ok")
+    Назначает свободный CIDR блок класса ноды одной транзакцией хранилища
+    """
+    _, base, mask, skip = pool_for_role(role)
+    size_class, prefix = node_prefix(role, facts)
+
+    entry, created = get_store().assign(role, nodename, globalip, base, mask, skip,
+                                        v6_pool=pool_v6(), node_prefix=prefix)
+    if role == "control-plane":
+        # выгружаем и для существующей ноды: ей могла быть дописана IPv6-подсеть
+        export_maps(("control-plane",))
+    if not created:
+        # если нода уже есть – возвращаем старую запись
+        log(f"Нода {nodename} уже присутствует в IPAM ({format_cidrs(entry)})", "warn")
+        return entry
+
+    log(f"Добавлен узел {nodename} ({role}, класс {size_class}) с CIDR {format_cidrs(entry)}", "ok")
     return entry
 
 
 def delete_node_entry(nodename: str) -> bool:
     """
-    Delete a node from control-plane or worker map
+    Delete a node from the store and return its CIDR to the pool
 
-    Удаляет ноду из карты control-plane или worker
+    Удаляет ноду из хранилища и возвращает её CIDR в пул
     """
-    deleted = False
+    entry = get_store().release(nodename, configured_pools())
+    if entry is None:
+        log(f"Нода {nodename} не найдена в IPAM", "error")
+        return False
 
-    # пробуем удалить из control-plane карты
-    cp_data = load_map(CONTROL_MAP)
-    if nodename in cp_data:
-        del cp_data[nodename]
-        save_map(CONTROL_MAP, cp_data)
-        log(f"Нода {nodename} удалена из control_plane_map.json", "ok")
-        deleted = True
+    if entry["role"] == "control-plane":
+        export_maps(("control-plane",))
+    log(f"Нода {nodename} удалена из IPAM, CIDR {format_cidrs(entry)} освобождён", "ok")
+    return True
 
-    # пробуем удалить из worker карты
-    worker_data = load_map(WORKER_MAP)
-    if nodename in worker_data:
-        del worker_data[nodename]
-        save_map(WORKER_MAP, worker_data)
-        log(f"Нода {nodename} удалена из worker_map.json", "ok")
-        deleted = True
 
-    if not deleted:
-        log(f"Нода {nodename} не найдена ни в одной карте", "error")
+class Mapper:
+    """
+    In-memory IPAM allocator for long-running callers (cps_service).
+    Pool parameters are resolved once, entries are cached and every change
+    is persisted through the store; results are returned as dicts.
+    With `lease_ttl` (seconds) new assignments are leases that must be
+    confirmed once the Node exists, otherwise reclaim_expired() frees them.
+    The cache is reloaded whenever the store generation shows a change made
+    by another process, so several service processes can share one store.
+
+    IPAM-аллокатор в памяти для долгоживущих процессов (cps_service).
+    Параметры пулов вычисляются один раз, записи кэшируются, каждое
+    изменение сохраняется через хранилище; результаты возвращаются словарями.
+    С `lease_ttl` (секунды) новые выдачи — аренды, которые нужно подтвердить,
+    когда появится Node, иначе reclaim_expired() их освободит.
+    Кэш перечитывается, как только поколение хранилища показывает изменение
+    другим процессом, поэтому несколько процессов сервиса делят одно хранилище.
+    """
 
-    return deleted
+    def __init__(self, store: IpamStore | None = None, lease_ttl: float | None = None):
+        self.store = store or get_store()
+        self.lease_ttl = lease_ttl or None
+        self.classes = load_classes()
+        self.pools = configured_pools()
+        self._generation = self.store.generation()
+        self._entries = self.store.entries()
+        self._lock = threading.Lock()
+        self._check_units()
+        log(f"IPAM загружен: {len(self._entries)} записей, пулы: {', '.join(self.pools)}", "info")
+
+    def _check_units(self) -> None:
+        """
+        Reject classes that widen a pool's unit over CIDRs already assigned with a longer prefix (ValueError).
+
+        Отвергает классы, расширяющие единицу пула поверх уже выданных CIDR с более длинным префиксом (ValueError).
+        """
+        allocators = {role: SubnetAllocator(*self.pools[role]) for role in MAP_FILES if role in self.pools}
+        for name, entry in self._entries.items():
+            alloc = allocators.get(entry["role"])
+            if alloc is not None and alloc.is_longer(entry["cidr"]):
+                raise ValueError(f"{CLASSES_FILE.name}: unit /{alloc.prefix} of role {entry['role']} is wider "
+                                 f"than {entry['cidr']} of node {name}; keep a class with that prefix")
+
+    def lookup(self, name: str) -> dict | None:
+        """
+        Return the cached entry of a node, if any.
+
+        Вернуть запись ноды из кэша, если она есть.
+        """
+        self._refresh()
+        return self._entries.get(name)
+
+    def _refresh(self) -> None:
+        # хранилище менял другой процесс — кэш мог устареть
+        if self.store.generation() != self._generation:
+            self.reload()
+
+    def _advance(self) -> None:
+        # своя запись: если до неё кэш был актуален, он актуален и после (вызывать под self._lock)
+        written = self.store.last_write()
+        if written is not None and written[0] == self._generation:
+            self._generation = written[1]
+
+    def _cached(self, name: str, v6_pool: tuple | None) -> dict | None:
+        # из кэша можно отдать запись только если не нужно дозаполнить IPv6 или продлить аренду
+        cached = self._entries.get(name)
+        if cached is None or (v6_pool and not cached.get("cidr_v6")):
+            return None
+        if self.lease_ttl and "lease_expires" in cached:
+            return None
+        return cached
+
+    def register(self, role: str, name: str, globalip: str, facts: dict | None = None) -> dict:
+        """
+        Assign a CIDR sized by the node's class (or return the existing one).
+        Raises ValueError for an unknown role and RuntimeError when the pool is exhausted.
+
+        Выдать CIDR размера класса ноды (или вернуть уже выданный).
+        ValueError для неизвестной роли и RuntimeError, если пул исчерпан.
+        """
+        v6_pool = self.pools.get(IPV6_POOL)
+        self._refresh()
+        if (cached := self._cached(name, v6_pool)) is not None:
+            return cached
+        cached = self._entries.get(name)
+        if role not in MAP_FILES or role not in self.pools:
+            raise ValueError(f"Unknown role: {role}")
+
+        size_class, prefix = node_prefix(role, facts, self.classes)
+        entry, created = self.store.assign(role, name, globalip, *self.pools[role],
+                                           v6_pool=v6_pool, node_prefix=prefix, lease_ttl=self.lease_ttl)
+        with self._lock:
+            self._entries[name] = entry
+            self._advance()
+        if created:
+            ALLOCATIONS.inc(role=role, size_class=size_class)
+        if created or (cached is not None and cached.get("cidr_v6") != entry.get("cidr_v6")):
+            if role == "control-plane":
+                export_maps(("control-plane",))
+            log(f"Добавлен узел {name} ({role}, класс {size_class}) с CIDR {format_cidrs(entry)}", "ok")
+        return entry
+
+    def register_batch(self, nodes: list) -> list:
+        """
+        Assign CIDRs to many nodes ({"hostname", "ip", "role", "facts"}) in one
+        store transaction; already registered nodes are served from the cache.
+        All nodes are validated before anything is allocated (ValueError), and an
+        exhausted pool rolls back the whole batch (RuntimeError). Returns entries
+        in input order.
+
+        Выдать CIDR многим нодам ({"hostname", "ip", "role", "facts"}) одной
+        транзакцией хранилища; уже зарегистрированные берутся из кэша.
+        Все ноды проверяются до выдачи (ValueError), исчерпание пула откатывает
+        весь пакет (RuntimeError). Возвращает записи в порядке входа.
+        """
+        v6_pool = self.pools.get(IPV6_POOL)
+        self._refresh()
+        results, pending = [None] * len(nodes), []
+        for i, node in enumerate(nodes):
+            role, name = node["role"], node["hostname"]
+            if role not in MAP_FILES or role not in self.pools:
+                raise ValueError(f"Unknown role: {role} ({name})")
+            if (cached := self._cached(name, v6_pool)) is not None:
+                results[i] = cached
+                continue
+            size_class, prefix = node_prefix(role, node.get("facts"), self.classes)
+            pending.append((i, (role, name, node["ip"], prefix), size_class))
+
+        if not pending:
+            return results
+        pools = {role: self.pools[role] for role in MAP_FILES if role in self.pools}
+        assigned = self.store.assign_batch([req for _, req, _ in pending], pools, v6_pool, self.lease_ttl)
+
+        created = []
+        with self._lock:
+            self._advance()
+            for (i, _, size_class), (entry, is_new) in zip(pending, assigned):
+                results[i] = self._entries[entry["name"]] = entry
+                if is_new:
+                    created.append(entry)
+                    ALLOCATIONS.inc(role=entry["role"], size_class=size_class)
+        if any(results[i]["role"] == "control-plane" for i, _, _ in pending):
+            export_maps(("control-plane",))
+        log(f"Пакетная регистрация: {len(nodes)} нод, новых CIDR: {len(created)}", "ok")
+        return results
+
+    def reload(self) -> None:
+        """
+        Re-read all entries from the store (after changes made by other processes).
+
+        Перечитать все записи из хранилища (после изменений другими процессами).
+        """
+        generation = self.store.generation()
+        entries = self.store.entries()
+        with self._lock:
+            self._generation, self._entries = generation, entries
+
+    def adopt(self, entry: dict) -> bool:
+        """
+        Record an entry assigned outside IPAM, reserving its CIDRs. False if they are not free.
+
+        Записать запись, выданную мимо IPAM, зарезервировав её CIDR. False, если они заняты.
+        """
+        if entry.get("role") not in MAP_FILES or not self.store.adopt(entry, self.pools):
+            return False
+        with self._lock:
+            self._entries[entry["name"]] = entry
+            self._advance()
+        if entry["role"] == "control-plane":
+            export_maps(("control-plane",))
+        log(f"Нода {entry['name']} ({entry['role']}) взята в IPAM с CIDR {format_cidrs(entry)}", "ok")
+        return True
+
+    def pool_usage(self) -> dict:
+        """
+        {pool: (free units, total units)} of every configured pool.
+
+        {пул: (свободно единиц, всего единиц)} для каждого настроенного пула.
+        """
+        return self.store.pool_usage(self.pools)
+
+    def node_counts(self) -> dict:
+        """
+        Number of cached entries per role (every role in MAP_FILES is present).
+
+        Число записей кэша по ролям (все роли из MAP_FILES присутствуют).
+        """
+        self._refresh()
+        counts = dict.fromkeys(MAP_FILES, 0)
+        for entry in list(self._entries.values()):
+            counts[entry["role"]] = counts.get(entry["role"], 0) + 1
+        return counts
+
+    def pending_leases(self) -> dict:
+        """
+        Cached entries that are still unconfirmed leases, as {name: entry}.
+
+        Записи из кэша, которые всё ещё остаются неподтверждённой арендой, {имя: запись}.
+        """
+        self._refresh()
+        return {name: e for name, e in list(self._entries.items()) if "lease_expires" in e}
+
+    def confirm(self, names) -> list:
+        """
+        Confirm the leases of nodes whose Node object exists. Returns the confirmed names.
+
+        Подтвердить аренды нод, у которых появился объект Node. Возвращает подтверждённые имена.
+        """
+        confirmed = self.store.confirm(names)
+        with self._lock:
+            if confirmed:
+                self._advance()
+            for name in confirmed:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    self._entries[name] = {k: v for k, v in entry.items() if k != "lease_expires"}
+        if confirmed:
+            log(f"Аренда CIDR подтверждена: {', '.join(confirmed)}", "ok")
+        return confirmed
+
+    def reclaim_expired(self) -> list:
+        """
+        Free the CIDRs of leases that expired without a Node. Returns the removed entries.
+
+        Освободить CIDR аренд, истёкших без появления Node. Возвращает удалённые записи.
+        """
+        expired = self.store.release_expired(self.pools)
+        if not expired:
+            return expired
+        with self._lock:
+            self._advance()
+            for entry in expired:
+                self._entries.pop(entry["name"], None)
+        if any(e["role"] == "control-plane" for e in expired):
+            export_maps(("control-plane",))
+        for entry in expired:
+            RELEASES.inc(role=entry["role"], reason="lease_expired")
+            log(f"Аренда ноды {entry['name']} истекла, CIDR {format_cidrs(entry)} освобождён", "warn")
+        return expired
+
+    def delete(self, name: str) -> dict | None:
+        """
+        Release the node's CIDR. Returns the removed entry or None if unknown.
+
+        Освободить CIDR ноды. Возвращает удалённую запись или None, если ноды нет.
+        """
+        entry = self.store.release(name, self.pools)
+        with self._lock:
+            if entry is not None:
+                self._advance()
+            self._entries.pop(name, None)
+        if entry is not None:
+            RELEASES.inc(role=entry["role"], reason="delete")
+            if entry["role"] == "control-plane":
+                export_maps(("control-plane",))
+            log(f"Нода {name} удалена из IPAM, CIDR {format_cidrs(entry)} освобождён", "ok")
+        return entry
+
+    def delete_batch(self, names) -> list:
+        """
+        Release the CIDRs of many nodes in one transaction. Returns the removed entries.
+
+        Освободить CIDR многих нод одной транзакцией. Возвращает удалённые записи.
+        """
+        names = list(names)
+        entries = self.store.release_batch(names, self.pools)
+        with self._lock:
+            if entries:
+                self._advance()
+            for name in names:
+                self._entries.pop(name, None)
+        if any(e["role"] == "control-plane" for e in entries):
+            export_maps(("control-plane",))
+        for entry in entries:
+            RELEASES.inc(role=entry["role"], reason="delete")
+        if entries:
+            log(f"Из IPAM удалено нод: {len(entries)}, CIDR освобождены", "ok")
+        return entries
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage CIDR assignments for Kubernetes nodes")
 
-    parser.add_argument("--action", choices=["register", "delete"], required=True,
-                        help="Action to perform: register or delete")
+    parser.add_argument("--action", choices=["register", "delete", "export"], required=True,
+                        help="Action to perform: register, delete or export (write JSON maps)")
 
     parser.add_argument("--cpb", action="store_true",
                         help="Use collected_info.py to get node parameters")
     parser.add_argument("--name", help="Node hostname")
     parser.add_argument("--ip", help="Node global IP")
     parser.add_argument("--role", choices=["control-plane", "worker"], help="Node role")
+    parser.add_argument("--cores", type=int, help="Node CPU cores (size class selection)")
+    parser.add_argument("--memory-gb", type=float, help="Node memory in GiB (size class selection)")
+    parser.add_argument("--max-pods", type=int, help="Node maxPods (size class selection)")
+    parser.add_argument("--pod-class", help="Explicit size class from ipam_classes.yaml")
 
     args = parser.parse_args()
 
     if args.action == "register":
+        facts = {"cores": args.cores, "memory_gb": args.memory_gb,
+                 "max_pods": args.max_pods, "class": args.pod_class}
         if args.cpb:
             name, ip, role, cluster_cidr = extract_info_from_py()
+            facts = {**extract_facts_from_py(), **{k: v for k, v in facts.items() if v is not None}}
         else:
             if not (args.name and args.ip and args.role):
                 parser.error("Must provide --name, --ip and --role for register unless using --cpb")
             name, ip, role = args.name, args.ip, args.role
 
-        result = assign_cidr(role, name, ip)
+        result = assign_cidr(role, name, ip, {k: v for k, v in facts.items() if v is not None})
         print(json.dumps(result, indent=4))
 
     elif args.action == "delete":
         if not args.name:
             parser.error("Must provide --name for delete")
-        delete_node_entry(args.name)
\ No newline at end of file
+        delete_node_entry(args.name)
+
+    elif args.action == "export":
+        export_maps()
\ No newline at end of file
@@ -5,6 +5,11 @@
 
     Модуль Patcher для обновления объекта CiliumNode.
     Поддерживает режимы --cpb (control-plane bootstrap), --w (worker mode) и внешний JSON-файл.
+
+    Dual-stack: if the entry has `cidr_v6`, both CIDRs go to Node.spec.podCIDRs
+    and CiliumNode.spec.ipam.podCIDRs (IPv4 first).
+    Dual-stack: если в записи есть `cidr_v6`, обе подсети попадают в
+    Node.spec.podCIDRs и CiliumNode.spec.ipam.podCIDRs (IPv4 первой).
 """
 
 import argparse
@@ -79,12 +84,21 @@ def run_kubectl(cmd: list, use_worker_config=False):
     return result
 
 
-def patch_node(name: str, cidr: str, worker_mode=False):
+def entry_cidrs(entry: dict) -> list:
+    """
+    Pod CIDRs of a map entry: IPv4 first, then IPv6 when allocated.
+    Pod CIDR записи карты: сначала IPv4, затем IPv6, если выдан.
+    """
+    return [entry["cidr"]] + ([entry["cidr_v6"]] if entry.get("cidr_v6") else [])
+
+
+def patch_node(name: str, cidrs: list, worker_mode=False):
     """
-    Patch Kubernetes node with given CIDR.
-    Пропатчить Kubernetes-ноду с указанным CIDR.
+    Patch Kubernetes node with given CIDRs (podCIDR is the first one).
+    Пропатчить Kubernetes-ноду с указанными CIDR (podCIDR — первый из них).
     """
-    patch_payload = f'{{"spec":{{"podCIDR":"{cidr}"}}}}'
+    cidr = ", ".join(cidrs)
+    patch_payload = json.dumps({"spec": {"podCIDR": cidrs[0], "podCIDRs": cidrs}})
     cmd = [
         "patch", "node", name,
         "--type=merge",
@@ -167,7 +181,7 @@ def wait_for_ciliumnode_resource(name: str, timeout_sec=DEFAULT_TIMEOUT_SEC, wor
         time.sleep(SLEEP_BETWEEN_TRIES_SEC)
 
 
-def patch_cilium_node(name: str, cidr: str, worker_mode=False, timeout_sec=DEFAULT_TIMEOUT_SEC):
+def patch_cilium_node(name: str, cidrs: list, worker_mode=False, timeout_sec=DEFAULT_TIMEOUT_SEC):
     """
     Patch CiliumNode object with podCIDRs via JSON patch.
     Пропатчить объект CiliumNode, добавив podCIDRs через JSON patch.
@@ -185,8 +199,9 @@ def patch_cilium_node(name: str, cidr: str, worker_mode=False, timeout_sec=DEFAU
     # 3) Патч с внутренними ретраями на случай гонок/404
     patch = json.dumps([
         {"op": "add", "path": "/spec/ipam", "value": {}},
-        {"op": "add", "path": "/spec/ipam/podCIDRs", "value": [cidr]}
+        {"op": "add", "path": "/spec/ipam/podCIDRs", "value": cidrs}
     ])
+    cidr = ", ".join(cidrs)
 
     deadline = time.time() + timeout_sec
     attempt = 0
@@ -239,10 +254,11 @@ if __name__ == "__main__":
             parser.error("Укажите --cpb, --w или --json <path>")
 
         # Сначала патчим обычную Node — это у тебя уже работало стабильно
-        patch_node(node_info["name"], node_info["cidr"], worker_mode=worker_mode)
+        cidrs = entry_cidrs(node_info)
+        patch_node(node_info["name"], cidrs, worker_mode=worker_mode)
 
         # Затем — CiliumNode с «умным» ожиданием CRD и ресурса
-        patch_cilium_node(node_info["name"], node_info["cidr"], worker_mode=worker_mode, timeout_sec=args.timeout)
+        patch_cilium_node(node_info["name"], cidrs, worker_mode=worker_mode, timeout_sec=args.timeout)
 
     except Exception as e:
         log(f"[PATCHER] Ошибка: {str(e)}", "error")
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+IPAM reconciliation against live cluster state.
+
+Сверка IPAM с реальным состоянием кластера.
+
+Nodes and CiliumNodes are listed in one paginated kubectl call
+(`--chunk-size`) and diffed against the IPAM store:
+  - leaks     — store entries without a Node (deleted without /delete);
+                repair releases their CIDRs;
+  - orphans   — Nodes with a podCIDR the store does not know; repair adopts
+                them into the store if the CIDRs are free;
+  - unpatched — Node/CiliumNode without podCIDRs; repair patches them;
+  - conflicts — podCIDRs that differ from the store or overlap another
+                node's allocation; CiliumNode is repaired by patching,
+                Node.spec.podCIDR is immutable and is only reported.
+Unconfirmed leases (store.py) without a Node are not leaks — the lease
+reclaimer in cps_service frees them on expiry; repair confirms leases whose
+Node already exists.
+
+Ноды и CiliumNode читаются одним постраничным вызовом kubectl
+(`--chunk-size`) и сравниваются с хранилищем IPAM:
+  - leaks     — записи без Node (удалены мимо /delete); repair освобождает CIDR;
+  - orphans   — Node с podCIDR, неизвестным хранилищу; repair забирает их в
+                хранилище, если CIDR свободны;
+  - unpatched — Node/CiliumNode без podCIDRs; repair патчит их;
+  - conflicts — podCIDRs, отличающиеся от хранилища или пересекающиеся с
+                чужой подсетью; CiliumNode чинится патчем, Node.spec.podCIDR
+                неизменяем и только попадает в отчёт.
+Неподтверждённые аренды (store.py) без Node — не утечки: их по истечении
+освобождает сборщик аренд в cps_service; repair подтверждает аренды, чья
+Node уже существует.
+
+Usage / Использование:
+    python3 cluster/ipam_cilium/reconcile.py [--repair] [--json]
+"""
+
+import argparse
+import bisect
+import ipaddress
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log
+from utils.metrics import histogram
+from cluster.ipam_cilium.store import pod_cidrs
+
+KUBECONFIG_PATH = "/etc/kubernetes/admin.conf"
+CHUNK_SIZE = 500
+CONTROL_PLANE_LABEL = "node-role.kubernetes.io/control-plane"
+KINDS = ("leaks", "orphans", "unpatched", "conflicts")
+
+KUBECTL_SECONDS = histogram("ipam_kubectl_duration_seconds", "kubectl call latency (kube API round trip)",
+                            ("verb", "result"))
+
+
+def kubectl(args: list, kubeconfig: str = KUBECONFIG_PATH) -> subprocess.CompletedProcess:
+    """
+    Run kubectl with text output, recording its latency by verb.
+
+    Выполнить kubectl с текстовым выводом, учитывая задержку по глаголу.
+    """
+    started = time.perf_counter()
+    result = subprocess.run(["kubectl", "--kubeconfig", kubeconfig] + args, capture_output=True, text=True)
+    KUBECTL_SECONDS.observe(time.perf_counter() - started, verb=args[0],
+                            result="ok" if result.returncode == 0 else "error")
+    return result
+
+
+def item_pod_cidrs(item: dict) -> list:
+    """
+    podCIDRs of a Node or CiliumNode object as returned by the API.
+
+    podCIDRs объекта Node или CiliumNode в том виде, как его вернул API.
+    """
+    spec = item.get("spec") or {}
+    if item.get("kind") == "CiliumNode":
+        return (spec.get("ipam") or {}).get("podCIDRs") or []
+    return spec.get("podCIDRs") or ([spec["podCIDR"]] if spec.get("podCIDR") else [])
+
+
+def list_cluster(kubeconfig: str = KUBECONFIG_PATH) -> tuple[dict, dict]:
+    """
+    List Nodes and CiliumNodes in one paginated pass.
+    Returns ({name: node facts}, {name: CiliumNode podCIDRs}).
+
+    Получить Node и CiliumNode за один постраничный проход.
+    Возвращает ({имя: факты ноды}, {имя: podCIDRs CiliumNode}).
+    """
+    args = ["get", "-o", "json", f"--chunk-size={CHUNK_SIZE}"]
+    result = kubectl(args + ["nodes,ciliumnodes.cilium.io"], kubeconfig)
+    if result.returncode != 0:
+        # CRD Cilium ещё не установлен — сверяем только Node
+        log(f"CiliumNode недоступны ({result.stderr.strip()}), сверяем только Node", "warn")
+        result = kubectl(args + ["nodes"], kubeconfig)
+        if result.returncode != 0:
+            raise RuntimeError(f"kubectl get nodes: {result.stderr.strip()}")
+
+    nodes, cilium_nodes = {}, {}
+    for item in json.loads(result.stdout).get("items", []):
+        name = item["metadata"]["name"]
+        if item.get("kind") == "CiliumNode":
+            cilium_nodes[name] = item_pod_cidrs(item)
+            continue
+        labels = item["metadata"].get("labels") or {}
+        addresses = (item.get("status") or {}).get("addresses") or []
+        nodes[name] = {
+            "role": "control-plane" if CONTROL_PLANE_LABEL in labels else "worker",
+            "globalip": next((a["address"] for a in addresses if a.get("type") == "InternalIP"), ""),
+            "podCIDRs": item_pod_cidrs(item),
+        }
+    return nodes, cilium_nodes
+
+
+class Allocations:
+    """
+    Sorted non-overlapping store CIDRs for O(log n) overlap lookups.
+
+    Отсортированные непересекающиеся CIDR хранилища для поиска пересечений за O(log n).
+    """
+
+    def __init__(self, entries: dict):
+        spans = []
+        for name, entry in entries.items():
+            for cidr in pod_cidrs(entry):
+                net = ipaddress.ip_network(cidr, strict=False)
+                spans.append(((net.version, int(net.network_address)), (net.version, int(net.broadcast_address)),
+                              name, cidr))
+        spans.sort()
+        self.spans = spans
+        self.ends = [s[1] for s in spans]
+
+    def owners(self, cidr: str) -> list:
+        """
+        (owner, cidr) of store allocations overlapping `cidr`.
+
+        (владелец, cidr) подсетей хранилища, пересекающихся с `cidr`.
+        """
+        net = ipaddress.ip_network(cidr, strict=False)
+        lo, hi = (net.version, int(net.network_address)), (net.version, int(net.broadcast_address))
+        found = []
+        for start, _, name, owned in self.spans[bisect.bisect_left(self.ends, lo):]:
+            if start > hi:
+                break
+            found.append((name, owned))
+        return found
+
+
+def diff_state(entries: dict, nodes: dict, cilium_nodes: dict) -> dict:
+    """
+    Compare store entries with cluster objects; returns {kind: [findings]} for KINDS
+    plus `leased` — names of unconfirmed leases whose Node exists.
+
+    Сравнить записи хранилища с объектами кластера; возвращает {вид: [находки]} для KINDS
+    и `leased` — имена неподтверждённых аренд, у которых уже есть Node.
+    """
+    report = {kind: [] for kind in KINDS}
+    report["leased"] = []
+    allocations = Allocations(entries)
+
+    for name, entry in entries.items():
+        want = pod_cidrs(entry)
+        if "lease_expires" in entry:
+            if name not in nodes:
+                # нода ещё не вошла в кластер — аренду освободит сборщик по истечении
+                continue
+            report["leased"].append(name)
+        if name not in nodes:
+            report["leaks"].append({"name": name, "role": entry["role"], "cidrs": want})
+            continue
+        observed = [("Node", nodes[name]["podCIDRs"])]
+        if name in cilium_nodes:
+            observed.append(("CiliumNode", cilium_nodes[name]))
+        for kind, have in observed:
+            if not have:
+                report["unpatched"].append({"name": name, "kind": kind, "want": want})
+            elif sorted(have) != sorted(want):
+                report["conflicts"].append({"name": name, "kind": kind, "have": have, "want": want})
+
+    for name, node in nodes.items():
+        if not node["podCIDRs"]:
+            continue
+        clashes = [{"cidr": cidr, "owner": owner, "owned": owned}
+                   for cidr in node["podCIDRs"] for owner, owned in allocations.owners(cidr) if owner != name]
+        if clashes:
+            report["conflicts"].append({"name": name, "kind": "overlap", "have": node["podCIDRs"],
+                                        "clashes": clashes})
+        elif name not in entries:
+            report["orphans"].append({"name": name, "role": node["role"], "globalip": node["globalip"],
+                                      "cidrs": node["podCIDRs"]})
+    return report
+
+
+def orphan_entry(orphan: dict) -> dict | None:
+    """
+    Build a store entry from an orphan Node (IPv4 and optional IPv6 CIDR), None if unusable.
+
+    Собрать запись хранилища по осиротевшей Node (IPv4 и опционально IPv6 CIDR), None если нельзя.
+    """
+    nets = [ipaddress.ip_network(c, strict=False) for c in orphan["cidrs"]]
+    v4 = [n for n in nets if n.version == 4]
+    v6 = [n for n in nets if n.version == 6]
+    if len(v4) != 1 or len(v6) > 1:
+        return None
+    entry = {"role": orphan["role"], "name": orphan["name"], "globalip": orphan["globalip"],
+             "cidr": str(v4[0]), "clasterip": str(v4[0].network_address)}
+    if v6:
+        entry.update({"cidr_v6": str(v6[0]), "clasterip_v6": str(v6[0].network_address)})
+    return entry
+
+
+def patch_pod_cidrs(name: str, kind: str, cidrs: list, kubeconfig: str = KUBECONFIG_PATH) -> bool:
+    """
+    Merge-patch podCIDRs of a Node or CiliumNode.
+
+    Merge-патч podCIDRs у Node или CiliumNode.
+    """
+    if kind == "Node":
+        resource, patch = "node", {"spec": {"podCIDR": cidrs[0], "podCIDRs": cidrs}}
+    else:
+        resource, patch = "ciliumnode", {"spec": {"ipam": {"podCIDRs": cidrs}}}
+    result = kubectl(["patch", resource, name, "--type=merge", "-p", json.dumps(patch)], kubeconfig)
+    if result.returncode != 0:
+        log(f"Ошибка патча {kind} {name}: {result.stderr.strip()}", "error")
+        return False
+    log(f"{kind} {name}: podCIDRs {', '.join(cidrs)}", "ok")
+    return True
+
+
+class Reconciler:
+    """
+    Runs reconcile passes for a Mapper. A leak is released only after it has been
+    seen in more than `grace_passes` consecutive passes, so a node registered
+    just before its Node object appears is not freed by the periodic loop.
+
+    Выполняет проходы сверки для Mapper. Утечка освобождается, только если она
+    видна дольше `grace_passes` проходов подряд, чтобы периодический цикл не
+    освободил ноду, зарегистрированную до появления её объекта Node.
+    """
+
+    def __init__(self, mapper, kubeconfig: str = KUBECONFIG_PATH, grace_passes: int = 0):
+        self.mapper = mapper
+        self.kubeconfig = kubeconfig
+        self.grace_passes = grace_passes
+        self._leak_seen = {}
+
+    def run(self, repair: bool = False) -> dict:
+        """
+        One reconcile pass; with `repair` fixes what can be fixed. Returns the report
+        with a `repaired` list of actions taken.
+
+        Один проход сверки; с `repair` исправляет то, что можно. Возвращает отчёт
+        со списком `repaired` выполненных действий.
+        """
+        nodes, cilium_nodes = list_cluster(self.kubeconfig)
+        self.mapper.reload()
+        report = diff_state(self.mapper.store.entries(), nodes, cilium_nodes)
+
+        leaked = {leak["name"] for leak in report["leaks"]}
+        self._leak_seen = {name: self._leak_seen.get(name, 0) + 1 for name in leaked}
+
+        report["repaired"] = []
+        if repair:
+            report["repaired"] = self._repair(report)
+
+        summary = ", ".join(f"{kind}: {len(report[kind])}" for kind in KINDS)
+        clean = not any(report[kind] for kind in KINDS)
+        log(f"Сверка IPAM ({len(nodes)} Node, {len(cilium_nodes)} CiliumNode): {summary}",
+            "ok" if clean else "warn")
+        return report
+
+    def _repair(self, report: dict) -> list:
+        done = [{"action": "confirm", "name": name} for name in self.mapper.confirm(report["leased"])]
+        for leak in report["leaks"]:
+            if self._leak_seen.get(leak["name"], 0) <= self.grace_passes:
+                log(f"Нода {leak['name']} пропала из кластера — освободим CIDR на следующем проходе", "info")
+                continue
+            if self.mapper.delete(leak["name"]) is not None:
+                self._leak_seen.pop(leak["name"], None)
+                done.append({"action": "release", "name": leak["name"], "cidrs": leak["cidrs"]})
+
+        for orphan in report["orphans"]:
+            entry = orphan_entry(orphan)
+            if entry is not None and self.mapper.adopt(entry):
+                done.append({"action": "adopt", "name": orphan["name"], "cidrs": orphan["cidrs"]})
+            else:
+                log(f"Нода {orphan['name']}: не удалось взять {orphan['cidrs']} в IPAM", "error")
+
+        for item in report["unpatched"]:
+            if patch_pod_cidrs(item["name"], item["kind"], item["want"], self.kubeconfig):
+                done.append({"action": "patch", "name": item["name"], "kind": item["kind"], "cidrs": item["want"]})
+
+        for item in report["conflicts"]:
+            if item["kind"] == "CiliumNode":
+                if patch_pod_cidrs(item["name"], item["kind"], item["want"], self.kubeconfig):
+                    done.append({"action": "patch", "name": item["name"], "kind": item["kind"],
+                                 "cidrs": item["want"]})
+            else:
+                # spec.podCIDR у Node неизменяем — нужна перерегистрация ноды
+                log(f"Конфликт {item['kind']} {item['name']}: {item['have']} — нужно удалить и "
+                    f"перерегистрировать ноду", "error")
+        return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile IPAM store with Nodes/CiliumNodes")
+    parser.add_argument("--repair", action="store_true",
+                        help="Release leaks, adopt orphans and patch missing/conflicting podCIDRs")
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON")
+    parser.add_argument("--kubeconfig", default=KUBECONFIG_PATH, help="kubeconfig for kubectl")
+    args = parser.parse_args()
+
+    from cluster.ipam_cilium.mapper import Mapper
+
+    try:
+        report = Reconciler(Mapper(), args.kubeconfig).run(repair=args.repair)
+    except RuntimeError as e:
+        log(f"Сверка IPAM не выполнена: {e}", "error")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for kind in KINDS:
+            for item in report[kind]:
+                log(f"[{kind}] {json.dumps(item, ensure_ascii=False)}", "warn")
+
+    repaired = {(a["name"], a.get("kind")) for a in report["repaired"]}
+    left = [i for k in KINDS for i in report[k] if (i["name"], i.get("kind")) not in repaired]
+    # ненулевой код — есть неисправленные расхождения (удобно для cron/алертов)
+    sys.exit(2 if left else 0)
+
+
+if __name__ == "__main__":
+    main()
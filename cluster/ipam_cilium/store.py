@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Transactional IPAM store (SQLite in WAL mode).
+
+Транзакционное хранилище IPAM (SQLite в режиме WAL).
+
+- One row per node in `nodes` (name, role, globalip, cidr, clasterip) and one
+  row per role in `pools` with the SubnetAllocator free-list, so register and
+  delete touch a constant number of rows instead of rewriting a JSON map.
+- Every mutation runs in `BEGIN IMMEDIATE`: the write lock is taken before the
+  free-list is read, so concurrent registrations (threads or separate mapper
+  processes) are serialised and cannot hand out the same CIDR.
+- Dual-stack: with an IPv6 pool configured every node also gets `cidr_v6`
+  from a single shared pool (`IPV6_POOL`), allocated in the same
+  transaction; nodes registered before IPv6 was enabled get it on their next
+  registration.
+- Leases: with `lease_ttl` a new entry is only leased until `lease_expires`
+  (epoch seconds) and becomes permanent on `confirm()` once its Node shows up;
+  `release_expired()` returns the subnets of leases that were never confirmed.
+- Every committed change bumps `generation` in `meta`, so a process caching
+  entries (Mapper) can tell cheaply whether another process changed the store.
+- On first open the legacy `control_plane_map.json` / `worker_map.json` are
+  imported; `export_json()` writes them back for compatibility.
+
+- Одна строка на ноду в `nodes` (name, role, globalip, cidr, clasterip) и одна
+  строка на роль в `pools` с free-list SubnetAllocator, поэтому register и
+  delete затрагивают постоянное число строк, а не переписывают JSON-карту.
+- Каждое изменение выполняется в `BEGIN IMMEDIATE`: блокировка на запись
+  берётся до чтения free-list, поэтому параллельные регистрации (потоки или
+  отдельные процессы mapper) сериализуются и не выдадут один CIDR дважды.
+- Dual-stack: если задан IPv6-пул, каждая нода в той же транзакции получает
+  ещё и `cidr_v6` из общего пула (`IPV6_POOL`); ноды, зарегистрированные до
+  включения IPv6, получают его при следующей регистрации.
+- Аренда: с `lease_ttl` новая запись лишь арендована до `lease_expires`
+  (секунды epoch) и закрепляется `confirm()`, когда появится её Node;
+  `release_expired()` возвращает подсети неподтверждённых аренд в пул.
+- Каждое зафиксированное изменение увеличивает `generation` в `meta`, поэтому
+  процесс с кэшем записей (Mapper) дёшево узнаёт, менял ли хранилище другой процесс.
+- При первом открытии импортируются старые `control_plane_map.json` /
+  `worker_map.json`; `export_json()` записывает их обратно для совместимости.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+import ipaddress
+from pathlib import Path
+from contextlib import contextmanager
+
+from cluster.ipam_cilium.allocator import SubnetAllocator
+
+BUSY_TIMEOUT_MS = 30000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    name      TEXT PRIMARY KEY,
+    role      TEXT NOT NULL,
+    globalip  TEXT NOT NULL,
+    cidr      TEXT NOT NULL UNIQUE,
+    clasterip TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_role ON nodes(role);
+
+CREATE TABLE IF NOT EXISTS pools (
+    role   TEXT PRIMARY KEY,
+    base   TEXT NOT NULL,
+    prefix INTEGER NOT NULL,
+    skip   INTEGER NOT NULL,
+    free   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+FIELDS = ("role", "name", "globalip", "cidr", "clasterip")
+V6_FIELDS = ("cidr_v6", "clasterip_v6")
+
+# Ключ общего IPv6-пула в таблице pools (все роли делят один префикс кластера)
+IPV6_POOL = "ipv6"
+
+
+def row_to_entry(row: sqlite3.Row) -> dict:
+    """
+    Node row as the JSON entry shape; IPv6 keys only when assigned,
+    `lease_expires` only while the entry is an unconfirmed lease.
+
+    Строка ноды в формате JSON-записи; IPv6-ключи только если подсеть выдана,
+    `lease_expires` — только пока запись остаётся неподтверждённой арендой.
+    """
+    entry = {k: row[k] for k in FIELDS}
+    if row["cidr_v6"]:
+        entry.update({k: row[k] for k in V6_FIELDS})
+    if row["lease_expires"] is not None:
+        entry["lease_expires"] = row["lease_expires"]
+    return entry
+
+
+def pod_cidrs(entry: dict) -> list:
+    """
+    All pod CIDRs of an entry: IPv4 first, then IPv6 when present.
+
+    Все pod CIDR записи: сначала IPv4, затем IPv6, если есть.
+    """
+    return [entry["cidr"]] + ([entry["cidr_v6"]] if entry.get("cidr_v6") else [])
+
+
+def cidr_sort_key(cidr: str) -> tuple[int, int]:
+    net = ipaddress.ip_network(cidr)
+    return net.version, int(net.network_address)
+
+
+class IpamStore:
+    """
+    SQLite-backed node → CIDR store with one connection per thread.
+
+    Хранилище нода → CIDR на SQLite с отдельным соединением на поток.
+    """
+
+    def __init__(self, db_path: Path, legacy_maps: dict | None = None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._init_schema(legacy_maps or {})
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None — транзакциями управляем сами через BEGIN IMMEDIATE
+            conn = sqlite3.connect(str(self.db_path), timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction holding the database write lock from the start.
+        If rows were changed, the store generation is bumped in the same transaction.
+
+        Транзакция на запись, удерживающая блокировку БД с самого начала.
+        Если строки изменились, поколение хранилища увеличивается в той же транзакции.
+        """
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        changes, self._local.last_write = db.total_changes, None
+        try:
+            yield db
+            if db.total_changes != changes:
+                generation = int(db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+                db.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (str(generation + 1),))
+                self._local.last_write = (generation, generation + 1)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _init_schema(self, legacy_maps: dict) -> None:
+        db = self._conn()
+        db.executescript(SCHEMA)
+        # миграция схемы: колонки IPv6 появились с поддержкой dual-stack
+        columns = {r["name"] for r in db.execute("PRAGMA table_info(nodes)")}
+        for column in V6_FIELDS:
+            if column not in columns:
+                db.execute(f"ALTER TABLE nodes ADD COLUMN {column} TEXT")
+        # NULL — запись подтверждена (в том числе все записи до появления аренды)
+        if "lease_expires" not in columns:
+            db.execute("ALTER TABLE nodes ADD COLUMN lease_expires REAL")
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS nodes_cidr_v6 ON nodes(cidr_v6)")
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('generation', '0')")
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                return
+            # разовый импорт старых JSON-карт
+            for path in legacy_maps.values():
+                path = Path(path)
+                if not path.exists():
+                    continue
+                try:
+                    data = json.loads(path.read_text() or "{}")
+                except ValueError:
+                    continue
+                for entry in data.values():
+                    if isinstance(entry, dict) and all(k in entry for k in FIELDS):
+                        self._insert(db, entry, ignore=True)
+            db.execute("INSERT INTO meta VALUES ('imported', '1')")
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, entry: dict, ignore: bool = False) -> None:
+        # конфликт имени или CIDR — IntegrityError и откат транзакции; пропускаем дубли только при импорте JSON
+        db.execute(f"INSERT {'OR IGNORE ' if ignore else ''}INTO nodes "
+                   "(name, role, globalip, cidr, clasterip, cidr_v6, clasterip_v6, lease_expires) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                   (entry["name"], entry["role"], entry["globalip"], entry["cidr"], entry["clasterip"],
+                    entry.get("cidr_v6"), entry.get("clasterip_v6"), entry.get("lease_expires")))
+
+    def _allocator(self, db: sqlite3.Connection, pool: str, base: str, prefix: int,
+                   skip: int) -> SubnetAllocator:
+        row = db.execute("SELECT * FROM pools WHERE role = ?", (pool,)).fetchone()
+        if row is not None:
+            alloc = SubnetAllocator.from_dict({**dict(row), "free": json.loads(row["free"])})
+            if alloc.matches(base, prefix, skip):
+                return alloc
+        # пула ещё нет или поменялись его параметры — пересобираем по выданным CIDR
+        if pool == IPV6_POOL:
+            rows = db.execute("SELECT cidr_v6 AS cidr FROM nodes WHERE cidr_v6 IS NOT NULL")
+        else:
+            rows = db.execute("SELECT cidr FROM nodes WHERE role = ?", (pool,))
+        return SubnetAllocator.from_used(base, prefix, (r["cidr"] for r in rows), skip)
+
+    @staticmethod
+    def _save_allocator(db: sqlite3.Connection, role: str, alloc: SubnetAllocator) -> None:
+        db.execute("INSERT OR REPLACE INTO pools VALUES (?, ?, ?, ?, ?)",
+                   (role, str(alloc.base), alloc.prefix, alloc.skip, json.dumps(alloc.free)))
+
+    def generation(self) -> int:
+        """
+        Counter of committed changes (by any process).
+
+        Счётчик зафиксированных изменений (любым процессом).
+        """
+        return int(self._conn().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+    def last_write(self) -> tuple[int, int] | None:
+        """
+        (generation before, generation after) of this thread's last changing transaction.
+
+        (поколение до, поколение после) последней изменившей данные транзакции этого потока.
+        """
+        return getattr(self._local, "last_write", None)
+
+    def get(self, name: str) -> dict | None:
+        row = self._conn().execute("SELECT * FROM nodes WHERE name = ?", (name,)).fetchone()
+        return row_to_entry(row) if row else None
+
+    def entries(self, role: str | None = None) -> dict:
+        """
+        All entries (optionally for one role) as {name: entry}.
+
+        Все записи (опционально для одной роли) в виде {имя: запись}.
+        """
+        db = self._conn()
+        rows = (db.execute("SELECT * FROM nodes WHERE role = ?", (role,)) if role
+                else db.execute("SELECT * FROM nodes"))
+        return {row["name"]: row_to_entry(row) for row in rows}
+
+    def assign(self, role: str, name: str, globalip: str, base: str, prefix: int,
+               skip: int = 0, v6_pool: tuple | None = None,
+               node_prefix: int | None = None, lease_ttl: float | None = None) -> tuple[dict, bool]:
+        """
+        Assign a free subnet of the pool to `name` atomically — a unit /`prefix`
+        or a /`node_prefix` block for the node's size class — plus an IPv6
+        subnet from `v6_pool` = (base, prefix, skip) when given.
+        Returns (entry, created); an existing entry is returned unchanged
+        except for a missing IPv6 subnet, which is filled in.
+        With `lease_ttl` (seconds) a new entry is leased, see assign_batch().
+
+        Атомарно выдать `name` свободную подсеть пула — единицу /`prefix` или
+        блок /`node_prefix` по классу ноды — и IPv6-подсеть из
+        `v6_pool` = (base, prefix, skip), если он задан.
+        Возвращает (запись, created); существующая запись не меняется, кроме
+        дозаполнения отсутствующей IPv6-подсети.
+        С `lease_ttl` (секунды) новая запись арендуется, см. assign_batch().
+        """
+        return self.assign_batch([(role, name, globalip, node_prefix)], {role: (base, prefix, skip)},
+                                 v6_pool, lease_ttl)[0]
+
+    def assign_batch(self, requests: list, pools: dict, v6_pool: tuple | None = None,
+                     lease_ttl: float | None = None) -> list:
+        """
+        Assign subnets to many nodes in one transaction. `requests` holds
+        (role, name, globalip, node_prefix) tuples, `pools` maps role →
+        (base, prefix, skip). Each pool's free-list is loaded and saved once;
+        if any pool runs out the whole batch is rolled back (RuntimeError).
+        Returns [(entry, created)] in request order, with `assign()` semantics.
+        With `lease_ttl` new entries are leased until now + lease_ttl and a
+        repeated registration of a still unconfirmed entry renews its lease;
+        confirmed entries are never turned back into leases.
+
+        Выдать подсети многим нодам одной транзакцией. `requests` — кортежи
+        (role, name, globalip, node_prefix), `pools` — роль → (base, prefix, skip).
+        Free-list каждого пула читается и сохраняется один раз; если какой-то
+        пул исчерпан, откатывается весь пакет (RuntimeError).
+        Возвращает [(запись, created)] в порядке запросов, как `assign()`.
+        С `lease_ttl` новые записи арендуются до now + lease_ttl, а повторная
+        регистрация ещё не подтверждённой записи продлевает аренду;
+        подтверждённые записи обратно в аренду не переводятся.
+        """
+        results, allocators = [], {}
+        expires = time.time() + lease_ttl if lease_ttl else None
+
+        def allocator(pool: str, params: tuple) -> SubnetAllocator:
+            if pool not in allocators:
+                allocators[pool] = self._allocator(db, pool, *params)
+            return allocators[pool]
+
+        with self.transaction() as db:
+            for role, name, globalip, node_prefix in requests:
+                row = db.execute("SELECT * FROM nodes WHERE name = ?", (name,)).fetchone()
+                created = row is None
+                if created:
+                    subnet = allocator(role, pools[role]).allocate(node_prefix)
+                    entry = {
+                        "role": role,
+                        "name": name,
+                        "globalip": globalip,
+                        "cidr": str(subnet),
+                        "clasterip": str(subnet.network_address),
+                    }
+                    if expires:
+                        entry["lease_expires"] = expires
+                    self._insert(db, entry)
+                else:
+                    entry = row_to_entry(row)
+                    if expires and "lease_expires" in entry:
+                        entry["lease_expires"] = expires
+                        db.execute("UPDATE nodes SET lease_expires = ? WHERE name = ?", (expires, name))
+
+                if v6_pool and not entry.get("cidr_v6"):
+                    subnet = allocator(IPV6_POOL, v6_pool).allocate()
+                    entry.update({"cidr_v6": str(subnet), "clasterip_v6": str(subnet.network_address)})
+                    db.execute("UPDATE nodes SET cidr_v6 = ?, clasterip_v6 = ? WHERE name = ?",
+                               (entry["cidr_v6"], entry["clasterip_v6"], name))
+                results.append((entry, created))
+
+            for pool, alloc in allocators.items():
+                self._save_allocator(db, pool, alloc)
+        return results
+
+    def adopt(self, entry: dict, pools: dict) -> bool:
+        """
+        Record an entry whose CIDRs were assigned outside the store (found in the
+        cluster by reconcile), reserving them in the pools. `pools` maps pool key →
+        (base, prefix, skip). Returns False if the name exists or a CIDR is not free.
+
+        Записать запись, чьи CIDR выданы мимо хранилища (найдены в кластере при
+        сверке), зарезервировав их в пулах. `pools` — ключ пула → (base, prefix, skip).
+        False, если имя уже есть или CIDR занят.
+        """
+        try:
+            with self.transaction() as db:
+                if db.execute("SELECT 1 FROM nodes WHERE name = ?", (entry["name"],)).fetchone():
+                    return False
+                reserved = []
+                for pool, cidr in ((entry["role"], entry["cidr"]), (IPV6_POOL, entry.get("cidr_v6"))):
+                    if not cidr:
+                        continue
+                    if pool not in pools:
+                        return False
+                    alloc = self._allocator(db, pool, *pools[pool])
+                    if not alloc.reserve(cidr):
+                        return False
+                    reserved.append((pool, alloc))
+                self._insert(db, entry)
+                for pool, alloc in reserved:
+                    self._save_allocator(db, pool, alloc)
+                return True
+        except sqlite3.IntegrityError:
+            # CIDR уже записан за другой нодой, хотя free-list считал его свободным — транзакция откачена
+            return False
+
+    def release(self, name: str, pools: dict) -> dict | None:
+        """
+        Delete `name` and return its subnets to the pool of its role (and IPV6_POOL).
+        `pools` maps pool key → (base, prefix, skip). Returns the removed entry or None.
+
+        Удалить `name` и вернуть подсети в пул её роли (и в IPV6_POOL).
+        `pools` — ключ пула → (base, prefix, skip). Возвращает удалённую запись или None.
+        """
+        with self.transaction() as db:
+            row = db.execute("SELECT * FROM nodes WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            entry = row_to_entry(row)
+            self._release_rows(db, [entry], pools)
+            return entry
+
+    def release_batch(self, names, pools: dict) -> list:
+        """
+        Delete every node of `names` in one transaction and return their subnets to
+        the pools (each free-list is read and saved once). Unknown names are skipped.
+        `pools` as in release(). Returns the removed entries.
+
+        Удалить все ноды из `names` одной транзакцией и вернуть их подсети в пулы
+        (каждый free-list читается и сохраняется один раз). Неизвестные имена
+        пропускаются. `pools` — как в release(). Возвращает удалённые записи.
+        """
+        with self.transaction() as db:
+            entries = []
+            for name in dict.fromkeys(names):
+                row = db.execute("SELECT * FROM nodes WHERE name = ?", (name,)).fetchone()
+                if row is not None:
+                    entries.append(row_to_entry(row))
+            self._release_rows(db, entries, pools)
+        return entries
+
+    def _release_rows(self, db: sqlite3.Connection, entries: list, pools: dict) -> None:
+        allocators = {}
+        for entry in entries:
+            db.execute("DELETE FROM nodes WHERE name = ?", (entry["name"],))
+            for pool, cidr in ((entry["role"], entry["cidr"]), (IPV6_POOL, entry.get("cidr_v6"))):
+                if cidr and pool in pools:
+                    if pool not in allocators:
+                        allocators[pool] = self._allocator(db, pool, *pools[pool])
+                    allocators[pool].release(cidr)
+        for pool, alloc in allocators.items():
+            self._save_allocator(db, pool, alloc)
+
+    def pool_usage(self, pools: dict) -> dict:
+        """
+        {pool: (free units, total units)} for every pool in `pools` (pool key → (base, prefix, skip)).
+        Read-only: a missing or outdated free-list is rebuilt in memory, not saved.
+
+        {пул: (свободно единиц, всего единиц)} для каждого пула из `pools` (ключ → (base, prefix, skip)).
+        Только чтение: отсутствующий или устаревший free-list пересобирается в памяти без сохранения.
+        """
+        db = self._conn()
+        usage = {}
+        for pool, params in pools.items():
+            alloc = self._allocator(db, pool, *params)
+            usage[pool] = (alloc.free_count, alloc.size - alloc.skip)
+        return usage
+
+    def leases(self) -> dict:
+        """
+        Unconfirmed (leased) entries as {name: entry}.
+
+        Неподтверждённые (арендованные) записи в виде {имя: запись}.
+        """
+        rows = self._conn().execute("SELECT * FROM nodes WHERE lease_expires IS NOT NULL")
+        return {row["name"]: row_to_entry(row) for row in rows}
+
+    def confirm(self, names) -> list:
+        """
+        Turn leases of `names` into permanent entries. Returns the names that were leased.
+
+        Закрепить аренды `names` как постоянные записи. Возвращает имена, которые были арендованы.
+        """
+        confirmed = []
+        with self.transaction() as db:
+            for name in names:
+                if db.execute("UPDATE nodes SET lease_expires = NULL "
+                              "WHERE name = ? AND lease_expires IS NOT NULL", (name,)).rowcount:
+                    confirmed.append(name)
+        return confirmed
+
+    def release_expired(self, pools: dict, now: float | None = None) -> list:
+        """
+        Delete every lease that expired by `now` and return its subnets to the pools
+        in one transaction. `pools` as in release(). Returns the removed entries.
+
+        Удалить все аренды, истёкшие к `now`, и вернуть их подсети в пулы одной
+        транзакцией. `pools` — как в release(). Возвращает удалённые записи.
+        """
+        now = time.time() if now is None else now
+        with self.transaction() as db:
+            rows = db.execute("SELECT * FROM nodes WHERE lease_expires IS NOT NULL AND lease_expires <= ?",
+                              (now,)).fetchall()
+            entries = [row_to_entry(row) for row in rows]
+            self._release_rows(db, entries, pools)
+        return entries
+
+    def export_json(self, role: str, path: Path) -> int:
+        """
+        Write the legacy JSON map for a role (sorted by CIDR) atomically. Returns entry count.
+
+        Атомарно записать старую JSON-карту роли (сортировка по CIDR). Возвращает число записей.
+        """
+        data = self.entries(role)
+        ordered = dict(sorted(data.items(), key=lambda x: cidr_sort_key(x[1]["cidr"])))
+        path = Path(path)
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(json.dumps(ordered, indent=4))
+        tmp.replace(path)
+        return len(ordered)
@@ -22,6 +22,12 @@ from jinja2 import Environment, FileSystemLoader
 
 OUTPUT_FILE = "data/collected_info.py"
 CLUSTER_POD_CIDR = "10.244.0.0/16"
+# IPv6 pod-префикс кластера (например fd00:10:244::/56); непустое значение включает dual-stack
+CLUSTER_POD_CIDR_V6 = os.environ.get("CLUSTER_POD_CIDR_V6", "")
+# Размер IPv6-подсети на ноду
+CIDR_V6 = "64"
+# Явный класс размера pod CIDR (data/conf/ipam_classes.yaml); пусто — выбор по ядрам/памяти
+POD_CIDR_CLASS = os.environ.get("POD_CIDR_CLASS", "")
 
 WRAPPER_PATH = "/opt/kuber-bootstrap/cluster/intake_services/ssh_wrapper.sh"
 RESTRICTED_CMD = f"/usr/bin/bash {WRAPPER_PATH}"
@@ -75,6 +81,36 @@ def get_ip():
         return "127.0.0.1"
 
 
+def get_ipv6():
+    """
+    Get the global IPv6 address via a dummy UDP connection (empty string if none).
+    Получает глобальный IPv6-адрес через фиктивное UDP-соединение (пустая строка, если его нет).
+    """
+    try:
+        s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        s.connect(("2001:4860:4860::8888", 80))
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except Exception:
+        return ""
+
+
+def get_memory_gb():
+    """
+    Get total memory in GiB from /proc/meminfo (0 if unavailable).
+    Получает общий объём памяти в ГиБ из /proc/meminfo (0, если недоступно).
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return round(int(line.split()[1]) / 1024 / 1024, 1)
+    except OSError:
+        pass
+    return 0
+
+
 def generate_token_string():
     """
     Generate a kubeadm-compatible bootstrap token.
@@ -289,7 +325,13 @@ def collect_info(role="control-plane"):
         "KERNEL": platform.release(),
         "ROLE": role,
         "CIDR": "24",
-        "CLUSTER_POD_CIDR": CLUSTER_POD_CIDR
+        "CLUSTER_POD_CIDR": CLUSTER_POD_CIDR,
+        "IPV6": get_ipv6(),
+        "CIDR_V6": CIDR_V6,
+        "CLUSTER_POD_CIDR_V6": CLUSTER_POD_CIDR_V6,
+        "CORES": str(os.cpu_count() or 1),
+        "MEMORY_GB": str(get_memory_gb()),
+        "POD_CIDR_CLASS": POD_CIDR_CLASS
     })
 
 
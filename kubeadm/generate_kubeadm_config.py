@@ -53,6 +53,7 @@ def generate_config():
     rendered = template.render(
         IP=collected_info.IP,
         CLUSTER_POD_CIDR=collected_info.CLUSTER_POD_CIDR,
+        CLUSTER_POD_CIDR_V6=getattr(collected_info, "CLUSTER_POD_CIDR_V6", ""),
     )
 
     OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
@@ -14,7 +14,9 @@ CONTROL_PLANE_STEPS = [
     ("Установка зависимостей", "setup/install_dependencies.py"),
     ("Проверка бинарников", "setup/check_binaries.py control-plane"),
     ("Установка недостающих бинарников", "setup/install_binaries.py"),
+    ("Запуск pull-through кэша реестров", "cluster/intake_services/init_services.py -rc"),
     ("Установка конифгурационного файла containered", "setup/install_containerd.py"),
+    ("Предзагрузка образов в containerd", "post/preload_images.py control-plane"),
     ("Генерация kubelet конфигурации", "kubelet/generate_kubelet_conf.py -cp"),
     ("Применение ограничений памяти для kubelet", "kubelet/manage_kubelet_config.py --mode memory"),
     ("Патч kubelet аргументов", "kubelet/manage_kubelet_config.py --mode bootstrap"),
@@ -39,7 +41,8 @@ CONTROL_PLANE_STEPS = [
     ("Установка CoreDNS и проверка компонентов", "post/initialize_coredns.py"),
     ("Назначение роли control-plane ноде", "post/label_node.py"),
     ("Сбор информации о ноде", "data/collect_node_info.py -cpb"),
-    ("Создание пользовтаеля cilium для воркер нод", "post/generate_cilium_sa.py")
+    ("Создание пользовтаеля cilium для воркер нод", "post/generate_cilium_sa.py"),
+    ("Запуск сервера артефактов для воркер-нод", "cluster/intake_services/init_services.py -as")
 ]
 
 # Очерёдность шагов установки для worker-ноды
@@ -48,8 +51,10 @@ WORKER_STEPS = [
     ("Сбор информации о ноде", "data/collect_node_info.py worker"),
     ("Установка зависимостей", "setup/install_dependencies.py"),
     ("Проверка бинарников", "setup/check_binaries.py worker"),
+    ("Загрузка недостающих артефактов с control-plane", "setup/fetch_artifacts.py worker"),
     ("Установка недостающих бинарников", "setup/install_binaries.py"),
     ("Установка корректного конфига для containerd", "setup/install_containerd.py"),
+    ("Предзагрузка образов в containerd", "post/preload_images.py worker"),
     ("Патч сети для возможности подключить ноду", "post/network_patch.py"),
     ("Генерация kubelet config", "kubelet/generate_kubelet_conf.py -w"),
     ("Установка systemd сервиса Kubelet.services из бинарника", "systemd/generate_kubelet_service.py"),
@@ -63,7 +68,6 @@ WORKER_STEPS = [
     ("Установка bpf файлов","post/install_bpf_files.py"),
     ("Настройка bpf маунтов для cilium-agent","post/verify_bpf_mount.py"),
     ("Создание cilium-agent systemd сервиса", "systemd/generate_cilium_service.py"),
-    ("ipam патч cilium-node","cluster/ipam_cilium/patcher.py --w"),
     ("Установка l7 прокси ка котдельного сервиса", "systemd/generate_envoy_service.py"),
 ]
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
-Generates cilium_values.yaml from template, pulls Cilium images and installs the Helm chart  
-Генерирует cilium_values.yaml из шаблона, загружает образы Cilium и устанавливает Helm-чарт
+Generates cilium_values.yaml from template, preloads Cilium images into containerd and installs the Helm chart  
+Генерирует cilium_values.yaml из шаблона, предзагружает образы Cilium в containerd и устанавливает Helm-чарт
 """
 
 import os
@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 
 from jinja2 import Template
 from utils.logger import log
+from post.preload_images import preload_images, tarball_name
 
 sys.path.append("data")
 import collected_info
@@ -60,6 +61,7 @@ def render_template(ca_crt: str):
     context = {
         "IP": collected_info.IP,
         "CLUSTER_POD_CIDR": collected_info.CLUSTER_POD_CIDR,
+        "CLUSTER_POD_CIDR_V6": getattr(collected_info, "CLUSTER_POD_CIDR_V6", ""),
         "OPERATOR_REPLICAS": 2,
         "ca_crt": ca_crt,
         "HOSTNAME": collected_info.HOSTNAME,
@@ -76,18 +78,15 @@ def render_template(ca_crt: str):
 
 def pull_images():
     """
-    Pulls required Docker images for Cilium and operator  
-    Загружает необходимые Docker-образы Cilium и оператора
+    Preloads Cilium and operator images into containerd (tarballs first, registry as fallback)  
+    Предзагружает образы Cilium и оператора в containerd (сначала тарболы, затем реестр)
     """
-    log("Загрузка Docker-образов Cilium...", level="info")
-
-    for image in IMAGES:
-        log(f"Загружается образ: {image}", level="info")
-        result = subprocess.run(["docker", "pull", image], capture_output=True, text=True)
-        if result.returncode != 0:
-            log(f"Ошибка при загрузке {image}:\n{result.stderr}", level="error")
-            sys.exit(1)
-        log(f"Образ загружен: {image}", level="ok")
+    log("Предзагрузка образов Cilium в containerd...", level="info")
+
+    images = [{"image": image, "tarball": tarball_name(image)} for image in IMAGES]
+    if not preload_images(images):
+        log("Не удалось предзагрузить образы Cilium", level="error")
+        sys.exit(1)
 
 
 def helm_install():
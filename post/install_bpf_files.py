@@ -27,6 +27,7 @@ from pathlib import Path
 # Добавляем utils.logger
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from utils.logger import log
+from utils.fileops import install_stream
 
 # Пути
 BPF_ARCHIVE = Path("/opt/kuber-bootstrap/binares/bpf.tar.gz")
@@ -142,10 +143,9 @@ def extract_missing_files():
         # Извлекаем только недостающие с нормализацией путей
         for m, relpath in missing:
             target_file = BPF_TARGET_DIR / relpath
-            target_file.parent.mkdir(parents=True, exist_ok=True)
             # извлекаем потоково, чтобы не тащить оригинальную структуру «как есть»
-            with tar.extractfile(m) as src, open(target_file, "wb") as dst:
-                dst.write(src.read())
+            with tar.extractfile(m) as src:
+                install_stream(src, target_file, mode=0o644)
             log(f"Добавлен файл: {relpath}", "ok")
 
 
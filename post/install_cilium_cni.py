@@ -14,6 +14,7 @@ from jinja2 import Template
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from utils.logger import log
+from utils.fileops import install_file
 
 # Пути
 ARCHIVE_PATH = Path("/opt/kuber-bootstrap/binares/cilium-cni.tar.gz")
@@ -66,10 +67,8 @@ def install_binary() -> bool:
         log(f"Бинарник не найден: {binary_path}", "error")
         return False
 
-    INSTALL_BIN_PATH.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(binary_path, INSTALL_BIN_PATH)
-    os.chmod(INSTALL_BIN_PATH, 0o755)
-    log(f"Бинарник установлен: {INSTALL_BIN_PATH}", "ok")
+    method = install_file(binary_path, INSTALL_BIN_PATH, mode=0o755)
+    log(f"Бинарник установлен: {INSTALL_BIN_PATH} ({method})", "ok")
     return True
 
 def cleanup() -> None:
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Preload container images into containerd (namespace k8s.io) before pods start.
+- Image list per role comes from `data/images.yaml`.
+- Images already present in containerd (by reference or by manifest digest
+  from the tarball's index.json) are skipped.
+- Remaining tarballs from `binares/images/` are imported in parallel via
+  `ctr -n k8s.io images import`.
+- If a tarball is missing or the import fails, the image is pulled from the
+  configured registry (`registry` in images.yaml or --registry) and tagged
+  with its original reference, so kubelet finds it without pulling. Pulls
+  go through the mirrors from `/etc/containerd/certs.d` when present.
+
+Предзагрузка образов в containerd (namespace k8s.io) до старта подов.
+- Список образов по ролям берётся из `data/images.yaml`.
+- Образы, уже присутствующие в containerd (по ссылке или по дайджесту
+  манифеста из index.json тарбола), пропускаются.
+- Оставшиеся тарболы из `binares/images/` импортируются параллельно через
+  `ctr -n k8s.io images import`.
+- Если тарбола нет или импорт упал, образ тянется из настроенного реестра
+  (`registry` в images.yaml или --registry) и тегируется исходным именем,
+  чтобы kubelet нашёл его без pull. Pull идёт через зеркала из
+  `/etc/containerd/certs.d`, если они настроены.
+"""
+
+import os
+import sys
+import json
+import tarfile
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.logger import log
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+IMAGES_FILE = PROJECT_ROOT / "data" / "images.yaml"
+IMAGES_DIR = PROJECT_ROOT / "binares" / "images"
+NAMESPACE = "k8s.io"
+HOSTS_DIR = Path("/etc/containerd/certs.d")
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def normalize_ref(ref: str) -> str:
+    """
+    Expand a short image reference the way containerd stores it
+    (debian:bookworm-slim -> docker.io/library/debian:bookworm-slim).
+
+    Развернуть короткую ссылку на образ так, как её хранит containerd
+    (debian:bookworm-slim -> docker.io/library/debian:bookworm-slim).
+    """
+    first = ref.split("/", 1)[0]
+    if "/" not in ref:
+        return f"docker.io/library/{ref}"
+    if "." not in first and ":" not in first and first != "localhost":
+        return f"docker.io/{ref}"
+    return ref
+
+
+def tarball_name(ref: str) -> str:
+    """
+    Default tarball file name for an image reference.
+    Имя тарбола по умолчанию для ссылки на образ.
+    """
+    return ref.replace("/", "_").replace(":", "_") + ".tar"
+
+
+def load_images(role: str) -> tuple[list, str]:
+    """
+    Load (images, registry) for a role from data/images.yaml.
+    Загрузить (образы, реестр) для роли из data/images.yaml.
+    """
+    if not IMAGES_FILE.exists():
+        log(f"Файл со списком образов не найден: {IMAGES_FILE}", "error")
+        return [], ""
+    with IMAGES_FILE.open("r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    images = [
+        {"image": e["image"], "tarball": e.get("tarball") or tarball_name(e["image"])}
+        for e in data.get(role, [])
+    ]
+    return images, data.get("registry") or ""
+
+
+def present_images() -> tuple[set, dict]:
+    """
+    Return (refs, {digest: ref}) of images already in containerd's k8s.io namespace.
+    Вернуть (ссылки, {дайджест: ссылка}) образов, уже имеющихся в namespace k8s.io.
+    """
+    result = subprocess.run(["ctr", "-n", NAMESPACE, "images", "ls"], capture_output=True, text=True)
+    if result.returncode != 0:
+        log(f"Не удалось получить список образов containerd: {result.stderr.strip()}", "warn")
+        return set(), {}
+
+    refs, digests = set(), {}
+    for line in result.stdout.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 3:
+            refs.add(parts[0])
+            digests.setdefault(parts[2], parts[0])
+    return refs, digests
+
+
+def tarball_digests(path: Path) -> set:
+    """
+    Read manifest digests from an OCI archive's index.json (empty for docker-save archives).
+    Прочитать дайджесты манифестов из index.json OCI-архива (пусто для docker save).
+    """
+    try:
+        with tarfile.open(path, "r:*") as tar:
+            member = tar.extractfile("index.json")
+            if member is None:
+                return set()
+            index = json.load(member)
+        return {m["digest"] for m in index.get("manifests", []) if "digest" in m}
+    except (KeyError, tarfile.TarError, json.JSONDecodeError, OSError):
+        return set()
+
+
+def import_tarball(path: Path) -> bool:
+    """
+    Import an image tarball into containerd's k8s.io namespace.
+    Импортировать тарбол образа в namespace k8s.io containerd.
+    """
+    result = subprocess.run(["ctr", "-n", NAMESPACE, "images", "import", str(path)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        log(f"Ошибка импорта {path.name}: {result.stderr.strip()}", "warn")
+        return False
+    return True
+
+
+def tag_image(source: str, ref: str) -> bool:
+    """
+    Tag the image `source` as `ref` (replacing an existing tag).
+    Протегировать образ `source` как `ref` (заменяя существующий тег).
+    """
+    result = subprocess.run(["ctr", "-n", NAMESPACE, "images", "tag", "--force", source, ref],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        log(f"Ошибка тега {source} -> {ref}: {result.stderr.strip()}", "warn")
+        return False
+    return True
+
+
+def pull_image(ref: str, registry: str) -> bool:
+    """
+    Pull `ref` (optionally through `registry`) and tag it with the original name.
+    Стянуть `ref` (опционально через `registry`) и протегировать исходным именем.
+    """
+    source = ref
+    if registry:
+        source = f"{registry.rstrip('/')}/{ref.split('/', 1)[1]}"
+
+    cmd = ["ctr", "-n", NAMESPACE, "images", "pull"]
+    if HOSTS_DIR.is_dir():
+        # ctr сам не читает hosts.toml — без флага pull прошёл бы мимо зеркал
+        cmd += ["--hosts-dir", str(HOSTS_DIR)]
+    result = subprocess.run(cmd + [source], capture_output=True, text=True)
+    if result.returncode != 0:
+        log(f"Ошибка pull {source}: {result.stderr.strip()}", "error")
+        return False
+
+    # без тега kubelet не найдёт образ под исходным именем
+    return source == ref or tag_image(source, ref)
+
+
+def preload_one(entry: dict, registry: str) -> str:
+    """
+    Import one image from its tarball, falling back to a registry pull.
+    Returns the method used ("import" or "pull"); raises on failure.
+
+    Импортировать один образ из тарбола, при неудаче — pull из реестра.
+    Возвращает использованный способ ("import" или "pull"); при ошибке — исключение.
+    """
+    ref = normalize_ref(entry["image"])
+    path = IMAGES_DIR / entry["tarball"]
+    if path.exists() and import_tarball(path):
+        return "import"
+    if pull_image(ref, registry):
+        return "pull"
+    raise RuntimeError(f"не удалось ни импортировать, ни стянуть {ref}")
+
+
+def preload_images(images: list, registry: str = "", workers: int = DEFAULT_WORKERS) -> bool:
+    """
+    Preload all missing images concurrently. Returns True if all are present afterwards.
+    Параллельно предзагрузить все недостающие образы. True, если в итоге все на месте.
+    """
+    refs, digests = present_images()
+    todo = []
+    for entry in images:
+        ref = normalize_ref(entry["image"])
+        if ref in refs:
+            log(f"Образ уже в containerd: {ref}", "ok")
+            continue
+        path = IMAGES_DIR / entry["tarball"]
+        known = [d for d in tarball_digests(path) if d in digests] if path.exists() else []
+        if known and tag_image(digests[known[0]], ref):
+            # тот же образ уже есть под другим именем — достаточно тега, импорт не нужен
+            log(f"Образ {ref} уже в containerd (совпал дайджест), добавлен тег", "ok")
+            continue
+        todo.append(entry)
+
+    if not todo:
+        log("Все образы уже предзагружены", "ok")
+        return True
+
+    log(f"Предзагрузка {len(todo)} образов (параллельно: {workers})...", "info")
+    ok = True
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(preload_one, e, registry): e["image"] for e in todo}
+        for fut in as_completed(futures):
+            image = futures[fut]
+            try:
+                method = fut.result()
+                log(f"Образ готов ({method}): {image}", "ok")
+            except Exception as e:
+                log(f"Ошибка предзагрузки {image}: {e}", "error")
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preload container images into containerd (k8s.io)")
+    parser.add_argument("role", choices=["control-plane", "worker"], help="Node role")
+    parser.add_argument("--registry", help="Fallback registry/mirror host (overrides images.yaml)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parallel imports")
+    parser.add_argument("--strict", action="store_true", help="Fail if any image could not be preloaded")
+    args = parser.parse_args()
+
+    images, registry = load_images(args.role)
+    if not images:
+        log(f"Для роли {args.role} образы не заданы — пропускаем", "warn")
+        return
+
+    if not preload_images(images, args.registry if args.registry is not None else registry, args.workers):
+        if args.strict:
+            sys.exit(1)
+        # не критично: kubelet дотянет недостающие образы сам при старте подов
+        log("Часть образов не предзагружена — они будут стянуты kubelet при старте подов", "warn")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Control-plane artifact server for worker nodes.
+- Serves the local artifact store (`binares/`) over HTTP or HTTPS.
+- `GET /manifest` returns {name: {"sha256", "size"}} for every served archive.
+- `GET /artifacts/<name>` streams a single archive (sendfile where possible)
+  with its digest in the `X-Checksum-Sha256` header.
+- Digests are cached in `binares/.digests.json` by (size, mtime) so restarts
+  do not rehash hundreds of megabytes; if `binares/SHA256SUMS` exists, every
+  artifact is verified against it and mismatching files are not served.
+
+Сервер артефактов control-plane для воркер-нод.
+- Раздаёт локальное хранилище артефактов (`binares/`) по HTTP или HTTPS.
+- `GET /manifest` возвращает {имя: {"sha256", "size"}} по каждому архиву.
+- `GET /artifacts/<имя>` отдаёт один архив (по возможности через sendfile)
+  с дайджестом в заголовке `X-Checksum-Sha256`.
+- Дайджесты кэшируются в `binares/.digests.json` по (size, mtime), чтобы
+  рестарт не пересчитывал сотни мегабайт; если есть `binares/SHA256SUMS`,
+  каждый артефакт сверяется с ним, несовпадающие файлы не раздаются.
+"""
+
+import os
+import sys
+import ssl
+import json
+import argparse
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Добавляем путь до корня проекта, чтобы работал import из utils
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log  # noqa: E402
+from utils.fileops import file_sha256  # noqa: E402
+
+ARTIFACTS_DIR = PROJECT_ROOT / "binares"
+DIGEST_CACHE_NAME = ".digests.json"
+CHECKSUMS_NAME = "SHA256SUMS"
+ARTIFACT_SUFFIXES = (".tar.gz", ".tgz")
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 5051
+
+
+def load_checksums(artifacts_dir: Path) -> dict:
+    """
+    Load expected digests from SHA256SUMS (sha256sum format), if present.
+
+    Загрузить ожидаемые дайджесты из SHA256SUMS (формат sha256sum), если файл есть.
+    """
+    path = artifacts_dir / CHECKSUMS_NAME
+    if not path.exists():
+        return {}
+
+    expected = {}
+    for line in path.read_text().splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            expected[parts[1].lstrip("*")] = parts[0].lower()
+    return expected
+
+
+def build_manifest(artifacts_dir: Path) -> dict:
+    """
+    Build the artifact manifest, reusing cached digests for unchanged files.
+    Files failing SHA256SUMS verification are logged and left out.
+
+    Построить манифест артефактов, переиспользуя кэш дайджестов для неизменных файлов.
+    Файлы, не прошедшие проверку по SHA256SUMS, логируются и исключаются.
+    """
+    cache_path = artifacts_dir / DIGEST_CACHE_NAME
+    try:
+        cache = json.loads(cache_path.read_text()) if cache_path.exists() else {}
+    except Exception:
+        cache = {}
+
+    expected = load_checksums(artifacts_dir)
+    manifest = {}
+    new_cache = {}
+
+    for path in sorted(artifacts_dir.iterdir()):
+        if not path.is_file() or not path.name.endswith(ARTIFACT_SUFFIXES):
+            continue
+
+        st = path.stat()
+        cached = cache.get(path.name)
+        if cached and cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+            digest = cached["sha256"]
+        else:
+            log(f"Вычисление sha256 для {path.name}...", "info")
+            digest = file_sha256(path)
+
+        new_cache[path.name] = {"sha256": digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+        if path.name in expected and expected[path.name] != digest:
+            log(f"Артефакт {path.name} не совпадает с {CHECKSUMS_NAME} — не раздаётся", "error")
+            continue
+
+        manifest[path.name] = {"sha256": digest, "size": st.st_size}
+
+    try:
+        cache_path.write_text(json.dumps(new_cache, indent=2))
+    except OSError as e:
+        log(f"Не удалось сохранить кэш дайджестов {cache_path}: {e}", "warn")
+
+    return manifest
+
+
+class ArtifactStore:
+    """
+    In-memory view of the artifact directory with a lazily refreshed manifest.
+
+    Представление директории артефактов в памяти с ленивым обновлением манифеста.
+    """
+
+    def __init__(self, artifacts_dir: Path):
+        self.dir = artifacts_dir
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._manifest = {}
+
+    def _dir_stamp(self) -> tuple:
+        return tuple(
+            (p.name, p.stat().st_size, p.stat().st_mtime_ns)
+            for p in sorted(self.dir.iterdir())
+            if p.is_file() and p.name.endswith(ARTIFACT_SUFFIXES + (CHECKSUMS_NAME,))
+        )
+
+    def manifest(self) -> dict:
+        """
+        Return the current manifest; rebuild it only if the directory changed.
+
+        Вернуть актуальный манифест; пересобирается только при изменении директории.
+        """
+        with self._lock:
+            stamp = self._dir_stamp()
+            if stamp != self._stamp:
+                self._manifest = build_manifest(self.dir)
+                self._stamp = stamp
+            return self._manifest
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler serving /manifest and /artifacts/<name>.
+
+    HTTP-обработчик для /manifest и /artifacts/<name>.
+    """
+
+    store: ArtifactStore = None
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, code: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/manifest":
+            self._send_json(200, self.store.manifest())
+            return
+
+        if not self.path.startswith("/artifacts/"):
+            self._send_json(404, {"detail": "Not found"})
+            return
+
+        # Раздаём только то, что есть в манифесте — никаких произвольных путей
+        name = self.path[len("/artifacts/"):]
+        entry = self.store.manifest().get(name)
+        if entry is None:
+            self._send_json(404, {"detail": f"Unknown artifact: {name}"})
+            return
+
+        path = self.store.dir / name
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(entry["size"]))
+            self.send_header("X-Checksum-Sha256", entry["sha256"])
+            self.end_headers()
+            self.wfile.flush()
+            # socket.sendfile сам откатывается на send() для TLS-сокетов
+            self.connection.sendfile(f)
+
+    def log_message(self, fmt, *args):
+        log(f"[artifacts] {self.client_address[0]} {fmt % args}", "info")
+
+
+def run_server(host: str, port: int, artifacts_dir: Path,
+               tls_cert: str | None = None, tls_key: str | None = None) -> None:
+    """
+    Start the threaded artifact server, optionally wrapped in TLS.
+
+    Запустить многопоточный сервер артефактов, опционально поверх TLS.
+    """
+    if not artifacts_dir.is_dir():
+        log(f"Директория артефактов не найдена: {artifacts_dir}", "error")
+        sys.exit(1)
+
+    ArtifactHandler.store = ArtifactStore(artifacts_dir)
+    manifest = ArtifactHandler.store.manifest()
+    log(f"Артефактов к раздаче: {len(manifest)}", "ok")
+
+    server = ThreadingHTTPServer((host, port), ArtifactHandler)
+    scheme = "http"
+    if tls_cert and tls_key:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(tls_cert, tls_key)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+
+    log(f"Сервер артефактов запущен на {scheme}://{host}:{port}", "info")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve binares/ artifacts to worker nodes")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Bind address (default {DEFAULT_HOST})")
+    parser.add_argument("--port", default=DEFAULT_PORT, type=int, help=f"Bind port (default {DEFAULT_PORT})")
+    parser.add_argument("--dir", default=str(ARTIFACTS_DIR), help="Artifact directory (default binares/)")
+    parser.add_argument("--tls-cert", help="TLS certificate (enables HTTPS)")
+    parser.add_argument("--tls-key", help="TLS private key")
+    args = parser.parse_args()
+
+    run_server(args.host, args.port, Path(args.dir), args.tls_cert, args.tls_key)
+
+
+if __name__ == "__main__":
+    main()
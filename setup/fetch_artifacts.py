@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fetch missing artifacts from the control-plane artifact server.
+- Reads `data/missing_binaries.json` (written by `check_binaries.py`) and the
+  per-role `artifacts` list from `data/required_binaries.yaml`.
+- Downloads only archives that are absent locally or whose sha256 differs
+  from the server manifest, several at a time.
+- All downloads share one token bucket, so the node never exceeds the
+  configured bandwidth cap (`--bandwidth-mbps` or ARTIFACT_BANDWIDTH_MBPS
+  in `data/join_info.json`; 0 = unlimited).
+- Every file is verified against the manifest digest before it is
+  atomically moved into `binares/`.
+
+Загрузка недостающих артефактов с сервера артефактов control-plane.
+- Читает `data/missing_binaries.json` (создаётся `check_binaries.py`) и список
+  `artifacts` для роли из `data/required_binaries.yaml`.
+- Скачивает только архивы, которых нет локально или чей sha256 расходится
+  с манифестом сервера, по несколько одновременно.
+- Все загрузки делят один token bucket, поэтому нода не превышает лимит
+  полосы (`--bandwidth-mbps` или ARTIFACT_BANDWIDTH_MBPS в
+  `data/join_info.json`; 0 — без ограничений).
+- Каждый файл сверяется с дайджестом из манифеста и только затем атомарно
+  переносится в `binares/`.
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+import threading
+import urllib.request
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+# Добавляем путь до корня проекта, чтобы работал import из utils
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log  # noqa: E402
+from utils.fileops import file_sha256  # noqa: E402
+
+ARTIFACTS_DIR = PROJECT_ROOT / "binares"
+MISSING_FILE = PROJECT_ROOT / "data" / "missing_binaries.json"
+REQUIRED_FILE = PROJECT_ROOT / "data" / "required_binaries.yaml"
+JOIN_INFO_FILE = PROJECT_ROOT / "data" / "join_info.json"
+
+DEFAULT_PORT = 5051
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 256 * 1024
+CNI_ARCHIVE_GLOB = "cni-plugins-linux-amd64-*.tgz"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all downloads of this node.
+
+    Потокобезопасный token bucket, общий для всех загрузок ноды.
+    """
+
+    def __init__(self, rate_bytes: float):
+        self.rate = rate_bytes
+        # ёмкость не меньше одного чанка, иначе при малом лимите consume() зависнет
+        self.capacity = max(rate_bytes, CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        """
+        Block until `amount` bytes may be transferred. No-op when unlimited.
+
+        Блокирует, пока не разрешена передача `amount` байт. Без лимита — no-op.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_join_info() -> dict:
+    """
+    Load data/join_info.json (CONTROL_PLANE_IP, optional ARTIFACT_* keys).
+
+    Загрузить data/join_info.json (CONTROL_PLANE_IP, опциональные ключи ARTIFACT_*).
+    """
+    if not JOIN_INFO_FILE.exists():
+        return {}
+    with open(JOIN_INFO_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def wanted_artifacts(role: str, manifest: dict) -> list:
+    """
+    Resolve artifact file names needed by this node: archives for binaries listed
+    in missing_binaries.json plus the role's `artifacts` list.
+
+    Определить имена нужных ноде архивов: архивы бинарников из missing_binaries.json
+    плюс список `artifacts` для роли.
+    """
+    names = []
+
+    if MISSING_FILE.exists():
+        with open(MISSING_FILE, "r", encoding="utf-8") as f:
+            missing = json.load(f).get("missing", [])
+        for binary in missing:
+            if binary == "cni-plugins":
+                matches = sorted(n for n in manifest if fnmatch.fnmatch(n, CNI_ARCHIVE_GLOB))
+                if matches:
+                    names.append(matches[-1])
+                else:
+                    log(f"На сервере нет архива CNI по шаблону {CNI_ARCHIVE_GLOB}", "warn")
+            else:
+                names.append(f"{binary}.tar.gz")
+
+    if REQUIRED_FILE.exists():
+        with REQUIRED_FILE.open("r", encoding="utf-8") as f:
+            required = yaml.safe_load(f) or {}
+        names.extend((required.get("artifacts") or {}).get(role, []))
+
+    # сохраняем порядок, убираем дубли
+    return list(dict.fromkeys(names))
+
+
+def needs_fetch(name: str, entry: dict) -> bool:
+    """
+    Return True if the local copy is absent or differs from the manifest entry.
+    Size is compared first so unchanged archives are hashed only when plausible.
+
+    Вернуть True, если локальной копии нет или она расходится с манифестом.
+    Сначала сравнивается размер, хэш считается только при совпадении размера.
+    """
+    local = ARTIFACTS_DIR / name
+    if not local.exists():
+        return True
+    if local.stat().st_size != entry["size"]:
+        return True
+    return file_sha256(local) != entry["sha256"]
+
+
+def fetch_one(base_url: str, name: str, entry: dict, bucket: TokenBucket,
+              ctx: ssl.SSLContext | None, timeout: int) -> None:
+    """
+    Download one artifact into a temp file, verify sha256 on the fly, then
+    atomically replace the target in binares/.
+
+    Скачать один артефакт во временный файл, проверяя sha256 на лету,
+    затем атомарно заменить целевой файл в binares/.
+    """
+    url = f"{base_url}/artifacts/{name}"
+    h = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=timeout, context=ctx) as resp, \
+            NamedTemporaryFile(dir=str(ARTIFACTS_DIR), prefix=f".{name}.", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+        try:
+            while True:
+                bucket.consume(CHUNK_SIZE)
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+                tmp.write(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    if h.hexdigest() != entry["sha256"]:
+        tmp_path.unlink(missing_ok=True)
+        raise ValueError(f"sha256 mismatch for {name}")
+
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, ARTIFACTS_DIR / name)
+
+
+def fetch_artifacts(role: str, host: str, port: int, scheme: str = "http", cafile: str | None = None,
+                    workers: int = DEFAULT_WORKERS, bandwidth_mbps: float = 0, timeout: int = 60) -> bool:
+    """
+    Fetch every missing artifact concurrently. Returns True if all succeeded.
+
+    Параллельно скачать все недостающие артефакты. Возвращает True при полном успехе.
+    """
+    base_url = f"{scheme}://{host}:{port}"
+    ctx = ssl.create_default_context(cafile=cafile) if scheme == "https" else None
+
+    try:
+        with urllib.request.urlopen(f"{base_url}/manifest", timeout=timeout, context=ctx) as resp:
+            manifest = json.load(resp)
+    except Exception as e:
+        # Сервера нет — остаёмся на локальной копии binares/, как раньше
+        log(f"Не удалось получить манифест артефактов с {base_url}: {e}. Используем локальный binares/", "warn")
+        return True
+
+    ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
+    todo = []
+    for name in wanted_artifacts(role, manifest):
+        entry = manifest.get(name)
+        if entry is None:
+            log(f"Артефакт {name} отсутствует на сервере", "warn")
+            continue
+        if needs_fetch(name, entry):
+            todo.append((name, entry))
+        else:
+            log(f"{name} уже актуален локально", "ok")
+
+    if not todo:
+        log("Все нужные артефакты уже на месте", "ok")
+        return True
+
+    total = sum(e["size"] for _, e in todo)
+    limit = f"{bandwidth_mbps} Мбит/с" if bandwidth_mbps > 0 else "без ограничения"
+    log(f"Загрузка {len(todo)} артефактов ({total / 1024 / 1024:.1f} МБ), лимит: {limit}", "info")
+
+    bucket = TokenBucket(bandwidth_mbps * 1_000_000 / 8)
+    ok = True
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fetch_one, base_url, n, e, bucket, ctx, timeout): n for n, e in todo}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                fut.result()
+                log(f"Артефакт загружен и проверен: {name}", "ok")
+            except Exception as e:
+                log(f"Ошибка загрузки {name}: {e}", "error")
+                ok = False
+    return ok
+
+
+def main() -> None:
+    join_info = load_join_info()
+
+    parser = argparse.ArgumentParser(description="Fetch missing artifacts from the control-plane artifact server")
+    parser.add_argument("role", nargs="?", default="worker", help="Node role (default worker)")
+    parser.add_argument("--host", default=join_info.get("CONTROL_PLANE_IP"),
+                        help="Artifact server host (default CONTROL_PLANE_IP from join_info.json)")
+    parser.add_argument("--port", type=int, default=int(join_info.get("ARTIFACT_PORT", DEFAULT_PORT)),
+                        help=f"Artifact server port (default {DEFAULT_PORT})")
+    parser.add_argument("--scheme", choices=["http", "https"], default=join_info.get("ARTIFACT_SCHEME", "http"))
+    parser.add_argument("--cafile", help="CA bundle to verify the server in https mode")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent downloads")
+    parser.add_argument("--bandwidth-mbps", type=float, default=float(join_info.get("ARTIFACT_BANDWIDTH_MBPS", 0)),
+                        help="Per-node bandwidth cap in Mbit/s (0 = unlimited)")
+    args = parser.parse_args()
+
+    if not args.host:
+        log("Не задан адрес сервера артефактов (--host или CONTROL_PLANE_IP в join_info.json)", "error")
+        sys.exit(1)
+
+    if not fetch_artifacts(args.role, args.host, args.port, args.scheme, args.cafile,
+                           args.workers, args.bandwidth_mbps):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
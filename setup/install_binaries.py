@@ -5,16 +5,20 @@
 Install missing CLI binaries from tar archives and (optionally) install CNI plugins.
 - Regular binaries: take "<name>.tar.gz" from "binares/" and place to /usr/local/bin
   (or /usr/bin for kubelet).
-- Special case "cilium": archive is unpacked to "binares/cilium", then moved to /usr/local/bin.
+- "cilium" CLI: the "cilium" file from "binares/cilium.tar.gz" goes to /usr/local/bin.
 - Special case "cni-plugins": pick "binares/cni-plugins-linux-amd64-*.tgz" and install
   every file inside to /opt/cni/bin with executable bit.
+- Tar members are streamed straight into the target (utils.fileops.install_stream):
+  no whole-file buffering in memory, atomic replace + fsync of the parent dir.
 
 Устанавливает недостающие CLI-бинарники из tar-архивов и (опционально) CNI-плагины.
 - Обычные бинарники: берём "<name>.tar.gz" из "binares/" и кладём в /usr/local/bin
   (или /usr/bin для kubelet).
-- Особый случай "cilium": распаковываем в "binares/cilium", затем переносим в /usr/local/bin.
+- cilium CLI: файл "cilium" из "binares/cilium.tar.gz" кладём в /usr/local/bin.
 - Особый случай "cni-plugins": находим "binares/cni-plugins-linux-amd64-*.tgz" и
   устанавливаем все файлы внутрь /opt/cni/bin с правами на исполнение.
+- Члены tar потоково пишутся прямо в цель (utils.fileops.install_stream):
+  без буферизации файла целиком в памяти, атомарная замена + fsync директории.
 """
 
 import os
@@ -22,39 +26,22 @@ import sys
 import json
 import tarfile
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 from typing import Optional
 
 # доступ к utils.logger
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from utils.logger import log  # noqa
+from utils.fileops import install_stream  # noqa
 
 MISSING_FILE = "data/missing_binaries.json"
 BINARIES_DIR = Path("binares")  # оставляю как в исходнике
 INSTALL_PATH = Path("/usr/local/bin")
-TMP_DIR = Path("/tmp")
 
 # CNI
 CNI_TARGET_DIR = Path("/opt/cni/bin")
 CNI_ARCHIVE_GLOB = "cni-plugins-linux-amd64-*.tgz"
 
 
-def safe_write_atomic(dst: Path, data: bytes, mode: int = 0o755) -> None:
-    """
-    Atomically write bytes to file (tmp -> fsync -> replace), then chmod.
-
-    Атомарная запись байтов в файл (tmp -> fsync -> replace), затем chmod.
-    """
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    with NamedTemporaryFile(dir=str(dst.parent), delete=False) as tmp:
-        tmp.write(data)
-        tmp.flush()
-        os.fsync(tmp.fileno())
-        tmp_path = Path(tmp.name)
-    os.replace(tmp_path, dst)
-    os.chmod(dst, mode)
-
-
 def find_cni_archive() -> Optional[Path]:
     """
     Return the latest-matching cni-plugins archive path or None if not found.
@@ -68,10 +55,10 @@ def find_cni_archive() -> Optional[Path]:
 def install_cni_plugins(archive_path: Path) -> None:
     """
     Install every regular file from CNI plugins archive into /opt/cni/bin.
-    We read each tar member into memory and write atomically, avoiding path traversal.
+    Each tar member is streamed into the target atomically, avoiding path traversal.
 
     Установить все обычные файлы из архива CNI-плагинов в /opt/cni/bin.
-    Читаем каждый член tar в память и пишем атомарно — без извлечения путей из архива.
+    Каждый член tar потоково и атомарно пишется в цель — без извлечения путей из архива.
     """
     if not archive_path.exists():
         log(f"CNI archive not found: {archive_path}", "error")
@@ -94,9 +81,9 @@ def install_cni_plugins(archive_path: Path) -> None:
                 if fobj is None:
                     log(f"Skip entry without file object: {m.name}", "warn")
                     continue
-                data = fobj.read()
                 target = CNI_TARGET_DIR / name
-                safe_write_atomic(target, data, mode=0o755)
+                with fobj:
+                    install_stream(fobj, target, mode=0o755)
                 installed += 1
                 log(f"Installed CNI plugin: {target}", "ok")
     except Exception as e:
@@ -125,33 +112,17 @@ def install_binary_from_archive(binary: str) -> None:
 
     try:
         with tarfile.open(archive_path, "r:gz") as tar:
-            if binary == "cilium":
-                # Особая логика: извлекаем в binares/cilium/
-                target_dir = BINARIES_DIR / "cilium"
-                tar.extractall(path=target_dir)
-                cli_binary = target_dir / "cilium"
-                if cli_binary.exists():
-                    cli_binary.chmod(0o755)
-                    cli_binary.replace(INSTALL_PATH / "cilium")
-                    log("cilium CLI установлен в /usr/local/bin/cilium", "ok")
-                else:
-                    log("cilium CLI не найден после распаковки", "error")
-                return
-
-            # Обычные бинарники — ищем одноимённый файл внутри архива
-            member = next((m for m in tar.getmembers() if m.name == binary), None)
+            # Ищем одноимённый файл в корне архива (для cilium CLI — тоже "cilium")
+            member = next((m for m in tar if m.isfile() and m.name.removeprefix("./") == binary), None)
             if not member:
                 log(f"{binary} не найден внутри архива {archive_path}", "error")
                 return
 
-            tar.extract(member, path=TMP_DIR)
-            extracted = TMP_DIR / binary
-            extracted.chmod(0o755)
-
             # Для kubelet — используем /usr/bin
             target_path = Path("/usr/bin") / binary if binary == "kubelet" else INSTALL_PATH / binary
 
-            extracted.replace(target_path)
+            with tar.extractfile(member) as fobj:
+                install_stream(fobj, target_path, mode=0o755)
             log(f"{binary} установлен в {target_path}", "ok")
 
     except Exception as e:
@@ -3,26 +3,47 @@
 
 """
 Idempotent installer/maintainer for containerd config.
-- Reads the reference config from `data/conf/containerd_conf.toml`.
-- Ensures `/etc/containerd/config.toml` exists and matches the reference.
+- Renders the reference config from `data/conf/containerd_conf.toml.j2`.
+- Tunables (pull/unpack concurrency, snapshotter, CRI pull settings, gRPC
+  buffer sizes, GC thresholds) are computed from the node's cores, disk type
+  and memory, then overridden by the selected profile from
+  `data/conf/containerd_profiles.yaml` (`--profile`, CONTAINERD_PROFILE in
+  collected_info.py, default "auto").
+- Ensures `/etc/containerd/config.toml` exists and matches the rendered reference.
 - If it differs, creates a timestamped backup and atomically replaces it.
-- Falls back to `containerd config default` when the reference file is missing.
+- Renders `/etc/containerd/certs.d/<registry>/hosts.toml` for every registry
+  in `data/conf/registry_mirrors.yaml`: configured mirrors, then the optional
+  control-plane pull-through cache (`setup/registry_cache.py`), then upstream.
+- Falls back to `containerd config default` when the template is missing.
 
 Идемпотентный установщик/поддерживатель конфига containerd.
-- Берёт эталонный конфиг из `data/conf/containerd_conf.toml`.
+- Рендерит эталонный конфиг из `data/conf/containerd_conf.toml.j2`.
+- Параметры (параллелизм pull/распаковки, snapshotter, настройки CRI pull,
+  размеры gRPC-буферов, пороги GC) вычисляются по ядрам, типу диска и памяти
+  ноды, затем переопределяются выбранным профилем из
+  `data/conf/containerd_profiles.yaml` (`--profile`, CONTAINERD_PROFILE в
+  collected_info.py, по умолчанию "auto").
 - Гарантирует наличие `/etc/containerd/config.toml` и его соответствие эталону.
 - При различиях делает бэкап с меткой времени и атомарно обновляет файл.
-- Если эталона нет, использует `containerd config default` как запасной вариант.
+- Рендерит `/etc/containerd/certs.d/<реестр>/hosts.toml` для каждого реестра
+  из `data/conf/registry_mirrors.yaml`: заданные зеркала, затем опциональный
+  pull-through кэш на control-plane (`setup/registry_cache.py`), затем сам реестр.
+- Если шаблона нет, использует `containerd config default` как запасной вариант.
 """
 
 import os
 import sys
+import json
+import argparse
 import subprocess
 import shutil
 import hashlib
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 
+import yaml
+from jinja2 import Template
+
 # Добавляем путь до корня проекта, чтобы работал import из utils
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, PROJECT_ROOT)
@@ -30,7 +51,13 @@ sys.path.insert(0, PROJECT_ROOT)
 from utils.logger import log  # noqa
 
 CONFIG_PATH = "/etc/containerd/config.toml"
-SOURCE_CONFIG = os.path.join(PROJECT_ROOT, "data", "conf", "containerd_conf.toml")
+SOURCE_TEMPLATE = os.path.join(PROJECT_ROOT, "data", "conf", "containerd_conf.toml.j2")
+PROFILES_FILE = os.path.join(PROJECT_ROOT, "data", "conf", "containerd_profiles.yaml")
+MIRRORS_FILE = os.path.join(PROJECT_ROOT, "data", "conf", "registry_mirrors.yaml")
+JOIN_INFO_FILE = os.path.join(PROJECT_ROOT, "data", "join_info.json")
+CERTS_DIR = "/etc/containerd/certs.d"
+CONTAINERD_ROOT = "/var/lib/containerd"
+DEFAULT_PROFILE = "auto"
 
 
 def file_sha256(path: str) -> str:
@@ -46,13 +73,212 @@ def file_sha256(path: str) -> str:
     return h.hexdigest()
 
 
-def files_differ(src: str, dst: str) -> bool:
+def detect_disk_type(path: str) -> str:
+    """
+    Detect whether `path` lives on a rotational disk: "ssd", "hdd" or "unknown".
+    Uses /sys/dev/block/<major:minor>/queue/rotational (or the parent disk for partitions).
+
+    Определить тип диска под `path`: "ssd", "hdd" или "unknown".
+    Читает /sys/dev/block/<major:minor>/queue/rotational (или родительского диска для разделов).
+    """
+    while not os.path.exists(path) and path != "/":
+        path = os.path.dirname(path)
+    st = os.stat(path)
+    dev = f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+    for candidate in (os.path.join(dev, "queue", "rotational"),
+                      os.path.join(dev, "..", "queue", "rotational")):
+        try:
+            with open(candidate) as f:
+                return "hdd" if f.read().strip() == "1" else "ssd"
+        except OSError:
+            continue
+    return "unknown"
+
+
+def detect_memory_gb() -> float:
+    """
+    Total memory in GiB from /proc/meminfo (0 if unavailable).
+
+    Общий объём памяти в ГиБ из /proc/meminfo (0, если недоступно).
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024 / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def node_facts() -> dict:
+    """
+    Collect node facts relevant for containerd tuning.
+
+    Собрать факты о ноде, важные для настройки containerd.
+    """
+    return {
+        "cores": os.cpu_count() or 1,
+        "memory_gb": detect_memory_gb(),
+        "disk": detect_disk_type(CONTAINERD_ROOT),
+    }
+
+
+def compute_auto_params(facts: dict) -> dict:
+    """
+    Compute default tunables from node facts: fast disks and many cores get more
+    parallel downloads/unpacks, rotational disks get fewer and longer pull timeouts,
+    big-memory nodes get larger gRPC buffers and less frequent GC under churn.
+
+    Вычислить параметры по фактам ноды: быстрые диски и много ядер — больше
+    параллельных загрузок/распаковок, HDD — меньше и с длинным таймаутом pull,
+    ноды с большим объёмом памяти — крупнее gRPC-буферы и реже GC при churn.
+    """
+    cores, mem_gb, disk = facts["cores"], facts["memory_gb"], facts["disk"]
+    fast = disk == "ssd"
+
+    return {
+        "max_concurrent_downloads": min(max(3, cores // 2), 10) if fast else 3,
+        "max_concurrent_uploaded_layers": min(max(3, cores // 4), 8) if fast else (2 if disk == "hdd" else 3),
+        "snapshotter": "overlayfs",
+        "image_pull_progress_timeout": "10m0s" if disk == "hdd" else "5m0s",
+        "image_pull_with_sync_fs": False,
+        "discard_unpacked_layers": False,
+        "grpc_max_msg_size": 33554432 if mem_gb >= 16 else 16777216,
+        "max_container_log_line_size": 16384,
+        "stream_idle_timeout": "4h0m0s",
+        "gc_deletion_threshold": 0,
+        "gc_mutation_threshold": 250 if mem_gb >= 16 else 100,
+        "gc_pause_threshold": 0.05 if 0 < mem_gb < 4 else 0.02,
+        "gc_schedule_delay": "0s",
+        "gc_startup_delay": "100ms",
+    }
+
+
+def load_profile(name: str) -> dict:
+    """
+    Load profile overrides by name from containerd_profiles.yaml.
+
+    Загрузить переопределения профиля по имени из containerd_profiles.yaml.
+    """
+    if not os.path.isfile(PROFILES_FILE):
+        log(f"Файл профилей не найден: {PROFILES_FILE} — используем auto", "warn")
+        return {}
+    with open(PROFILES_FILE, "r", encoding="utf-8") as f:
+        profiles = yaml.safe_load(f) or {}
+    if name not in profiles:
+        log(f"Профиль containerd '{name}' не найден. Доступны: {', '.join(profiles)}", "error")
+        raise SystemExit(1)
+    return profiles[name] or {}
+
+
+def default_profile_name() -> str:
+    """
+    Profile from collected_info.CONTAINERD_PROFILE, else "auto".
+
+    Профиль из collected_info.CONTAINERD_PROFILE, иначе "auto".
+    """
+    try:
+        from data import collected_info
+        return getattr(collected_info, "CONTAINERD_PROFILE", None) or DEFAULT_PROFILE
+    except ImportError:
+        return DEFAULT_PROFILE
+
+
+def resolve_params(profile: str) -> dict:
+    """
+    Auto-computed tunables with the profile's overrides applied.
+
+    Автоматически вычисленные параметры с применёнными переопределениями профиля.
+    """
+    facts = node_facts()
+    log(f"Нода: ядер={facts['cores']}, память={facts['memory_gb']:.1f} ГиБ, диск={facts['disk']}", "info")
+    params = compute_auto_params(facts)
+    params.update(load_profile(profile))
+    log(f"Профиль containerd: {profile} (downloads={params['max_concurrent_downloads']}, "
+        f"unpack={params['max_concurrent_uploaded_layers']}, snapshotter={params['snapshotter']})", "info")
+    return params
+
+
+def render_config(params: dict) -> bytes:
+    """
+    Render containerd config from the Jinja2 template.
+
+    Отрендерить конфиг containerd из шаблона Jinja2.
+    """
+    with open(SOURCE_TEMPLATE, "r", encoding="utf-8") as f:
+        template = Template(f.read(), keep_trailing_newline=True)
+    return template.render(**params).encode("utf-8")
+
+
+def cache_endpoint(cache: dict) -> str | None:
+    """
+    URL of the control-plane pull-through cache, or None when it is disabled.
+    Workers take CONTROL_PLANE_IP from join_info.json, the control plane uses its own IP.
+
+    URL pull-through кэша на control-plane или None, если он выключен.
+    Воркеры берут CONTROL_PLANE_IP из join_info.json, control-plane — свой IP.
+    """
+    if not cache.get("enabled"):
+        return None
+
+    host = None
+    if os.path.isfile(JOIN_INFO_FILE):
+        with open(JOIN_INFO_FILE, "r", encoding="utf-8") as f:
+            host = json.load(f).get("CONTROL_PLANE_IP")
+    if not host:
+        try:
+            from data import collected_info
+            host = collected_info.IP
+        except (ImportError, AttributeError):
+            log("Не удалось определить адрес кэша реестров — кэш не используется", "warn")
+            return None
+    return f"http://{host}:{cache.get('port', 5000)}"
+
+
+def render_hosts_toml(server: str, mirrors: list) -> bytes:
+    """
+    Render containerd hosts.toml: mirrors are tried in order, `server` is the fallback.
+
+    Отрендерить hosts.toml для containerd: зеркала пробуются по порядку, `server` — запасной.
     """
-    Return True if two files differ by SHA-256 checksum.
+    lines = [f'server = "{server}"', ""]
+    for mirror in mirrors:
+        lines.append(f'[host."{mirror}"]')
+        lines.append('  capabilities = ["pull", "resolve"]')
+        lines.append("")
+    return "\n".join(lines).encode("utf-8")
 
-    Вернуть True, если файлы различаются по хэшу SHA-256.
+
+def install_registry_mirrors() -> bool:
     """
-    return file_sha256(src) != file_sha256(dst)
+    Render hosts.toml for every registry from registry_mirrors.yaml into CERTS_DIR.
+    Returns True if the mirror config is in use (containerd config_path must point to CERTS_DIR).
+
+    Отрендерить hosts.toml для каждого реестра из registry_mirrors.yaml в CERTS_DIR.
+    Возвращает True, если конфиг зеркал используется (config_path containerd должен указывать на CERTS_DIR).
+    """
+    if not os.path.isfile(MIRRORS_FILE):
+        log(f"Файл зеркал не найден: {MIRRORS_FILE} — hosts.toml не создаются", "warn")
+        return False
+    with open(MIRRORS_FILE, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+
+    cache_url = cache_endpoint(data.get("cache") or {})
+    for registry, entry in (data.get("registries") or {}).items():
+        entry = entry or {}
+        server = entry.get("server") or f"https://{registry}"
+        mirrors = list(entry.get("mirrors") or [])
+        if cache_url:
+            mirrors.append(cache_url)
+
+        rendered = render_hosts_toml(server, mirrors)
+        path = os.path.join(CERTS_DIR, registry, "hosts.toml")
+        if os.path.isfile(path) and file_sha256(path) == hashlib.sha256(rendered).hexdigest():
+            continue
+        write_atomic(path, rendered)
+        log(f"hosts.toml для {registry}: {', '.join(mirrors) or 'без зеркал'} → {server}", "ok")
+    return True
 
 
 def ensure_dir(path: str) -> None:
@@ -122,64 +348,66 @@ def generate_default_config_to(path: str) -> bool:
         return False
 
 
-def install_from_source(src: str, dst: str) -> None:
+def install_rendered(data: bytes, dst: str) -> None:
     """
-    Install config from `src` to `dst` atomically. Fails if `src` is missing.
+    Install rendered config bytes to `dst` atomically.
 
-    Установить конфиг из `src` в `dst` атомарно. Падает с ошибкой, если нет `src`.
+    Атомарно установить отрендеренный конфиг в `dst`.
     """
-    if not os.path.isfile(src):
-        log(f"Reference config not found: {src}", "error")
-        raise SystemExit(1)
-
-    with open(src, "rb") as f:
-        data = f.read()
-
     write_atomic(dst, data)
-    log(f"Installed config from {src} → {dst}", "ok")
+    log(f"Installed config from {SOURCE_TEMPLATE} → {dst}", "ok")
 
 
 def main() -> None:
     """
     Orchestrate config check & apply:
-    - If target is missing → install from reference; fallback to default.
+    - Render reference from template with the selected profile.
+    - If target is missing → install rendered reference; fallback to default.
     - If present → compare hashes; backup & replace when different.
 
     Оркестрация проверки и применения:
-    - Если файла нет → ставим из эталона; запасной вариант — дефолтный.
+    - Рендерим эталон из шаблона с выбранным профилем.
+    - Если файла нет → ставим отрендеренный эталон; запасной вариант — дефолтный.
     - Если есть → сравниваем хэши; при различиях делаем бэкап и обновляем.
     """
+    parser = argparse.ArgumentParser(description="Install/update containerd config from profile")
+    parser.add_argument("--profile", default=None, help="Profile from containerd_profiles.yaml (default: auto)")
+    args = parser.parse_args()
+
     log("Checking/updating containerd configuration…", "info")
 
-    # 1) Нет текущего файла — ставим из репозитория (или дефолт)
+    if not os.path.isfile(SOURCE_TEMPLATE):
+        log(f"Reference template not found: {SOURCE_TEMPLATE}", "error")
+        # 1) Нет ни эталона, ни текущего файла — пробуем дефолтный
+        if not os.path.isfile(CONFIG_PATH) and generate_default_config_to(CONFIG_PATH):
+            log("You should restart containerd: systemctl restart containerd", "warn")
+            return
+        raise SystemExit(1)
+
+    params = resolve_params(args.profile or default_profile_name())
+    # hosts.toml подхватываются containerd на лету, перезапуск нужен только при смене config_path
+    params["registry_config_path"] = CERTS_DIR if install_registry_mirrors() else ""
+    rendered = render_config(params)
+
+    # 2) Нет текущего файла — ставим отрендеренный эталон
     if not os.path.isfile(CONFIG_PATH):
         log(f"File not found: {CONFIG_PATH}. Will install from reference.", "warn")
-        try:
-            install_from_source(SOURCE_CONFIG, CONFIG_PATH)
-        except SystemExit:
-            # Эталона нет — пробуем дефолтный
-            if generate_default_config_to(CONFIG_PATH):
-                log("You should restart containerd: systemctl restart containerd", "warn")
-            return
+        install_rendered(rendered, CONFIG_PATH)
         log("You should restart containerd: systemctl restart containerd", "warn")
         return
 
-    # 2) Файл есть — сравним с эталоном
-    if not os.path.isfile(SOURCE_CONFIG):
-        log(f"Reference config missing: {SOURCE_CONFIG}. Nothing to compare — leaving as is.", "error")
-        raise SystemExit(1)
-
+    # 3) Файл есть — сравним с эталоном
     try:
-        if files_differ(SOURCE_CONFIG, CONFIG_PATH):
-            old_hash = file_sha256(CONFIG_PATH)
-            new_hash = file_sha256(SOURCE_CONFIG)
+        new_hash = hashlib.sha256(rendered).hexdigest()
+        old_hash = file_sha256(CONFIG_PATH)
+        if new_hash != old_hash:
             bak_path = backup_file(CONFIG_PATH)
             log("Differences found in containerd config.", "warn")
             log(f"Current:  {CONFIG_PATH} sha256={old_hash}", "info")
-            log(f"Reference:{SOURCE_CONFIG} sha256={new_hash}", "info")
+            log(f"Reference:{SOURCE_TEMPLATE} sha256={new_hash}", "info")
             log(f"Backup saved: {bak_path}", "ok")
 
-            install_from_source(SOURCE_CONFIG, CONFIG_PATH)
+            install_rendered(rendered, CONFIG_PATH)
             log("You should restart containerd: systemctl restart containerd", "warn")
         else:
             log("Config is already up to date — no changes required.", "ok")
@@ -189,4 +417,4 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight pull-through registry cache for the control plane.
+- Speaks the read-only part of the OCI distribution API (`/v2/`, manifests
+  and blobs, GET and HEAD) — enough for containerd to use it as a mirror
+  from `hosts.toml`.
+- The upstream registry is taken from the `ns` query parameter containerd
+  adds for mirrors; only registries listed in `data/conf/registry_mirrors.yaml`
+  are proxied.
+- Blobs and manifests are content-addressed and cached on disk forever;
+  tag → digest lookups are trusted for `manifest_ttl` seconds, and a stale
+  mapping is served when the upstream is unreachable.
+- A blob is streamed to the client while it is written to the cache and
+  verified against its digest; concurrent requests for the same blob wait
+  for the first download instead of pulling it again.
+- Anonymous bearer tokens (Docker Hub, quay.io, ...) are fetched and cached
+  per scope.
+
+Лёгкий pull-through кэш реестра для control-plane.
+- Реализует read-only часть OCI distribution API (`/v2/`, манифесты и блобы,
+  GET и HEAD) — достаточно, чтобы containerd использовал его как зеркало
+  из `hosts.toml`.
+- Исходный реестр берётся из query-параметра `ns`, который containerd
+  добавляет для зеркал; проксируются только реестры из
+  `data/conf/registry_mirrors.yaml`.
+- Блобы и манифесты адресуются по содержимому и хранятся на диске бессрочно;
+  соответствию тег → дайджест доверяем `manifest_ttl` секунд, а при
+  недоступности реестра отдаём устаревшее соответствие.
+- Блоб отдаётся клиенту одновременно с записью в кэш и проверяется по
+  дайджесту; параллельные запросы того же блоба ждут первую загрузку, а не
+  тянут его повторно.
+- Анонимные bearer-токены (Docker Hub, quay.io, ...) получаются и кэшируются
+  по scope.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import contextlib
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+# Добавляем путь до корня проекта, чтобы работал import из utils
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.logger import log  # noqa: E402
+
+MIRRORS_FILE = PROJECT_ROOT / "data" / "conf" / "registry_mirrors.yaml"
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 5000
+DEFAULT_DIR = "/var/lib/kuber-bootstrap/registry-cache"
+DEFAULT_TTL = 300
+DEFAULT_NS = "docker.io"
+CHUNK_SIZE = 1024 * 1024
+UPSTREAM_TIMEOUT = 60
+PRUNE_INTERVAL = 60
+
+MANIFEST_ACCEPT = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+PATH_RE = re.compile(r"^/v2/(?P<name>.+)/(?P<kind>manifests|blobs)/(?P<ref>[^/]+)$")
+DIGEST_RE = re.compile(r"^sha256:[0-9a-f]{64}$")
+AUTH_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def load_cache_config() -> tuple[dict, dict]:
+    """
+    Load (cache settings, {registry: server URL}) from registry_mirrors.yaml.
+
+    Загрузить (настройки кэша, {реестр: URL сервера}) из registry_mirrors.yaml.
+    """
+    if not MIRRORS_FILE.exists():
+        return {}, {}
+    with MIRRORS_FILE.open("r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    upstreams = {
+        name: (entry or {}).get("server") or f"https://{name}"
+        for name, entry in (data.get("registries") or {}).items()
+    }
+    return data.get("cache") or {}, upstreams
+
+
+class UpstreamClient:
+    """
+    HTTP client for upstream registries with anonymous bearer-token caching.
+
+    HTTP-клиент к исходным реестрам с кэшированием анонимных bearer-токенов.
+    """
+
+    def __init__(self, upstreams: dict):
+        self.upstreams = upstreams
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def _fetch_token(self, challenge: str) -> str | None:
+        params = dict(AUTH_PARAM_RE.findall(challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            return None
+        key = (realm, params.get("scope", ""))
+
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
+        url = f"{realm}?{urllib.parse.urlencode(params)}"
+        with urllib.request.urlopen(url, timeout=UPSTREAM_TIMEOUT) as resp:
+            payload = json.load(resp)
+        token = payload.get("token") or payload.get("access_token")
+        # обновляем токен заранее, чтобы не попасть на истечение посреди загрузки
+        ttl = max(int(payload.get("expires_in", 60)) - 10, 10)
+        with self._lock:
+            self._tokens[key] = (token, time.monotonic() + ttl)
+        return token
+
+    def open(self, ns: str, path: str, method: str = "GET", accept: str | None = None):
+        """
+        Open `path` on the upstream registry `ns`, retrying once with a bearer token on 401.
+        Returns the response; raises urllib.error.HTTPError on upstream errors.
+
+        Открыть `path` в реестре `ns`, при 401 повторить один раз с bearer-токеном.
+        Возвращает ответ; при ошибке реестра бросает urllib.error.HTTPError.
+        """
+        url = f"{self.upstreams[ns].rstrip('/')}{path}"
+        token = None
+        for _ in range(2):
+            req = urllib.request.Request(url, method=method)
+            if accept:
+                req.add_header("Accept", accept)
+            if token:
+                # не переносится на редирект в CDN/S3, где лишняя авторизация запрещена
+                req.add_unredirected_header("Authorization", f"Bearer {token}")
+            try:
+                return urllib.request.urlopen(req, timeout=UPSTREAM_TIMEOUT)
+            except urllib.error.HTTPError as e:
+                challenge = e.headers.get("WWW-Authenticate", "")
+                if e.code != 401 or token or not challenge.lower().startswith("bearer"):
+                    raise
+                token = self._fetch_token(challenge)
+                if not token:
+                    raise
+        raise RuntimeError("unreachable")
+
+
+class CacheStore:
+    """
+    On-disk content-addressed store for blobs and manifests plus in-memory tag map.
+
+    Хранилище на диске с адресацией по содержимому для блобов и манифестов
+    и таблица тегов в памяти.
+    """
+
+    def __init__(self, root: Path, manifest_ttl: int, max_bytes: int):
+        self.root = root
+        self.manifest_ttl = manifest_ttl
+        self.max_bytes = max_bytes
+        self._tags = {}
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._last_prune = 0.0
+        for sub in ("blobs", "manifests"):
+            (root / sub).mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest: str) -> Path:
+        return self.root / "blobs" / digest.split(":", 1)[1]
+
+    def manifest_path(self, digest: str) -> Path:
+        return self.root / "manifests" / digest.split(":", 1)[1]
+
+    @contextlib.contextmanager
+    def digest_lock(self, digest: str):
+        """
+        Per-digest lock so a blob is downloaded from upstream only once at a time.
+        The lock is dropped once no thread holds or waits for it.
+
+        Блокировка на дайджест, чтобы блоб качался из реестра только один раз.
+        Блокировка удаляется, когда её никто не держит и не ждёт.
+        """
+        with self._lock:
+            # [блокировка, сколько потоков её держат или ждут]
+            entry = self._inflight.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._inflight[digest]
+
+    def get_tag(self, ns: str, name: str, tag: str, allow_stale: bool = False) -> str | None:
+        with self._lock:
+            entry = self._tags.get((ns, name, tag))
+        if entry and (allow_stale or entry[1] > time.monotonic()):
+            return entry[0]
+        return None
+
+    def set_tag(self, ns: str, name: str, tag: str, digest: str) -> None:
+        with self._lock:
+            self._tags[(ns, name, tag)] = (digest, time.monotonic() + self.manifest_ttl)
+
+    def read_manifest(self, digest: str) -> tuple[bytes, str] | None:
+        path = self.manifest_path(digest)
+        if not path.exists():
+            return None
+        meta = path.with_suffix(".type")
+        media_type = meta.read_text().strip() if meta.exists() else "application/vnd.oci.image.manifest.v1+json"
+        return path.read_bytes(), media_type
+
+    def write_manifest(self, digest: str, body: bytes, media_type: str) -> None:
+        path = self.manifest_path(digest)
+        path.with_suffix(".type").write_text(media_type)
+        with NamedTemporaryFile(dir=str(path.parent), prefix=".tmp.", delete=False) as tmp:
+            tmp.write(body)
+        os.replace(tmp.name, path)
+
+    def prune(self) -> None:
+        """
+        Drop least recently used blobs until the cache fits `max_bytes` (throttled).
+
+        Удалять давно не используемые блобы, пока кэш не уложится в `max_bytes` (не чаще раза в минуту).
+        """
+        if self.max_bytes <= 0 or time.monotonic() - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+
+        blobs = [(p.stat(), p) for p in (self.root / "blobs").iterdir() if not p.name.startswith(".")]
+        total = sum(st.st_size for st, _ in blobs)
+        if total <= self.max_bytes:
+            return
+        for st, path in sorted(blobs, key=lambda item: item[0].st_atime):
+            path.unlink(missing_ok=True)
+            total -= st.st_size
+            log(f"[registry-cache] Удалён из кэша {path.name[:12]} ({st.st_size / 1024 / 1024:.1f} МБ)", "info")
+            if total <= self.max_bytes:
+                break
+
+
+class RegistryCacheHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for the read-only registry API.
+
+    HTTP-обработчик read-only API реестра.
+    """
+
+    store: CacheStore = None
+    upstream: UpstreamClient = None
+    protocol_version = "HTTP/1.1"
+
+    def _send_error(self, code: int, message: str) -> None:
+        if self.headers_sent:
+            # ответ уже начат (часть блоба отправлена) — второй статус испортил бы тело,
+            # клиент увидит обрыв соединения и повторит запрос
+            log(f"[registry-cache] Ответ прерван после заголовков: {message}", "warn")
+            self.close_connection = True
+            return
+        body = json.dumps({"errors": [{"code": "UNKNOWN", "message": message}]}).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_headers(self, size: int, media_type: str, digest: str) -> None:
+        self.headers_sent = True
+        self.send_response(200)
+        self.send_header("Content-Type", media_type)
+        self.send_header("Content-Length", str(size))
+        if digest:
+            self.send_header("Docker-Content-Digest", digest)
+        self.send_header("Docker-Distribution-API-Version", "registry/2.0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.headers_sent = False
+        url = urllib.parse.urlsplit(self.path)
+        if url.path in ("/v2", "/v2/"):
+            self._send_headers(2, "application/json", "")
+            if self.command != "HEAD":
+                self.wfile.write(b"{}")
+            return
+
+        match = PATH_RE.match(url.path)
+        if not match:
+            self._send_error(404, "not found")
+            return
+
+        ns = urllib.parse.parse_qs(url.query).get("ns", [DEFAULT_NS])[0]
+        if ns not in self.upstream.upstreams:
+            self._send_error(404, f"registry {ns} is not proxied")
+            return
+
+        name, kind, ref = match.group("name", "kind", "ref")
+        try:
+            if kind == "blobs":
+                self._serve_blob(ns, name, ref)
+            else:
+                self._serve_manifest(ns, name, ref)
+        except urllib.error.HTTPError as e:
+            self._send_error(e.code, f"upstream {ns}: {e.reason}")
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            log(f"[registry-cache] Ошибка {ns}/{name}/{kind}/{ref}: {e}", "warn")
+            self._send_error(502, f"upstream {ns}: {e}")
+
+    def _serve_manifest(self, ns: str, name: str, ref: str) -> None:
+        digest = ref if DIGEST_RE.match(ref) else self.store.get_tag(ns, name, ref)
+        cached = self.store.read_manifest(digest) if digest else None
+
+        if cached is None:
+            try:
+                with self.upstream.open(ns, f"/v2/{name}/manifests/{ref}",
+                                        accept=self.headers.get("Accept") or MANIFEST_ACCEPT) as resp:
+                    body = resp.read()
+                    media_type = resp.headers.get("Content-Type", "application/vnd.oci.image.manifest.v1+json")
+                digest = "sha256:" + hashlib.sha256(body).hexdigest()
+                if DIGEST_RE.match(ref) and ref != digest:
+                    raise ValueError(f"digest mismatch for manifest {ref}")
+                self.store.write_manifest(digest, body, media_type)
+                cached = (body, media_type)
+            except urllib.error.HTTPError:
+                raise
+            except (urllib.error.URLError, OSError):
+                # реестр недоступен — отдаём последний известный дайджест тега, если он есть
+                digest = self.store.get_tag(ns, name, ref, allow_stale=True)
+                cached = self.store.read_manifest(digest) if digest else None
+                if cached is None:
+                    raise
+                log(f"[registry-cache] {ns} недоступен, отдаём устаревший {name}:{ref}", "warn")
+
+        if not DIGEST_RE.match(ref):
+            self.store.set_tag(ns, name, ref, digest)
+
+        body, media_type = cached
+        self._send_headers(len(body), media_type, digest)
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _serve_blob(self, ns: str, name: str, digest: str) -> None:
+        if not DIGEST_RE.match(digest):
+            self._send_error(400, f"unsupported digest {digest}")
+            return
+
+        path = self.store.blob_path(digest)
+        if not path.exists() and self.command == "HEAD":
+            with self.upstream.open(ns, f"/v2/{name}/blobs/{digest}", method="HEAD") as resp:
+                size = int(resp.headers.get("Content-Length", 0))
+            self._send_headers(size, "application/octet-stream", digest)
+            return
+
+        if not path.exists():
+            with self.store.digest_lock(digest):
+                # пока ждали блокировку, блоб мог скачать другой поток
+                if not path.exists() and self._fetch_blob(ns, name, digest, path):
+                    return
+
+        size = path.stat().st_size
+        self._send_headers(size, "application/octet-stream", digest)
+        if self.command != "HEAD":
+            with open(path, "rb") as f:
+                self.wfile.flush()
+                self.connection.sendfile(f)
+            os.utime(path)
+
+    def _fetch_blob(self, ns: str, name: str, digest: str, path: Path) -> bool:
+        """
+        Stream a blob from upstream to the client and into the cache at the same time.
+        The cache entry is kept only if the digest matches. Without Content-Length
+        (chunked upstream) the blob is only downloaded into the cache and False is
+        returned: the caller serves it from disk with the real size.
+
+        Отдавать блоб из реестра клиенту и одновременно писать в кэш.
+        Запись в кэше сохраняется, только если совпал дайджест. Без Content-Length
+        (chunked-ответ реестра) блоб только скачивается в кэш и возвращается False:
+        вызывающий отдаёт его с диска с настоящим размером.
+        """
+        with self.upstream.open(ns, f"/v2/{name}/blobs/{digest}") as resp, \
+                NamedTemporaryFile(dir=str(path.parent), prefix=".tmp.", delete=False) as tmp:
+            tmp_path = Path(tmp.name)
+            try:
+                length = resp.headers.get("Content-Length")
+                streaming = length is not None
+                if streaming:
+                    self._send_headers(int(length), "application/octet-stream", digest)
+                h = hashlib.sha256()
+                size = 0
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                    h.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+                    if streaming:
+                        self.wfile.write(chunk)
+                tmp.flush()
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+
+        if "sha256:" + h.hexdigest() != digest:
+            tmp_path.unlink(missing_ok=True)
+            log(f"[registry-cache] Дайджест блоба {digest} не совпал — в кэш не сохранён", "error")
+            # клиент уже получил заголовки: оборванное соединение, а не «успешный» битый блоб
+            raise ValueError(f"digest mismatch for blob {digest}")
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        log(f"[registry-cache] Закэширован {ns}/{name}@{digest[:19]} ({size / 1024 / 1024:.1f} МБ)", "ok")
+        self.store.prune()
+        return streaming
+
+    def log_message(self, fmt, *args):
+        log(f"[registry-cache] {self.client_address[0]} {fmt % args}", "info")
+
+
+def run_server(host: str, port: int, cache_dir: Path, manifest_ttl: int, max_size_gb: float,
+               upstreams: dict) -> None:
+    """
+    Start the threaded pull-through cache.
+
+    Запустить многопоточный pull-through кэш.
+    """
+    if not upstreams:
+        log(f"В {MIRRORS_FILE} не задано ни одного реестра", "error")
+        sys.exit(1)
+
+    RegistryCacheHandler.store = CacheStore(cache_dir, manifest_ttl, int(max_size_gb * 1024 ** 3))
+    RegistryCacheHandler.upstream = UpstreamClient(upstreams)
+
+    server = ThreadingHTTPServer((host, port), RegistryCacheHandler)
+    log(f"Pull-through кэш реестров запущен на http://{host}:{port} ({', '.join(upstreams)}), кэш: {cache_dir}",
+        "info")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    cache, upstreams = load_cache_config()
+
+    parser = argparse.ArgumentParser(description="Pull-through registry cache for containerd mirrors")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Bind address (default {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=int(cache.get("port", DEFAULT_PORT)), help="Bind port")
+    parser.add_argument("--dir", default=cache.get("dir", DEFAULT_DIR), help="Cache directory")
+    parser.add_argument("--manifest-ttl", type=int, default=int(cache.get("manifest_ttl", DEFAULT_TTL)),
+                        help="Seconds to trust a cached tag → digest mapping")
+    parser.add_argument("--max-size-gb", type=float, default=float(cache.get("max_size_gb", 0)),
+                        help="Blob cache size limit in GiB (0 = unlimited)")
+    args = parser.parse_args()
+
+    run_server(args.host, args.port, Path(args.dir), args.manifest_ttl, args.max_size_gb, upstreams)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,6 @@ import sys
 import tarfile
 import shutil
 import subprocess
-import hashlib
 from pathlib import Path
 from jinja2 import Template
 
@@ -19,11 +18,12 @@ from jinja2 import Template
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from utils.logger import log
+from utils.fileops import install_stream
 from data import collected_info
 
 # Пути
 ARCHIVE_PATH = Path("/opt/kuber-bootstrap/binares/cilium.tar.gz")
-EXTRACT_DIR = Path("/opt/kuber-bootstrap/tmp/cilium_extract")
+AGENT_MEMBER = "daemon/cilium-agent"
 TARGET_BIN = Path("/usr/local/bin/cilium-agent")
 CONFIG_DIR = Path("/etc/cilium")
 CONFIG_TEMPLATE_PATH = Path("data/yaml/cilium.yaml.j2")
@@ -35,16 +35,12 @@ SERVICE_PATH = Path("/etc/systemd/system/cilium.service")
 SERVICE_UPDATED = False
 BINARY_UPDATED = False
 
-def file_sha256(path: Path) -> str:
+def find_member(tar: tarfile.TarFile, match) -> tarfile.TarInfo | None:
     """
-    Calculate SHA256 checksum of a file.
-    Рассчитывает SHA256-хеш файла для проверки изменений.
+    Find the first regular file in archive whose normalized name satisfies `match`.
+    Находит первый обычный файл архива, нормализованное имя которого удовлетворяет `match`.
     """
-    h = hashlib.sha256()
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
+    return next((m for m in tar if m.isfile() and match(m.name.removeprefix("./"))), None)
 
 def ensure_directories():
     """
@@ -75,8 +71,9 @@ def ensure_directories():
 
 def extract_and_install():
     """
-    Extract Cilium binary from archive and install it.
-    Распаковывает бинарник Cilium из архива и устанавливает его в систему.
+    Stream Cilium binaries from archives straight into place.
+    Потоково устанавливает бинарники Cilium из архивов сразу на место:
+    без распаковки во временную директорию, хеш считается по ходу записи.
     """
     global BINARY_UPDATED
 
@@ -85,33 +82,27 @@ def extract_and_install():
         log(f"Архив не найден: {ARCHIVE_PATH}", "error")
         sys.exit(1)
 
-    if EXTRACT_DIR.exists():
-        shutil.rmtree(EXTRACT_DIR)
-    EXTRACT_DIR.mkdir(parents=True)
-
-    log(f"Распаковка архива {ARCHIVE_PATH} в {EXTRACT_DIR}", "info")
-    with tarfile.open(ARCHIVE_PATH, "r:gz") as tar:
-        tar.extractall(path=EXTRACT_DIR)
-
-    source = EXTRACT_DIR / "daemon" / "cilium-agent"
-    if not source.exists():
-        log("Бинарник cilium-agent не найден после распаковки", "error")
-        sys.exit(1)
-
-    if TARGET_BIN.exists() and file_sha256(source) == file_sha256(TARGET_BIN):
-        log("Бинарник не изменился — замена не требуется", "info")
-    else:
+    def stop_old_agent():
         if TARGET_BIN.exists():
             subprocess.run(["systemctl", "stop", "cilium.service"], check=False)
             log("Старый бинарник остановлен перед заменой", "warn")
 
-        shutil.copy2(source, TARGET_BIN)
-        os.chmod(TARGET_BIN, 0o755)
+    log(f"Установка {AGENT_MEMBER} из архива {ARCHIVE_PATH}", "info")
+    with tarfile.open(ARCHIVE_PATH, "r:gz") as tar:
+        member = find_member(tar, lambda name: name == AGENT_MEMBER)
+        if member is None:
+            log("Бинарник cilium-agent не найден в архиве", "error")
+            sys.exit(1)
+
+        with tar.extractfile(member) as src:
+            _, changed = install_stream(src, TARGET_BIN, mode=0o755,
+                                        skip_if_same=True, before_replace=stop_old_agent)
+
+    if changed:
         log(f"Бинарник установлен: {TARGET_BIN}", "ok")
         BINARY_UPDATED = True
-
-    shutil.rmtree(EXTRACT_DIR, ignore_errors=True)
-    log("Временные файлы удалены", "info")
+    else:
+        log("Бинарник не изменился — замена не требуется", "info")
 
     # --- Cilium Health Responder ---
     health_bin = Path("/usr/local/bin/cilium-health-responder")
@@ -121,17 +112,15 @@ def extract_and_install():
             log("Архив cilium-health-responder не найден", "error")
             sys.exit(1)
 
-        log(f"Распаковка архива {health_archive}", "info")
+        log(f"Установка из архива {health_archive}", "info")
         with tarfile.open(health_archive, "r:gz") as tar:
-            tar.extractall(path=EXTRACT_DIR)
-
-        responder_src = next(EXTRACT_DIR.glob("**/cilium-health-responder"), None)
-        if not responder_src or not responder_src.exists():
-            log("Файл cilium-health-responder не найден в архиве", "error")
-            sys.exit(1)
+            member = find_member(tar, lambda name: os.path.basename(name) == "cilium-health-responder")
+            if member is None:
+                log("Файл cilium-health-responder не найден в архиве", "error")
+                sys.exit(1)
 
-        shutil.copy2(responder_src, health_bin)
-        os.chmod(health_bin, 0o755)
+            with tar.extractfile(member) as src:
+                install_stream(src, health_bin, mode=0o755)
         log(f"Бинарник установлен: {health_bin}", "ok")
     else:
         log("cilium-health-responder уже установлен — пропускаем", "info")
@@ -153,7 +142,11 @@ def render_config_file():
         IP=collected_info.IP,
         POD_CIDR=collected_info.CLUSTER_POD_CIDR,
         CLUSTER_POD_CIDR=collected_info.CLUSTER_POD_CIDR,
-        CIDR=collected_info.CIDR
+        CIDR=collected_info.CIDR,
+        # dual-stack: пустой CLUSTER_POD_CIDR_V6 (или старый collected_info) — только IPv4
+        CLUSTER_POD_CIDR_V6=getattr(collected_info, "CLUSTER_POD_CIDR_V6", ""),
+        CIDR_V6=getattr(collected_info, "CIDR_V6", "64"),
+        IPV6=getattr(collected_info, "IPV6", "")
     )
 
     if CONFIG_OUTPUT_PATH.exists():
@@ -0,0 +1,211 @@
+# utils/fileops.py
+
+"""
+Common install primitives for large files (binaries, BPF objects, archives).
+- `install_file` copies file → file inside the kernel: reflink (FICLONE) when
+  the filesystem supports it, then `copy_file_range`, then `sendfile`, and a
+  plain read/write loop only as the last resort.
+- `install_stream` writes a file-like object (e.g. a tar member) in chunks and
+  computes sha256 while writing, so a binary is never buffered whole in RAM
+  and is read exactly once.
+- Both write to a temp file in the target directory, fsync it, chmod, do an
+  atomic `os.replace()` and fsync the parent directory.
+
+Общие примитивы установки больших файлов (бинарники, BPF-объекты, архивы).
+- `install_file` копирует файл → файл внутри ядра: reflink (FICLONE), если
+  ФС поддерживает, затем `copy_file_range`, затем `sendfile`, и обычный цикл
+  read/write только как последний вариант.
+- `install_stream` пишет file-like объект (например, член tar) чанками и
+  считает sha256 по ходу записи, поэтому бинарник не держится в памяти целиком
+  и читается ровно один раз.
+- Обе функции пишут во временный файл в целевой директории, делают fsync,
+  chmod, атомарный `os.replace()` и fsync родительской директории.
+"""
+
+import os
+import errno
+import fcntl
+import hashlib
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Callable, Optional
+
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl FICLONE из linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Ошибки, при которых ускоренный путь просто не поддерживается и нужно откатиться
+_FALLBACK_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF}
+
+
+def file_sha256(path: Path) -> str:
+    """
+    Compute SHA-256 checksum of a file in a streaming fashion (1 MB chunks).
+
+    Вычислить SHA-256 файла потоково (чанки по 1 МБ).
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fsync_dir(path: Path) -> None:
+    """
+    fsync a directory so a rename inside it survives a crash.
+
+    Сделать fsync директории, чтобы переименование в ней пережило сбой.
+    """
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_fd(src_fd: int, dst_fd: int, size: int) -> str:
+    """
+    Copy `size` bytes between descriptors with the cheapest available method.
+    Returns the method used: "reflink", "copy_file_range", "sendfile" or "readwrite".
+
+    Скопировать `size` байт между дескрипторами самым дешёвым доступным способом.
+    Возвращает использованный метод: "reflink", "copy_file_range", "sendfile" или "readwrite".
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return "reflink"
+    except OSError as e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+
+    copied = 0
+    method = "copy_file_range"
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return method
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    # copy_file_range с явными смещениями не двигает позицию dst — выставляем вручную
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    method = "sendfile"
+    try:
+        while copied < size:
+            n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+            if n == 0:
+                break
+            copied += n
+        if copied >= size:
+            return method
+    except OSError as e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, CHUNK_SIZE)
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+    return "readwrite"
+
+
+def _commit(tmp_path: Path, dst: Path, mode: int) -> None:
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dst)
+    fsync_dir(dst.parent)
+
+
+def same_file_content(a: Path, b: Path) -> bool:
+    """
+    Return True if both files exist and have equal content.
+    Sizes are compared first, so differing files are never hashed.
+
+    Вернуть True, если оба файла существуют и совпадают по содержимому.
+    Сначала сравниваются размеры — отличающиеся файлы не хэшируются.
+    """
+    if not (a.exists() and b.exists()):
+        return False
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    return file_sha256(a) == file_sha256(b)
+
+
+def install_file(src: Path, dst: Path, mode: int = 0o755) -> str:
+    """
+    Atomically install `src` to `dst` using an in-kernel copy.
+    Returns the copy method that was used.
+
+    Атомарно установить `src` в `dst` через копирование внутри ядра.
+    Возвращает использованный метод копирования.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    size = src.stat().st_size
+    with open(src, "rb") as s, NamedTemporaryFile(dir=str(dst.parent), prefix=f".{dst.name}.", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+        try:
+            method = copy_fd(s.fileno(), tmp.fileno(), size)
+            os.fsync(tmp.fileno())
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    _commit(tmp_path, dst, mode)
+    return method
+
+
+def install_stream(fobj: BinaryIO, dst: Path, mode: int = 0o755, skip_if_same: bool = False,
+                   before_replace: Optional[Callable[[], None]] = None) -> tuple[str, bool]:
+    """
+    Atomically install the content of `fobj` to `dst`, hashing while writing.
+
+    With `skip_if_same=True` an existing `dst` with identical content is left
+    untouched (the existing file is hashed only if its size matches).
+    `before_replace` is called right before the swap, e.g. to stop a service.
+    Returns (sha256, changed).
+
+    Атомарно установить содержимое `fobj` в `dst`, считая хэш по ходу записи.
+
+    При `skip_if_same=True` существующий `dst` с тем же содержимым не трогается
+    (существующий файл хэшируется, только если совпадает размер).
+    `before_replace` вызывается прямо перед заменой, например для остановки сервиса.
+    Возвращает (sha256, changed).
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    size = 0
+    with NamedTemporaryFile(dir=str(dst.parent), prefix=f".{dst.name}.", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+        try:
+            for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    digest = h.hexdigest()
+    if skip_if_same and dst.exists() and dst.stat().st_size == size and file_sha256(dst) == digest:
+        tmp_path.unlink(missing_ok=True)
+        return digest, False
+
+    try:
+        if before_replace is not None:
+            before_replace()
+        _commit(tmp_path, dst, mode)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return digest, True
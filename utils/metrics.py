@@ -0,0 +1,258 @@
+# utils/metrics.py
+
+"""
+Minimal Prometheus metrics (text exposition format 0.0.4) without extra dependencies.
+- `counter()`, `gauge()`, `histogram()` create metrics in the process-wide
+  REGISTRY; label values are passed as keyword arguments.
+- `render()` returns the whole registry as text for a `/metrics` endpoint.
+- All metrics are thread-safe: the intake service updates them from the event
+  loop, the executor threads and the background loops at once.
+- Several processes: each one writes its values with `write_snapshot(dir)`
+  and `render(dir)` merges the other processes' files into the output —
+  counters and histograms are summed, gauges are summed or (merge="local")
+  taken from the rendering process only.
+
+Минимальные метрики Prometheus (текстовый формат 0.0.4) без лишних зависимостей.
+- `counter()`, `gauge()`, `histogram()` создают метрики в общем для процесса
+  REGISTRY; значения меток передаются именованными аргументами.
+- `render()` отдаёт весь реестр текстом для эндпоинта `/metrics`.
+- Все метрики потокобезопасны: intake-сервис обновляет их одновременно из
+  event loop, потоков пула и фоновых циклов.
+- Несколько процессов: каждый записывает свои значения `write_snapshot(dir)`,
+  а `render(dir)` добавляет к выводу файлы остальных процессов — счётчики и
+  гистограммы суммируются, gauge суммируются или (merge="local") берутся
+  только из процесса, отдающего метрики.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from pathlib import Path
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы гистограмм по умолчанию, секунды (как в клиентских библиотеках Prometheus)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base for a labelled metric family.
+
+    Основа семейства метрик с метками.
+    """
+
+    kind = "untyped"
+    # как сводить значения нескольких процессов: "sum" или "local" (только свои)
+    merge = "sum"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: labels {sorted(labels)} != {list(self.label_names)}")
+        return tuple(labels[n] for n in self.label_names)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _combine(a, b):
+        return a + b
+
+    def render(self, others=()) -> list:
+        """
+        Text samples of this metric; `others` are snapshot() lists of other processes.
+
+        Текстовые сэмплы метрики; `others` — списки snapshot() других процессов.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = {tuple(key): value for key, value in self.snapshot()}
+        if self.merge == "sum":
+            for snapshot in others:
+                for key, value in snapshot:
+                    key = tuple(key)
+                    values[key] = self._combine(values[key], value) if key in values else value
+        items = sorted(values.items(), key=lambda kv: tuple(map(str, kv[0])))
+        return lines + self._samples(items)
+
+    def _samples(self, items: list) -> list:
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in items]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels=(), merge: str = "sum"):
+        super().__init__(name, help_text, labels)
+        self.merge = merge
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счётчики по корзинам (последняя — +Inf), сумма]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1]]
+
+    @staticmethod
+    def _combine(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+    def _samples(self, items: list) -> list:
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Ordered set of metric families of one process.
+
+    Упорядоченный набор семейств метрик одного процесса.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric: Metric) -> Metric:
+        # повторный импорт модуля не должен дублировать семейство
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: {"kind": m.kind, "values": m.snapshot()} for m in metrics}
+
+    def render(self, others=()) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics
+                         for line in m.render([o[m.name]["values"] for o in others if m.name in o])) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str, labels=()) -> Counter:
+    return REGISTRY.add(Counter(name, help_text, labels))
+
+
+def gauge(name: str, help_text: str, labels=(), merge: str = "sum") -> Gauge:
+    return REGISTRY.add(Gauge(name, help_text, labels, merge))
+
+
+def histogram(name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.add(Histogram(name, help_text, labels, buckets))
+
+
+def write_snapshot(directory: Path) -> None:
+    """
+    Atomically write this process's values to `directory`/<pid>.json.
+
+    Атомарно записать значения этого процесса в `directory`/<pid>.json.
+    """
+    path = Path(directory) / f"{os.getpid()}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps(REGISTRY.snapshot()))
+    tmp.replace(path)
+
+
+def read_snapshots(directory: Path, max_age: float | None = None) -> list:
+    """
+    Snapshots written by other processes. Gauges of files older than `max_age`
+    seconds are dropped: the process has exited, its counters still count.
+
+    Снимки, записанные другими процессами. Gauge из файлов старше `max_age`
+    секунд отбрасываются: процесс завершился, но его счётчики учитываются.
+    """
+    snapshots, now = [], time.time()
+    for path in Path(directory).glob("*.json"):
+        if path.stem == str(os.getpid()):
+            continue
+        try:
+            data = json.loads(path.read_text())
+            stale = max_age is not None and now - path.stat().st_mtime > max_age
+        except (OSError, ValueError):
+            continue
+        if stale:
+            data = {name: m for name, m in data.items() if m.get("kind") != "gauge"}
+        snapshots.append(data)
+    return snapshots
+
+
+def render(snapshot_dir: Path | None = None, max_age: float | None = None) -> str:
+    """
+    The whole registry as text; with `snapshot_dir` other processes' values are merged in.
+
+    Весь реестр текстом; с `snapshot_dir` добавляются значения других процессов.
+    """
+    others = read_snapshots(snapshot_dir, max_age) if snapshot_dir else ()
+    return REGISTRY.render(others)